@@ -1,126 +1,261 @@
-import os
-import json
-import rasterio
-from rasterio.mask import mask
-import geopandas as gpd
-from shapely.geometry import shape, mapping
-
-
-def aplicar_mascara_shapefile(shapefile_path, raster_path, output_path, nodata=0):
-    """
-    Aplica uma máscara de shapefile a um raster TIFF e salva o resultado,
-    preservando os nomes das bandas originais.
-    """
-    os.environ["SHAPE_RESTORE_SHX"] = "YES"
-
-    try:
-        # Carregar o shapefile
-        gdf = gpd.read_file(shapefile_path)
-        print(f"Shapefile carregado: {shapefile_path}")
-
-        # Abrir o raster
-        with rasterio.open(raster_path) as src:
-            print(f"Raster aberto: {raster_path}")
-            print(f"Nomes originais das bandas: {src.descriptions}")
-
-            # Converter CRS se necessário
-            if gdf.crs != src.crs:
-                print(f"Convertendo CRS: {gdf.crs} -> {src.crs}")
-                gdf = gdf.to_crs(src.crs)
-
-            # Combinar geometrias (suporta múltiplos polígonos)
-            geoms = (
-                [mapping(gdf.unary_union)]
-                if len(gdf) > 1
-                else [mapping(geom) for geom in gdf.geometry]
-            )
-
-            # Aplicar a máscara
-            out_image, out_transform = mask(
-                src, geoms, crop=True, filled=True, nodata=nodata
-            )
-
-            # Atualizar metadados
-            out_meta = src.meta.copy()
-            out_meta.update(
-                {
-                    "height": out_image.shape[1],
-                    "width": out_image.shape[2],
-                    "transform": out_transform,
-                    "nodata": nodata,
-                }
-            )
-
-        # Salvar resultado preservando nomes das bandas
-        with rasterio.open(output_path, "w", **out_meta) as dest:
-            dest.write(out_image)
-
-            for i in range(1, src.count + 1):
-                dest.set_band_description(i, src.descriptions[i - 1] or f"band_{i}")
-
-            if src.tags():
-                dest.update_tags(**src.tags())
-
-            print(f"Nomes das bandas preservados: {dest.descriptions}")
-
-        print(f"Raster recortado salvo em: {output_path}")
-        return output_path
-
-    except Exception as e:
-        print(f"Erro ao aplicar mascara: {str(e)}")
-        raise
-
-
-def aplicar_mascara_txt(txt_path, raster_path, output_path, nodata=0):
-    """
-    Aplica uma máscara a um raster TIFF utilizando um polígono em formato GeoJSON contido num arquivo .txt
-    e salva o resultado, preservando os nomes das bandas originais.
-    """
-    try:
-        # Carregar geometria do arquivo .txt
-        with open(txt_path, "r") as f:
-            geojson_data = json.load(f)
-            print(f"Geometria carregada do .txt: {txt_path}")
-
-        geom = shape(geojson_data)  # Converte para objeto shapely
-        geoms = [mapping(geom)]  # Prepara geometria para o rasterio.mask
-
-        # Abrir o raster
-        with rasterio.open(raster_path) as src:
-            print(f"Raster aberto: {raster_path}")
-            print(f"Nomes originais das bandas: {src.descriptions}")
-
-            # Aplicar a máscara
-            out_image, out_transform = mask(
-                src, geoms, crop=True, filled=True, nodata=nodata
-            )
-
-            # Atualizar metadados
-            out_meta = src.meta.copy()
-            out_meta.update(
-                {
-                    "height": out_image.shape[1],
-                    "width": out_image.shape[2],
-                    "transform": out_transform,
-                    "nodata": nodata,
-                }
-            )
-
-        # Salvar o novo raster
-        with rasterio.open(output_path, "w", **out_meta) as dest:
-            dest.write(out_image)
-
-            for i in range(1, src.count + 1):
-                dest.set_band_description(i, src.descriptions[i - 1] or f"band_{i}")
-
-            if src.tags():
-                dest.update_tags(**src.tags())
-
-            print(f"Nomes das bandas preservados: {dest.descriptions}")
-
-        print(f"Raster recortado salvo em: {output_path}")
-        return output_path
-
-    except Exception as e:
-        print(f"Erro ao aplicar mascara: {str(e)}")
-        raise
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.mask import mask, raster_geometry_mask
+from rasterio.warp import transform_geom
+import geopandas as gpd
+from shapely.geometry import shape, mapping
+
+from parametros.raster_io import RasterMemoria, guardar_raster, materializar
+from parametros.instrumentacao import instrumentar
+
+# Máscaras rasterizadas mantidas em memória (bit-packed) por processo
+MAX_MASCARAS_EM_CACHE = 32
+
+_geometrias = {}  # (shapefile, mtime) -> (geoms, crs_wkt)
+_geometrias_crs = {}  # (hash da geometria, crs destino) -> geoms reprojetadas
+_mascaras = OrderedDict()  # (hash, crs, transform, forma) -> máscara compactada
+_cache_lock = threading.Lock()
+
+
+def carregar_geometria_shapefile(shapefile_path):
+    """
+    Lê um shapefile e combina as suas geometrias (unary_union) uma única vez
+
+    O resultado fica em memória no processo: chamadas seguintes para o mesmo
+    shapefile (não alterado) não voltam a ler nem a combinar as geometrias.
+
+    Retorna:
+    tuple: (lista de geometrias GeoJSON, CRS em WKT), reutilizável em
+    aplicar_mascara_shapefile(geometria=...) e serializável entre processos
+    """
+    os.environ["SHAPE_RESTORE_SHX"] = "YES"
+
+    caminho = Path(shapefile_path).resolve()
+    chave = (str(caminho), caminho.stat().st_mtime_ns)
+    with _cache_lock:
+        if chave in _geometrias:
+            return _geometrias[chave]
+
+    gdf = gpd.read_file(shapefile_path)
+    print(f"Shapefile carregado: {shapefile_path}")
+
+    # Combinar geometrias (suporta múltiplos polígonos)
+    geoms = (
+        [mapping(gdf.unary_union)]
+        if len(gdf) > 1
+        else [mapping(geom) for geom in gdf.geometry]
+    )
+    geometria = (geoms, gdf.crs.to_wkt())
+    with _cache_lock:
+        _geometrias[chave] = geometria
+    return geometria
+
+
+def _hash_geometria(geometria) -> str:
+    geoms, crs_geometria = geometria
+    texto = json.dumps([geoms, crs_geometria], sort_keys=True)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+def geometria_no_crs(geometria, crs, chave_geometria: str = None) -> list:
+    """Geometrias (GeoJSON) reprojetadas para crs, calculadas uma vez por CRS"""
+    geoms, crs_geometria = geometria
+    crs_geometria = CRS.from_user_input(crs_geometria)
+    if crs_geometria == crs:
+        return geoms
+
+    chave = (chave_geometria or _hash_geometria(geometria), CRS(crs).to_wkt())
+    with _cache_lock:
+        if chave in _geometrias_crs:
+            return _geometrias_crs[chave]
+
+    print(f"Convertendo CRS: {crs_geometria} -> {crs}")
+    reprojetadas = [transform_geom(crs_geometria, crs, g) for g in geoms]
+    with _cache_lock:
+        _geometrias_crs[chave] = reprojetadas
+    return reprojetadas
+
+
+def mascara_da_grelha(src, geometria):
+    """
+    Máscara rasterizada da geometria na grelha do dataset src (recorte incluído)
+
+    A rasterização é feita uma vez por (geometria, CRS, transform, forma) e
+    guardada compactada (1 bit por pixel); produtos na mesma grelha (ex.: LST
+    diurno e noturno, ou o intervalo alternativo) reutilizam-na.
+
+    Retorna:
+    tuple: (máscara booleana, True fora da geometria; transform do recorte;
+    janela do recorte), como rasterio.mask.raster_geometry_mask(crop=True)
+    """
+    chave_geometria = _hash_geometria(geometria)
+    chave = (
+        chave_geometria,
+        src.crs.to_wkt() if src.crs else None,
+        tuple(src.transform)[:6],
+        src.shape,
+    )
+    with _cache_lock:
+        if chave in _mascaras:
+            _mascaras.move_to_end(chave)
+            compactada, forma, transform, janela = _mascaras[chave]
+            fora = np.unpackbits(compactada, count=forma[0] * forma[1])
+            return fora.reshape(forma).view(bool), transform, janela
+
+    geoms = geometria_no_crs(geometria, src.crs, chave_geometria)
+    fora, transform, janela = raster_geometry_mask(src, geoms, crop=True)
+
+    with _cache_lock:
+        _mascaras[chave] = (np.packbits(fora, axis=None), fora.shape, transform, janela)
+        while len(_mascaras) > MAX_MASCARAS_EM_CACHE:
+            _mascaras.popitem(last=False)
+    return fora, transform, janela
+
+
+def aplicar_mascara_dataset(src, geometria, nodata=0):
+    """
+    Recorta e mascara todas as bandas de um dataset aberto com a geometria
+
+    Equivalente a rasterio.mask.mask(src, geoms, crop=True, filled=True,
+    nodata=nodata), mas a máscara vem de mascara_da_grelha e é aplicada a
+    todas as bandas numa única operação.
+
+    Retorna:
+    tuple: (array (bandas, linhas, colunas), transform do recorte)
+    """
+    fora, transform, janela = mascara_da_grelha(src, geometria)
+    dados = src.read(window=janela, masked=True)
+    invalidos = np.ma.getmaskarray(dados) | fora
+    recorte = np.where(invalidos, np.array(nodata, dtype=dados.dtype), dados.data)
+    return recorte, transform
+
+
+@instrumentar()
+def aplicar_mascara_shapefile(
+    shapefile_path, raster_path, output_path=None, nodata=0, geometria=None
+):
+    """
+    Aplica uma máscara de shapefile a um raster TIFF, preservando os nomes das
+    bandas originais e as tags.
+
+    Com output_path o resultado é escrito em GeoTIFF e é devolvido o caminho;
+    sem output_path é devolvido um RasterMemoria (bandas, perfil, nomes das
+    bandas e tags), sem codificar um segundo GeoTIFF - só é lida do original
+    a janela recortada. raster_io.materializar escreve-o mais tarde, se
+    necessário.
+
+    geometria: resultado de carregar_geometria_shapefile, para não voltar a ler
+    e combinar o shapefile em cada chamada. Por omissão o shapefile é lido
+    uma vez por processo e a máscara rasterizada é reutilizada para rasters
+    na mesma grelha (ver mascara_da_grelha).
+    """
+    os.environ["SHAPE_RESTORE_SHX"] = "YES"
+
+    try:
+        # Carregar o shapefile
+        if geometria is None:
+            geometria = carregar_geometria_shapefile(shapefile_path)
+
+        # Abrir o raster
+        with rasterio.open(raster_path) as src:
+            print(f"Raster aberto: {raster_path}")
+            print(f"Nomes originais das bandas: {src.descriptions}")
+
+            # Aplicar a máscara (geometria reprojetada e rasterizada em cache)
+            out_image, out_transform = aplicar_mascara_dataset(
+                src, geometria, nodata=nodata
+            )
+
+            # Atualizar metadados
+            out_meta = src.meta.copy()
+            out_meta.update(
+                {
+                    "height": out_image.shape[1],
+                    "width": out_image.shape[2],
+                    "transform": out_transform,
+                    "nodata": nodata,
+                }
+            )
+            recorte = RasterMemoria(
+                out_image,
+                out_meta,
+                tuple(
+                    desc or f"band_{i}" for i, desc in enumerate(src.descriptions, 1)
+                ),
+                src.tags(),
+            )
+
+        if output_path is None:
+            print("Raster recortado mantido em memoria")
+            return recorte
+
+        # Salvar resultado preservando nomes das bandas e tags
+        materializar(recorte, output_path)
+        print(f"Nomes das bandas preservados: {recorte.descricoes}")
+        print(f"Raster recortado salvo em: {output_path}")
+        return output_path
+
+    except Exception as e:
+        print(f"Erro ao aplicar mascara: {str(e)}")
+        raise
+
+
+def aplicar_mascara_txt(txt_path, raster_path, output_path, nodata=0):
+    """
+    Aplica uma máscara a um raster TIFF utilizando um polígono em formato GeoJSON contido num arquivo .txt
+    e salva o resultado, preservando os nomes das bandas originais.
+    """
+    try:
+        # Carregar geometria do arquivo .txt
+        with open(txt_path, "r") as f:
+            geojson_data = json.load(f)
+            print(f"Geometria carregada do .txt: {txt_path}")
+
+        geom = shape(geojson_data)  # Converte para objeto shapely
+        geoms = [mapping(geom)]  # Prepara geometria para o rasterio.mask
+
+        # Abrir o raster
+        with rasterio.open(raster_path) as src:
+            print(f"Raster aberto: {raster_path}")
+            print(f"Nomes originais das bandas: {src.descriptions}")
+
+            # Aplicar a máscara
+            out_image, out_transform = mask(
+                src, geoms, crop=True, filled=True, nodata=nodata
+            )
+
+            # Atualizar metadados
+            out_meta = src.meta.copy()
+            out_meta.update(
+                {
+                    "height": out_image.shape[1],
+                    "width": out_image.shape[2],
+                    "transform": out_transform,
+                    "nodata": nodata,
+                }
+            )
+
+            descricoes = tuple(
+                desc or f"band_{i}" for i, desc in enumerate(src.descriptions, 1)
+            )
+            tags = src.tags()
+
+        # Salvar o novo raster
+        guardar_raster(
+            output_path, out_image, out_meta, descricoes=descricoes, tags=tags
+        )
+        print(f"Nomes das bandas preservados: {descricoes}")
+
+        print(f"Raster recortado salvo em: {output_path}")
+        return output_path
+
+    except Exception as e:
+        print(f"Erro ao aplicar mascara: {str(e)}")
+        raise
@@ -1,134 +1,369 @@
-import openeo
-import json
-from pathlib import Path
-import logging
-from datetime import datetime, timedelta
-import re
-
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-
-def download_sentinel_data(
-    sentinel_version: int,
-    geojson_file: str,
-    cloud_coverage: float,
-    bands: list,
-    date_interval: list,
-    output_filename: str = None,
-    s3_day_night: str = "both",  # 'day', 'night' ou 'both'
-) -> Path:
-    """
-    Download dados do Sentinel como GeoTIFF processados
-    """
-    try:
-        # Conectar ao backend
-        conn = openeo.connect(
-            "https://openeo.dataspace.copernicus.eu"
-        ).authenticate_oidc()
-        logger.info("Conexao com openEO estabelecida")
-
-        # Carregar geometria
-        with open(geojson_file) as f:
-            geojson_data = json.load(f)
-        logger.info(f"Geometria carregada de {geojson_file}")
-
-        # Determinar coleção
-        collections = {2: "SENTINEL2_L2A", 3: "SENTINEL3_SLSTR_L2_LST"}
-        collection = collections.get(sentinel_version)
-        if not collection:
-            raise ValueError(f"Versao Sentinel inválida: {sentinel_version}")
-
-        # Carregar coleção com filtros mínimos
-        load_params = {
-            "temporal_extent": date_interval,
-            "spatial_extent": geojson_data,
-            "bands": bands,
-        }
-
-        # Apenas para Sentinel-2: filtro de nuvens
-        if sentinel_version == 2:
-            load_params["properties"] = {
-                "eo:cloud_cover": lambda v: v <= cloud_coverage
-            }
-            datacube = conn.load_collection(collection, **load_params)
-        else:  # Sentinel-3
-            # Usar banda de confiança para máscara de qualidade
-            confidence_band = "confidence_in"
-            original_bands = bands.copy()
-            if confidence_band not in bands:
-                bands.append(confidence_band)
-
-            load_params["bands"] = bands
-            datacube = conn.load_collection(collection, **load_params)
-
-            # Filtrar por dia/noite usando a hora de aquisição
-            if s3_day_night != "both":
-                valid_options = ["day", "night"]
-                if s3_day_night not in valid_options:
-                    raise ValueError(
-                        f"Opçao invalida para s3_day_night: '{s3_day_night}'. Use 'day', 'night' ou 'both'"
-                    )
-
-                if s3_day_night == "day":
-                    # Filtrar para horas entre 06:00 e 19:00 UTC
-                    datacube = datacube.filter_temporal(
-                        start_date=f"{date_interval[0]}T06:00:00Z",
-                        end_date=f"{date_interval[1]}T19:00:00Z",
-                    )
-                else:
-                    datacube = datacube.filter_temporal(
-                        start_date=f"{date_interval[0]}T20:00:00Z",
-                        end_date=f"{date_interval[1]}T06:00:00Z",
-                    )
-
-                logger.info(f"Filtro temporal aplicado para imagens de {s3_day_night}")
-
-            # Criar máscara de qualidade
-            confidence_flags = datacube.band(confidence_band)
-            mask = (confidence_flags & 1 == 1) & (  # Bit 0: Land flag (1=land)
-                confidence_flags & 2 == 0
-            )  # Bit 1: Cloud flag (0=no cloud)
-
-            # Aplicar máscara e manter bandas originais
-            datacube = datacube.filter_bands(original_bands).mask(mask)
-            logger.info("Máscara de Terra aplicada para Sentinel-3")
-
-        # Composição temporal
-        reducer = "median" if sentinel_version == 2 else "mean"
-        composicao = datacube.reduce_dimension(dimension="t", reducer=reducer)
-        logger.info(f"Redução temporal aplicada com {reducer}")
-
-        # Nome do arquivo de saída
-        if not output_filename:
-            band_str = "_".join(original_bands if sentinel_version == 3 else bands)
-            dn_suffix = (
-                f"_{s3_day_night}"
-                if sentinel_version == 3 and s3_day_night != "both"
-                else ""
-            )
-
-            # Sanitizar nome do arquivo
-            clean_band_str = re.sub(r"[^a-zA-Z0-9_]", "", band_str)
-            output_filename = f"Sentinel{sentinel_version}_{clean_band_str}{dn_suffix}_{date_interval[0]}_{date_interval[1]}.tif"
-
-        # Configurações de download
-        download_options = {
-            "sample_by_feature": True,
-            "data_type": "Float32" if sentinel_version == 3 else "uint16",
-        }
-
-        # Garantir diretoria de saída
-        output_path = Path(output_filename)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-
-        logger.info(f"A iniciar download para {output_path}")
-        composicao.download(str(output_path), format="GTiff", options=download_options)
-        logger.info(f"Download completo: {output_path}")
-
-        return output_path.resolve()
-
-    except Exception as e:
-        logger.error(f"Erro no download de dados Sentinel-{sentinel_version}: {str(e)}")
-        raise
+import openeo
+from openeo.rest import OpenEoApiError
+import json
+import os
+from pathlib import Path
+import logging
+from datetime import date, datetime, timedelta
+import re
+import shutil
+import threading
+
+from cache_downloads import obter_cache
+from parametros.instrumentacao import instrumentar
+
+logger = logging.getLogger(__name__)
+
+URL_OPENEO = "https://openeo.dataspace.copernicus.eu"
+
+# Variável de ambiente com as opções (JSON) do backend local de openeo_local;
+# é herdada pelos processos de trabalho, onde obter_sessao a usa em vez do openEO
+VARIAVEL_BACKEND_LOCAL = "OPENEO_LOCAL"
+
+# Produtos Sentinel usados no cálculo do NPP
+PRODUTOS_SENTINEL = {
+    "Sentinel-2": {"sentinel_version": 2, "bands": ["B04", "B08", "B11", "B12"]},
+    "LST diurno": {"sentinel_version": 3, "bands": ["LST"], "s3_day_night": "day"},
+    "LST noturno": {"sentinel_version": 3, "bands": ["LST"], "s3_day_night": "night"},
+}
+
+
+def intervalos_do_mes(ano: int, mes: int) -> list:
+    """
+    Intervalos de pesquisa de um mês, por ordem de tentativa
+
+    Retorna:
+    list: [(date_interval, cloud_coverage), ...] - intervalo principal (dias
+    1 a 8, nuvens <= 10%) e alternativo (dias 9 a 28, nuvens <= 20%)
+    """
+    data_inicial = date(ano, mes, 1)
+    data_final = data_inicial + timedelta(days=7)
+    data_alternativa = data_inicial + timedelta(days=8)
+    data_alternativa_fim = data_inicial.replace(day=28)
+
+    data = [data_inicial.isoformat(), data_final.isoformat()]
+    data2 = [data_alternativa.isoformat(), data_alternativa_fim.isoformat()]
+    return [(data, 10), (data2, 20)]
+
+
+def conectar_openeo(url: str = URL_OPENEO):
+    """Abre uma ligação ao backend openEO e autentica via OIDC"""
+    return openeo.connect(url).authenticate_oidc()
+
+
+class SessaoOpenEO:
+    """
+    Ligação openEO autenticada, partilhada entre downloads (incluindo threads)
+
+    A ligação é criada na primeira utilização e reutilizada; o cliente openEO
+    renova o access token com o refresh token OIDC e, se o backend ainda assim
+    rejeitar a autenticação (401/403), a sessão volta a autenticar e repete o
+    pedido uma vez. fabrica_conexao permite injetar outra ligação (ex.: testes
+    ou benchmarks sem rede).
+    """
+
+    def __init__(self, url: str = URL_OPENEO, fabrica_conexao=None):
+        self.url = url
+        self._fabrica_conexao = fabrica_conexao or conectar_openeo
+        self._conexao = None
+        self._lock = threading.Lock()
+
+    def conexao(self):
+        """Devolve a ligação autenticada, criando-a se necessário"""
+        with self._lock:
+            if self._conexao is None:
+                self._conexao = self._fabrica_conexao(self.url)
+                logger.info("Conexao com openEO estabelecida")
+            return self._conexao
+
+    def renovar(self, conexao_rejeitada=None):
+        """
+        Descarta a ligação atual e autentica de novo
+
+        Se outra thread já tiver renovado a ligação rejeitada, reutiliza a nova.
+        """
+        with self._lock:
+            if conexao_rejeitada is None or self._conexao is conexao_rejeitada:
+                self._conexao = None
+        logger.info("A renovar autenticacao openEO")
+        return self.conexao()
+
+    def executar(self, funcao):
+        """Executa funcao(conexao), renovando a autenticação uma vez se expirada"""
+        conn = self.conexao()
+        try:
+            return funcao(conn)
+        except OpenEoApiError as e:
+            if e.http_status_code not in (401, 403):
+                raise
+            logger.warning(f"Autenticacao openEO rejeitada ({e.code}), a repetir")
+            return funcao(self.renovar(conn))
+
+
+_sessao = None
+_sessao_lock = threading.Lock()
+
+
+def obter_sessao() -> SessaoOpenEO:
+    """
+    Devolve a sessão openEO partilhada do processo (criada na primeira utilização)
+
+    Se a variável de ambiente VARIAVEL_BACKEND_LOCAL estiver definida (ver
+    openeo_local.ativar_backend_local) a sessão usa o backend local em vez
+    do openEO.
+    """
+    global _sessao
+    with _sessao_lock:
+        if _sessao is None:
+            opcoes_local = os.environ.get(VARIAVEL_BACKEND_LOCAL)
+            if opcoes_local is not None:
+                from openeo_local import sessao_local
+
+                _sessao = sessao_local(**json.loads(opcoes_local or "{}"))
+            else:
+                _sessao = SessaoOpenEO()
+        return _sessao
+
+
+def definir_sessao(sessao: SessaoOpenEO):
+    """Substitui a sessão openEO partilhada (ex.: ligação falsa em testes)"""
+    global _sessao
+    with _sessao_lock:
+        _sessao = sessao
+
+
+def meses_entre(inicio: str, fim: str) -> list:
+    """Lista (ano, mes) de inicio a fim, inclusive, no formato AAAA-MM"""
+    ano, mes = map(int, inicio.split("-"))
+    ano_fim, mes_fim = map(int, fim.split("-"))
+    meses = []
+    while (ano, mes) <= (ano_fim, mes_fim):
+        meses.append((ano, mes))
+        ano, mes = (ano + 1, 1) if mes == 12 else (ano, mes + 1)
+    return meses
+
+
+def parametros_pedido(
+    sentinel_version: int,
+    cloud_coverage: float,
+    bands: list,
+    date_interval: list,
+    s3_day_night: str = "both",
+    backend: str = URL_OPENEO,
+) -> dict:
+    """
+    Parâmetros que identificam um pedido na cache de downloads (sem a geometria)
+
+    backend é o URL da sessão; só entra nos parâmetros quando não é o openEO,
+    para que os compósitos de outro backend (ex.: openeo_local) não sejam
+    servidos como downloads reais.
+    """
+    collections = {2: "SENTINEL2_L2A", 3: "SENTINEL3_SLSTR_L2_LST"}
+    parametros = {
+        "colecao": collections.get(sentinel_version),
+        "bandas": list(bands),
+        "nuvens": cloud_coverage if sentinel_version == 2 else None,
+        "intervalo": list(date_interval),
+        "dia_noite": s3_day_night if sentinel_version == 3 else None,
+    }
+    if backend != URL_OPENEO:
+        parametros["backend"] = backend
+    return parametros
+
+
+def opcoes_download(sentinel_version: int) -> dict:
+    """Opções de formato do GeoTIFF pedido ao backend"""
+    return {
+        "sample_by_feature": True,
+        "data_type": "Float32" if sentinel_version == 3 else "uint16",
+    }
+
+
+def construir_composicao(
+    conn,
+    sentinel_version: int,
+    geojson_data: dict,
+    cloud_coverage: float,
+    bands: list,
+    date_interval: list,
+    s3_day_night: str = "both",
+):
+    """
+    Constrói o datacube openEO (filtros, máscara de qualidade e composição
+    temporal) de um pedido Sentinel, sem o executar
+    """
+    collections = {2: "SENTINEL2_L2A", 3: "SENTINEL3_SLSTR_L2_LST"}
+    collection = collections.get(sentinel_version)
+    if not collection:
+        raise ValueError(f"Versao Sentinel inválida: {sentinel_version}")
+
+    bands = list(bands)
+
+    # Carregar coleção com filtros mínimos
+    load_params = {
+        "temporal_extent": date_interval,
+        "spatial_extent": geojson_data,
+        "bands": bands,
+    }
+
+    # Apenas para Sentinel-2: filtro de nuvens
+    if sentinel_version == 2:
+        load_params["properties"] = {"eo:cloud_cover": lambda v: v <= cloud_coverage}
+        datacube = conn.load_collection(collection, **load_params)
+    else:  # Sentinel-3
+        # Usar banda de confiança para máscara de qualidade
+        confidence_band = "confidence_in"
+        original_bands = bands.copy()
+        if confidence_band not in bands:
+            bands.append(confidence_band)
+
+        load_params["bands"] = bands
+        datacube = conn.load_collection(collection, **load_params)
+
+        # Filtrar por dia/noite usando a hora de aquisição
+        if s3_day_night != "both":
+            valid_options = ["day", "night"]
+            if s3_day_night not in valid_options:
+                raise ValueError(
+                    f"Opçao invalida para s3_day_night: '{s3_day_night}'. Use 'day', 'night' ou 'both'"
+                )
+
+            if s3_day_night == "day":
+                # Filtrar para horas entre 06:00 e 19:00 UTC
+                datacube = datacube.filter_temporal(
+                    start_date=f"{date_interval[0]}T06:00:00Z",
+                    end_date=f"{date_interval[1]}T19:00:00Z",
+                )
+            else:
+                datacube = datacube.filter_temporal(
+                    start_date=f"{date_interval[0]}T20:00:00Z",
+                    end_date=f"{date_interval[1]}T06:00:00Z",
+                )
+
+            logger.info(f"Filtro temporal aplicado para imagens de {s3_day_night}")
+
+        # Criar máscara de qualidade
+        confidence_flags = datacube.band(confidence_band)
+        mask = (confidence_flags & 1 == 1) & (  # Bit 0: Land flag (1=land)
+            confidence_flags & 2 == 0
+        )  # Bit 1: Cloud flag (0=no cloud)
+
+        # Aplicar máscara e manter bandas originais
+        datacube = datacube.filter_bands(original_bands).mask(mask)
+        logger.info("Máscara de Terra aplicada para Sentinel-3")
+
+    # Composição temporal
+    reducer = "median" if sentinel_version == 2 else "mean"
+    composicao = datacube.reduce_dimension(dimension="t", reducer=reducer)
+    logger.info(f"Redução temporal aplicada com {reducer}")
+
+    return composicao
+
+
+@instrumentar()
+def download_sentinel_data(
+    sentinel_version: int,
+    geojson_file: str,
+    cloud_coverage: float,
+    bands: list,
+    date_interval: list,
+    output_filename: str = None,
+    s3_day_night: str = "both",  # 'day', 'night' ou 'both'
+    usar_cache: bool = True,
+    sessao: "SessaoOpenEO" = None,
+) -> Path:
+    """
+    Download dados do Sentinel como GeoTIFF processados
+
+    Com usar_cache, um pedido já feito (mesma coleção, geometria, bandas,
+    nuvens, intervalo e dia/noite) é servido pela cache local de downloads sem
+    contactar o backend: devolve o GeoTIFF em cache, ou uma cópia dele em
+    output_filename quando este é indicado.
+
+    A ligação ao backend vem de sessao (por omissão a sessão partilhada do
+    processo, ver obter_sessao), pelo que a autenticação OIDC é feita uma vez.
+    Qualquer ligação com a API openEO usada em construir_composicao serve de
+    backend, como a ConexaoLocal de openeo_local (sem rede nem credenciais).
+    """
+    try:
+        # Carregar geometria
+        with open(geojson_file) as f:
+            geojson_data = json.load(f)
+        logger.info(f"Geometria carregada de {geojson_file}")
+
+        # Determinar coleção
+        collections = {2: "SENTINEL2_L2A", 3: "SENTINEL3_SLSTR_L2_LST"}
+        collection = collections.get(sentinel_version)
+        if not collection:
+            raise ValueError(f"Versao Sentinel inválida: {sentinel_version}")
+
+        # Procurar o pedido na cache de downloads
+        sessao = sessao or obter_sessao()
+        cache = obter_cache() if usar_cache else None
+        if cache is not None:
+            parametros_cache = parametros_pedido(
+                sentinel_version,
+                cloud_coverage,
+                bands,
+                date_interval,
+                s3_day_night,
+                backend=sessao.url,
+            )
+            chave = cache.chave(geometria=geojson_data, **parametros_cache)
+            em_cache = cache.obter(chave)
+            if em_cache is not None:
+                if not output_filename:
+                    return em_cache
+                output_path = Path(output_filename)
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(em_cache, output_path)
+                logger.info(f"Download servido pela cache: {output_path}")
+                return output_path.resolve()
+
+        # Nome do arquivo de saída
+        if not output_filename:
+            band_str = "_".join(bands)
+            dn_suffix = (
+                f"_{s3_day_night}"
+                if sentinel_version == 3 and s3_day_night != "both"
+                else ""
+            )
+
+            # Sanitizar nome do arquivo
+            clean_band_str = re.sub(r"[^a-zA-Z0-9_]", "", band_str)
+            output_filename = f"Sentinel{sentinel_version}_{clean_band_str}{dn_suffix}_{date_interval[0]}_{date_interval[1]}.tif"
+
+        # Configurações de download
+        download_options = opcoes_download(sentinel_version)
+
+        # Garantir diretoria de saída
+        output_path = Path(output_filename)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Conectar ao backend (ligação partilhada) e descarregar
+        def descarregar(conn):
+            composicao = construir_composicao(
+                conn,
+                sentinel_version,
+                geojson_data,
+                cloud_coverage,
+                bands,
+                date_interval,
+                s3_day_night,
+            )
+            logger.info(f"A iniciar download para {output_path}")
+            composicao.download(
+                str(output_path), format="GTiff", options=download_options
+            )
+
+        sessao.executar(descarregar)
+        logger.info(f"Download completo: {output_path}")
+
+        if cache is not None:
+            cache.guardar(chave, output_path, parametros_cache)
+
+        return output_path.resolve()
+
+    except Exception as e:
+        logger.error(f"Erro no download de dados Sentinel-{sentinel_version}: {str(e)}")
+        raise
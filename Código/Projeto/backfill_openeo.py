@@ -0,0 +1,280 @@
+import argparse
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from Download import (
+    PRODUTOS_SENTINEL,
+    construir_composicao,
+    intervalos_do_mes,
+    meses_entre,
+    obter_sessao,
+    opcoes_download,
+    parametros_pedido,
+)
+from cache_downloads import obter_cache
+
+logger = logging.getLogger(__name__)
+
+# Estados openEO de um batch job que já não vão mudar
+ESTADOS_FINAIS = {"finished", "error", "canceled"}
+
+
+def pedidos_backfill(meses: list, produtos: dict = PRODUTOS_SENTINEL) -> dict:
+    """
+    Cria os pedidos (produto, mês) de um backfill
+
+    Args:
+        meses: Lista de (ano, mes)
+        produtos: Produtos a pedir (por omissão os três do cálculo do NPP)
+
+    Returns:
+        dict: id_pedido -> {"produto", "ano", "mes", "intervalos", parâmetros do produto}
+    """
+    pedidos = {}
+    for ano, mes in meses:
+        for nome, params in produtos.items():
+            id_pedido = f"{ano}-{mes:02d}_{nome.replace(' ', '_')}"
+            pedidos[id_pedido] = dict(
+                params,
+                produto=nome,
+                ano=ano,
+                mes=mes,
+                intervalos=intervalos_do_mes(ano, mes),
+            )
+    return pedidos
+
+
+def executar_backfill(
+    meses: list,
+    geojson_file: Path,
+    destino_dir: Path,
+    ficheiro_estado: Path = None,
+    max_jobs_ativos: int = 4,
+    intervalo_polling: float = 30,
+    produtos: dict = PRODUTOS_SENTINEL,
+    sessao=None,
+    usar_cache: bool = True,
+    repetir_falhados: bool = True,
+) -> dict:
+    """
+    Descarrega vários meses de produtos Sentinel através de batch jobs openEO
+
+    Em vez de um pedido síncrono por produto, submete batch jobs para todos os
+    pares (produto, mês), com no máximo max_jobs_ativos em simultâneo, e
+    descarrega cada resultado assim que o job termina. Se um job falhar é
+    submetido o intervalo alternativo do mês, como no modo síncrono.
+
+    Os IDs dos jobs e o estado de cada pedido são gravados em ficheiro_estado
+    após cada alteração: um backfill interrompido retoma os jobs já
+    submetidos e não volta a pedir os já descarregados. Os resultados são
+    também guardados na cache de downloads, pelo que main.main desses meses
+    não volta a contactar o backend. Os pedidos que falharam numa execução
+    anterior voltam à fila desde o primeiro intervalo (repetir_falhados=False
+    para os ignorar).
+
+    Returns:
+        dict: id_pedido -> caminho do GeoTIFF (apenas pedidos concluídos)
+    """
+    destino_dir = Path(destino_dir)
+    destino_dir.mkdir(parents=True, exist_ok=True)
+    ficheiro_estado = Path(ficheiro_estado or destino_dir / "estado_backfill.json")
+
+    with open(geojson_file) as f:
+        geojson_data = json.load(f)
+
+    sessao = sessao or obter_sessao()
+    cache = obter_cache() if usar_cache else None
+
+    pedidos = pedidos_backfill(meses, produtos)
+    estado = _ler_estado(ficheiro_estado)
+
+    fila = []
+    ativos = []
+    for id_pedido in pedidos:
+        registo = estado.setdefault(id_pedido, {"tentativa": 0})
+        if (
+            registo.get("estado") == "descarregado"
+            and Path(registo["ficheiro"]).exists()
+        ):
+            continue
+        if registo.get("estado") == "falhou":
+            if not repetir_falhados:
+                continue
+            logger.info(f"A repetir pedido falhado {id_pedido}")
+            registo.clear()
+            registo["tentativa"] = 0
+        if registo.get("job_id"):
+            # Job submetido numa execução anterior: retomar o acompanhamento
+            logger.info(f"A retomar job {registo['job_id']} ({id_pedido})")
+            ativos.append(id_pedido)
+        else:
+            fila.append(id_pedido)
+    _gravar_estado(ficheiro_estado, estado)
+
+    while fila or ativos:
+        # Submeter novos jobs até ao limite de concorrência
+        while fila and len(ativos) < max_jobs_ativos:
+            id_pedido = fila.pop(0)
+            _submeter(
+                id_pedido, pedidos[id_pedido], estado[id_pedido], geojson_data, sessao
+            )
+            _gravar_estado(ficheiro_estado, estado)
+            ativos.append(id_pedido)
+
+        time.sleep(intervalo_polling)
+
+        for id_pedido in list(ativos):
+            registo = estado[id_pedido]
+            job_id = registo["job_id"]
+            status = sessao.executar(lambda conn: conn.job(job_id).status())
+            if status not in ESTADOS_FINAIS:
+                continue
+
+            ativos.remove(id_pedido)
+            if status == "finished":
+                registo["ficheiro"] = str(
+                    _descarregar_resultado(
+                        id_pedido,
+                        pedidos[id_pedido],
+                        registo,
+                        geojson_data,
+                        destino_dir,
+                        sessao,
+                        cache,
+                    )
+                )
+                registo["estado"] = "descarregado"
+            elif registo["tentativa"] + 1 < len(pedidos[id_pedido]["intervalos"]):
+                logger.warning(
+                    f"Job {job_id} ({id_pedido}) terminou com '{status}', "
+                    "a tentar intervalo alternativo"
+                )
+                registo["tentativa"] += 1
+                registo.pop("job_id")
+                fila.append(id_pedido)
+            else:
+                logger.error(f"Job {job_id} ({id_pedido}) terminou com '{status}'")
+                registo["estado"] = "falhou"
+            _gravar_estado(ficheiro_estado, estado)
+
+    concluidos = {
+        id_pedido: Path(estado[id_pedido]["ficheiro"])
+        for id_pedido in pedidos
+        if estado[id_pedido].get("estado") == "descarregado"
+    }
+    logger.info(f"Backfill concluido: {len(concluidos)}/{len(pedidos)} pedidos")
+    return concluidos
+
+
+def _submeter(id_pedido: str, pedido: dict, registo: dict, geojson_data: dict, sessao):
+    """Cria e arranca o batch job de um pedido, registando o job_id"""
+    date_interval, cloud_coverage = pedido["intervalos"][registo["tentativa"]]
+
+    def submeter(conn):
+        composicao = construir_composicao(
+            conn,
+            pedido["sentinel_version"],
+            geojson_data,
+            cloud_coverage,
+            pedido["bands"],
+            date_interval,
+            pedido.get("s3_day_night", "both"),
+        )
+        job = composicao.create_job(
+            out_format="GTiff",
+            title=f"backfill {id_pedido}",
+            **opcoes_download(pedido["sentinel_version"]),
+        )
+        job.start()
+        return job.job_id
+
+    registo["job_id"] = sessao.executar(submeter)
+    registo["estado"] = "submetido"
+    registo["intervalo"] = list(date_interval)
+    logger.info(f"Job {registo['job_id']} submetido ({id_pedido}, {date_interval})")
+
+
+def _descarregar_resultado(
+    id_pedido: str,
+    pedido: dict,
+    registo: dict,
+    geojson_data: dict,
+    destino_dir: Path,
+    sessao,
+    cache,
+) -> Path:
+    """Descarrega o GeoTIFF de um job terminado e guarda-o na cache de downloads"""
+    destino = destino_dir / f"{id_pedido}.tif"
+    job_id = registo["job_id"]
+    sessao.executar(lambda conn: conn.job(job_id).get_results().download_file(destino))
+    logger.info(f"Resultado do job {job_id} descarregado: {destino}")
+
+    if cache is not None:
+        date_interval, cloud_coverage = pedido["intervalos"][registo["tentativa"]]
+        parametros = parametros_pedido(
+            pedido["sentinel_version"],
+            cloud_coverage,
+            pedido["bands"],
+            date_interval,
+            pedido.get("s3_day_night", "both"),
+            backend=sessao.url,
+        )
+        cache.guardar(
+            cache.chave(geometria=geojson_data, **parametros), destino, parametros
+        )
+
+    return destino
+
+
+def _ler_estado(ficheiro_estado: Path) -> dict:
+    if not ficheiro_estado.exists():
+        return {}
+    with open(ficheiro_estado, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _gravar_estado(ficheiro_estado: Path, estado: dict):
+    """Grava o estado de forma atómica (um backfill interrompido não o corrompe)"""
+    temporario = ficheiro_estado.with_suffix(".tmp")
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump(estado, f, indent=2)
+    os.replace(temporario, ficheiro_estado)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    projeto_dir = Path(__file__).parent.resolve()
+
+    parser = argparse.ArgumentParser(
+        description="Backfill de meses via batch jobs openEO"
+    )
+    parser.add_argument("inicio", help="primeiro mês (AAAA-MM)")
+    parser.add_argument("fim", help="último mês (AAAA-MM)")
+    parser.add_argument("--geojson", type=Path, default=projeto_dir / "coordenadas.txt")
+    parser.add_argument(
+        "--destino", type=Path, default=projeto_dir / "INPUTS" / "BACKFILL"
+    )
+    parser.add_argument("--max-jobs", type=int, default=4)
+    parser.add_argument("--polling", type=float, default=30)
+    parser.add_argument(
+        "--sem-repetir-falhados",
+        action="store_true",
+        help="não volta a pedir os meses que falharam numa execução anterior",
+    )
+    args = parser.parse_args()
+
+    executar_backfill(
+        meses_entre(args.inicio, args.fim),
+        geojson_file=args.geojson,
+        destino_dir=args.destino,
+        max_jobs_ativos=args.max_jobs,
+        intervalo_polling=args.polling,
+        repetir_falhados=not args.sem_repetir_falhados,
+    )
@@ -0,0 +1,516 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_bounds, from_origin
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from parametros import instrumentacao, kernels
+from parametros.Param_FPAR import calcular_fpar, calcular_ndvi
+from parametros.Param_WSC import calculate_WSC_from_tif
+from parametros.Param_T1_T2 import calcular_T1_T2
+from parametros.Param_SOL import calcular_sol, recortar_ghi
+from parametros.Param_Emax import calcular_emax
+from parametros.calc_NPP import calcular_npp
+from parametros.analise_NPP import analisar_npp
+from parametros.raster_io import GrelhaAlvo
+
+logger = logging.getLogger(__name__)
+
+# Tamanhos da grelha Sentinel-2 (largura, altura), a 10 m
+TAMANHOS = {
+    "oeiras": (1050, 860),  # ~0.9 Mpixel, extensão de Oeiras
+    "medio": (3200, 3200),  # ~10 Mpixel
+    "grande": (10000, 10000),  # ~100 Mpixel
+}
+
+# Canto superior esquerdo (UTM 29N) das grelhas sintéticas, perto de Oeiras
+ORIGEM_UTM = (470000.0, 4290000.0)
+CRS_UTM = "EPSG:32629"
+
+# Resoluções dos produtos reais: LST Sentinel-3 (~1 km), WorldCover e GHI
+RESOLUCAO_S3 = 1000.0
+RESOLUCAO_WORLDCOVER = 1 / 12000
+RESOLUCAO_GHI = 1 / 400
+
+# Linhas escritas de cada vez ao gerar as entradas (memória limitada)
+LINHAS_POR_BLOCO = 1024
+
+# Parâmetros de Oeiras usados em SOL e na análise
+MES, ANO = 6, 2024
+VAR_PCT_MES = {MES: 10.0}
+POPULACAO = 172120
+EMISSOES_CO2_PER_CAPITA = 0.8917
+
+
+class EntradasSinteticas(NamedTuple):
+    """Ficheiros de entrada sintéticos de um tamanho e a grelha do Sentinel-2"""
+
+    s2: Path
+    lst_dia: Path
+    lst_noite: Path
+    worldcover: Path
+    ghi: Path
+    wkt: Path
+    grelha: GrelhaAlvo
+
+
+def gerar_entradas(
+    diretoria: Path, largura: int, altura: int, semente: int = 0
+) -> EntradasSinteticas:
+    """
+    Gera (uma vez) entradas georreferenciadas semelhantes às reais
+
+    Sentinel-2 com as bandas B04/B08/B11/B12 em UTM a 10 m, LST diurno e
+    noturno do Sentinel-3 a ~1 km, WorldCover e GHI em EPSG:4326, todos a
+    cobrir a mesma área. Os ficheiros já existentes com o mesmo tamanho são
+    reutilizados.
+    """
+    diretoria = Path(diretoria)
+    diretoria.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(semente)
+
+    x0, y0 = ORIGEM_UTM
+    transform = from_origin(x0, y0, 10, 10)
+    grelha = GrelhaAlvo(CRS.from_string(CRS_UTM), transform, largura, altura)
+    limites_utm = (x0, y0 - altura * 10, x0 + largura * 10, y0)
+    limites = transform_bounds(CRS_UTM, "EPSG:4326", *limites_utm)
+
+    entradas = EntradasSinteticas(
+        s2=diretoria / "Sentinel2_B04_B08_B11_B12.tif",
+        lst_dia=diretoria / "LST_dia.tif",
+        lst_noite=diretoria / "LST_noite.tif",
+        worldcover=diretoria / "WorldCover.tif",
+        ghi=diretoria / "GHI.tif",
+        wkt=diretoria / "area.wkt",
+        grelha=grelha,
+    )
+
+    if not entradas.s2.exists():
+        # Reflectâncias (x10000) típicas de vegetação e solo
+        intervalos = ((300, 1500), (1500, 4000), (1000, 3000), (500, 2000))
+        _escrever_por_blocos(
+            entradas.s2,
+            largura,
+            altura,
+            transform,
+            CRS_UTM,
+            "uint16",
+            lambda linhas: np.stack(
+                [
+                    rng.integers(a, b, (linhas, largura), dtype=np.uint16)
+                    for a, b in intervalos
+                ]
+            ),
+            count=4,
+            nodata=0,
+            descricoes=("B04", "B08", "B11", "B12"),
+            tags={"DATE": f"{ANO}-{MES:02d}-15"},
+        )
+
+    largura_s3 = max(1, round(largura * 10 / RESOLUCAO_S3))
+    altura_s3 = max(1, round(altura * 10 / RESOLUCAO_S3))
+    for caminho, media in ((entradas.lst_dia, 303.0), (entradas.lst_noite, 290.0)):
+        if not caminho.exists():
+            _escrever_por_blocos(
+                caminho,
+                largura_s3,
+                altura_s3,
+                from_bounds(*limites, largura_s3, altura_s3),
+                "EPSG:4326",
+                "float32",
+                lambda linhas: rng.normal(media, 3.0, (1, linhas, largura_s3)),
+                nodata=-9999,
+            )
+
+    if not entradas.worldcover.exists():
+        largura_wc = int(np.ceil((limites[2] - limites[0]) / RESOLUCAO_WORLDCOVER))
+        altura_wc = int(np.ceil((limites[3] - limites[1]) / RESOLUCAO_WORLDCOVER))
+        classes = np.array([10, 20, 30, 40, 50, 60, 80], dtype=np.uint8)
+        _escrever_por_blocos(
+            entradas.worldcover,
+            largura_wc,
+            altura_wc,
+            from_origin(
+                limites[0], limites[3], RESOLUCAO_WORLDCOVER, RESOLUCAO_WORLDCOVER
+            ),
+            "EPSG:4326",
+            "uint8",
+            lambda linhas: rng.choice(classes, (1, linhas, largura_wc)),
+            nodata=0,
+        )
+
+    if not entradas.ghi.exists():
+        margem = 5 * RESOLUCAO_GHI
+        largura_ghi = int(np.ceil((limites[2] - limites[0]) / RESOLUCAO_GHI)) + 10
+        altura_ghi = int(np.ceil((limites[3] - limites[1]) / RESOLUCAO_GHI)) + 10
+        _escrever_por_blocos(
+            entradas.ghi,
+            largura_ghi,
+            altura_ghi,
+            from_origin(
+                limites[0] - margem, limites[3] + margem, RESOLUCAO_GHI, RESOLUCAO_GHI
+            ),
+            "EPSG:4326",
+            "float32",
+            lambda linhas: rng.uniform(4.2, 4.8, (1, linhas, largura_ghi)),
+            nodata=-9999,
+        )
+
+    if not entradas.wkt.exists():
+        oeste, sul, este, norte = limites
+        entradas.wkt.write_text(
+            f"POLYGON (({oeste} {sul}, {este} {sul}, {este} {norte}, "
+            f"{oeste} {norte}, {oeste} {sul}))",
+            encoding="utf-8",
+        )
+
+    return entradas
+
+
+def _escrever_por_blocos(
+    caminho,
+    largura,
+    altura,
+    transform,
+    crs,
+    dtype,
+    gerar,
+    count=1,
+    nodata=None,
+    descricoes=None,
+    tags=None,
+):
+    """Escreve um GeoTIFF em faixas de LINHAS_POR_BLOCO linhas (gerar(linhas))"""
+    perfil = {
+        "driver": "GTiff",
+        "dtype": dtype,
+        "count": count,
+        "width": largura,
+        "height": altura,
+        "crs": crs,
+        "transform": transform,
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "BIGTIFF": "IF_SAFER",
+    }
+    temporario = Path(caminho).with_suffix(".tmp.tif")
+    with rasterio.open(temporario, "w", **perfil) as dst:
+        for linha in range(0, altura, LINHAS_POR_BLOCO):
+            linhas = min(LINHAS_POR_BLOCO, altura - linha)
+            dst.write(
+                gerar(linhas).astype(dtype, copy=False),
+                window=Window(0, linha, largura, linhas),
+            )
+        if descricoes:
+            dst.descriptions = descricoes
+        if tags:
+            dst.update_tags(**tags)
+    temporario.replace(caminho)
+
+
+def medir_kernel(nome: str, funcao, pixeis: int, repeticoes: int = 1):
+    """
+    Executa funcao repeticoes vezes e mede tempo e memória
+
+    Retorna:
+    tuple: (resultado da última execução, linha de resultados com o melhor
+        tempo, o débito em Mpixel/s e o maior pico de memória residente)
+    """
+    tempos = []
+    picos = []
+    incrementos = []
+    for _ in range(repeticoes):
+        # As mensagens dos kernels não entram na medição
+        with contextlib.redirect_stdout(io.StringIO()):
+            with instrumentacao.medir(nome) as registo:
+                resultado = funcao()
+        tempos.append(registo["duracao_s"])
+        picos.append(registo["rss_pico_mb"] or 0.0)
+        incrementos.append(
+            (registo["rss_pico_mb"] or 0.0) - (registo["rss_inicio_mb"] or 0.0)
+        )
+
+    segundos = min(tempos)
+    linha = {
+        "kernel": nome,
+        "pixeis": pixeis,
+        "segundos": round(segundos, 4),
+        "mpixel_s": round(pixeis / 1e6 / segundos, 2) if segundos > 0 else None,
+        "rss_pico_mb": max(picos),
+        "rss_incremento_mb": round(max(incrementos), 1),
+        "repeticoes": repeticoes,
+    }
+    logger.info(
+        f"{nome}: {linha['segundos']:.3f} s, {linha['mpixel_s']} Mpixel/s, "
+        f"pico {linha['rss_pico_mb']} MB"
+    )
+    return resultado, linha
+
+
+def executar_pipeline_offline(entradas: EntradasSinteticas, diretoria: Path) -> dict:
+    """Encadeia os cálculos do mês (FPAR, WSC, T1/T2, SOL, E_max, NPP e análise)"""
+    fpar = calcular_fpar(calcular_ndvi(entradas.s2))
+    wsc = calculate_WSC_from_tif(entradas.s2)
+    T1, t2 = calcular_T1_T2(str(entradas.lst_dia), str(entradas.lst_noite))
+    sol = calcular_sol(
+        diretoria,
+        None,
+        MES,
+        ANO,
+        VAR_PCT_MES,
+        3.6,
+        1.0,
+        ghi_recortado=recortar_ghi(diretoria, entradas.ghi, entradas.wkt),
+    )
+    emax = calcular_emax(entradas.worldcover, None, grelha=entradas.grelha)
+    npp = calcular_npp(
+        diretoria,
+        diretoria / "RESULT",
+        camadas={"FPAR": fpar, "T2": t2, "WSC": wsc, "SOL": sol, "E_max": emax},
+        T1=T1,
+        grelha=entradas.grelha,
+    )
+    return analisar_npp(
+        npp,
+        diretoria / "ANALISE",
+        POPULACAO,
+        EMISSOES_CO2_PER_CAPITA,
+        mes=MES,
+        ano_referencia=ANO,
+    )
+
+
+def executar_benchmark(
+    tamanhos: list, diretoria: Path, repeticoes: int = 1, semente: int = 0
+) -> list:
+    """
+    Mede cada kernel de parametros e o pipeline completo, por tamanho
+
+    Cada kernel recebe as saídas em memória do anterior (calculadas na
+    mesma passagem), como em main. Não usa a rede nem o openEO. Os cálculos
+    por pixel correm no backend ativo de parametros.kernels.
+
+    Retorna:
+    list: Uma linha por (tamanho, kernel) - ver medir_kernel
+    """
+    linhas = []
+    instrumentacao.ativar()
+    try:
+        for tamanho in tamanhos:
+            largura, altura = TAMANHOS[tamanho]
+            logger.info(f"--- {tamanho}: {largura}x{altura} ---")
+            trabalho = Path(diretoria) / tamanho
+            entradas = gerar_entradas(trabalho / "INPUTS", largura, altura, semente)
+            n = largura * altura
+            with rasterio.open(entradas.lst_dia) as src:
+                n_s3 = src.width * src.height
+
+            def medir(nome, funcao, pixeis=n):
+                resultado, linha = medir_kernel(nome, funcao, pixeis, repeticoes)
+                linhas.append(
+                    dict(
+                        tamanho=tamanho,
+                        largura=largura,
+                        altura=altura,
+                        backend=kernels.backend_ativo(),
+                        **linha,
+                    )
+                )
+                return resultado
+
+            ndvi = medir("calcular_ndvi", lambda: calcular_ndvi(entradas.s2))
+            fpar = medir("calcular_fpar", lambda: calcular_fpar(ndvi))
+            del ndvi
+            wsc = medir(
+                "calculate_WSC_from_tif", lambda: calculate_WSC_from_tif(entradas.s2)
+            )
+            T1, t2 = medir(
+                "calcular_T1_T2",
+                lambda: calcular_T1_T2(str(entradas.lst_dia), str(entradas.lst_noite)),
+                n_s3,
+            )
+            ghi = recortar_ghi(trabalho, entradas.ghi, entradas.wkt)
+            sol = medir(
+                "calcular_sol",
+                lambda: calcular_sol(
+                    trabalho, None, MES, ANO, VAR_PCT_MES, 3.6, 1.0, ghi_recortado=ghi
+                ),
+                ghi.dados.size,
+            )
+            emax = medir(
+                "calcular_emax",
+                lambda: calcular_emax(
+                    entradas.worldcover, None, grelha=entradas.grelha
+                ),
+            )
+            camadas = {"FPAR": fpar, "T2": t2, "WSC": wsc, "SOL": sol, "E_max": emax}
+            npp = medir(
+                "calcular_npp",
+                lambda: calcular_npp(
+                    trabalho, trabalho / "RESULT", camadas, T1, grelha=entradas.grelha
+                ),
+            )
+            del camadas, fpar, wsc, t2, sol, emax
+            medir(
+                "analisar_npp",
+                lambda: analisar_npp(
+                    npp,
+                    trabalho / "ANALISE",
+                    POPULACAO,
+                    EMISSOES_CO2_PER_CAPITA,
+                    mes=MES,
+                    ano_referencia=ANO,
+                ),
+            )
+            medir("pipeline", lambda: executar_pipeline_offline(entradas, trabalho))
+    finally:
+        instrumentacao.desativar()
+    return linhas
+
+
+def commit_atual() -> str:
+    """Commit git do código medido (None fora de um repositório)"""
+    try:
+        saida = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return saida.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def escrever_resultados(linhas: list, caminho: Path) -> Path:
+    """Escreve os resultados com o commit, a data e a máquina, para comparação"""
+    dados = {
+        "commit": commit_atual(),
+        "data": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "plataforma": instrumentacao.dados_plataforma(),
+        "resultados": linhas,
+    }
+    caminho = Path(caminho)
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(dados, f, indent=2)
+    logger.info(f"Resultados do benchmark salvos em: {caminho}")
+    return caminho
+
+
+def comparar_resultados(
+    anteriores: Path, linhas: list, tolerancia: float = 0.10
+) -> list:
+    """
+    Compara o débito com um ficheiro de resultados anterior
+
+    Retorna:
+    list: (tamanho, kernel, Mpixel/s antes, agora, razão) dos kernels mais
+        lentos do que antes por mais de tolerancia (ex.: 0.10 = 10%)
+    """
+    with open(anteriores, encoding="utf-8") as f:
+        dados = json.load(f)
+    antes = {(l["tamanho"], l["kernel"]): l for l in dados["resultados"]}
+    logger.info(f"Comparacao com {anteriores} (commit {dados.get('commit')})")
+
+    regressoes = []
+    for linha in linhas:
+        anterior = antes.get((linha["tamanho"], linha["kernel"]))
+        if not anterior or not anterior["mpixel_s"] or not linha["mpixel_s"]:
+            continue
+        razao = linha["mpixel_s"] / anterior["mpixel_s"]
+        logger.info(
+            f"{linha['tamanho']:>7} {linha['kernel']:<24} "
+            f"{anterior['mpixel_s']:>9.2f} -> {linha['mpixel_s']:>9.2f} Mpixel/s "
+            f"({anterior.get('backend', 'numpy')} -> {linha['backend']}) "
+            f"(x{razao:.2f}), pico {anterior['rss_pico_mb']} -> "
+            f"{linha['rss_pico_mb']} MB"
+        )
+        if razao < 1 - tolerancia:
+            regressoes.append(
+                (
+                    linha["tamanho"],
+                    linha["kernel"],
+                    anterior["mpixel_s"],
+                    linha["mpixel_s"],
+                    razao,
+                )
+            )
+    for tamanho, kernel, *_, razao in regressoes:
+        logger.warning(f"Regressao: {kernel} ({tamanho}) a x{razao:.2f} do anterior")
+    return regressoes
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    # Só as mensagens do benchmark (não as de cada kernel)
+    logging.getLogger("parametros").setLevel(logging.WARNING)
+    projeto_dir = Path(__file__).parent.resolve()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark offline dos cálculos de parametros (rasters sintéticos)"
+    )
+    parser.add_argument(
+        "--tamanhos",
+        nargs="+",
+        choices=list(TAMANHOS),
+        default=["oeiras", "medio"],
+        help="tamanhos a medir (grande: ~100 Mpixel, precisa de vários GB de RAM)",
+    )
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument(
+        "--backend",
+        choices=("auto",) + kernels.BACKENDS,
+        default="auto",
+        help="backend dos kernels por pixel (ver python -m parametros.kernels)",
+    )
+    parser.add_argument(
+        "--diretoria",
+        type=Path,
+        default=projeto_dir / "CACHE" / "benchmark",
+        help="onde ficam as entradas sintéticas (reutilizadas) e as saídas",
+    )
+    parser.add_argument(
+        "--saida",
+        type=Path,
+        help="ficheiro JSON de resultados (por omissão BENCHMARKS/<commit>.json)",
+    )
+    parser.add_argument("--comparar", type=Path, help="resultados anteriores (JSON)")
+    parser.add_argument(
+        "--tolerancia",
+        type=float,
+        default=0.10,
+        help="perda de débito aceite na comparação (0.10 = 10%%)",
+    )
+    args = parser.parse_args()
+
+    kernels.definir_backend(args.backend)
+    linhas = executar_benchmark(args.tamanhos, args.diretoria, args.repeticoes)
+    saida = (
+        args.saida
+        or projeto_dir
+        / "BENCHMARKS"
+        / f"{commit_atual() or time.strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    escrever_resultados(linhas, saida)
+    if args.comparar and comparar_resultados(args.comparar, linhas, args.tolerancia):
+        sys.exit(1)
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+from indice_cache import IndiceCache, argumentos_cli, linha_entrada
+from parametros.raster_io import GrelhaAlvo, RasterMemoria
+
+logger = logging.getLogger(__name__)
+
+# Diretoria por omissão da cache de camadas estáticas
+DIRETORIA_CACHE_CAMADAS = Path(__file__).parent.resolve() / "CACHE" / "camadas"
+
+# Checksums já calculados neste processo: (caminho, tamanho, mtime) -> sha256
+_checksums = {}
+_checksums_lock = threading.Lock()
+
+
+def checksum_ficheiro(caminho: Path) -> str:
+    """
+    SHA-256 do conteúdo de um ficheiro
+
+    O resultado é memorizado por (caminho, tamanho, data de modificação), pelo
+    que um ficheiro só volta a ser lido se for alterado.
+    """
+    caminho = Path(caminho).resolve()
+    estado = caminho.stat()
+    identidade = (str(caminho), estado.st_size, estado.st_mtime_ns)
+    with _checksums_lock:
+        if identidade in _checksums:
+            return _checksums[identidade]
+
+    sha = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(bloco)
+
+    with _checksums_lock:
+        _checksums[identidade] = sha.hexdigest()
+    return _checksums[identidade]
+
+
+def descrever_grelha(grelha: GrelhaAlvo) -> dict:
+    """Especificação serializável (JSON) de uma grelha, para chaves e índice"""
+    if grelha is None:
+        return None
+    return {
+        "crs": CRS.from_user_input(grelha.crs).to_wkt(),
+        "transform": list(grelha.transform)[:6],
+        "largura": grelha.largura,
+        "altura": grelha.altura,
+    }
+
+
+class CacheCamadas:
+    """
+    Cache em disco de camadas estáticas já alinhadas (E_max, GHI recortado, ...)
+
+    Cada entrada é identificada pelo hash de: nome da camada, região, grelha
+    alvo, checksum dos ficheiros de origem e parâmetros (ex.: tabela epsilon).
+    Alterar um ficheiro de origem muda a chave, pelo que a entrada antiga
+    deixa de ser usada; é removida quando a nova (mesma camada, região, grelha
+    e parâmetros) é guardada. Os dados ficam em .npy e são abertos em
+    memory-map, prontos a usar sem voltar a reprojetar. O índice é
+    partilhado entre processos (ver IndiceCache).
+    """
+
+    def __init__(self, diretoria: Path = DIRETORIA_CACHE_CAMADAS):
+        self.diretoria = Path(diretoria)
+        self._indice = IndiceCache(self.diretoria)
+
+    def chave(
+        self,
+        camada: str,
+        regiao: str,
+        grelha: GrelhaAlvo = None,
+        fontes: list = (),
+        **parametros,
+    ) -> tuple:
+        """
+        Calcula a chave de uma camada
+
+        Retorna:
+        tuple: (chave SHA-256, identidade) - a identidade é a chave sem os
+        checksums, usada para invalidar versões antigas da mesma camada
+        """
+        identidade = {
+            "camada": camada,
+            "regiao": regiao,
+            "grelha": descrever_grelha(grelha),
+            "parametros": parametros,
+        }
+        conteudo = dict(
+            identidade, fontes=[checksum_ficheiro(fonte) for fonte in fontes]
+        )
+        return _hash(conteudo), _hash(identidade)
+
+    def obter(self, chave: tuple):
+        """
+        Procura uma camada na cache
+
+        Retorna:
+        RasterMemoria: Camada em cache (dados em memory-map), ou None
+        """
+        chave_conteudo, _ = chave
+        with self._indice.alterar() as indice:
+            entrada = indice.get(chave_conteudo)
+            if entrada is None:
+                return None
+
+            caminho = self.diretoria / entrada["ficheiro"]
+            if not caminho.exists():
+                del indice[chave_conteudo]
+                return None
+
+            entrada["ultimo_acesso"] = time.time()
+
+        logger.info(
+            f"Cache de camadas: {entrada['camada']} ({entrada['regiao']}) encontrada"
+        )
+        return RasterMemoria(
+            np.load(caminho, mmap_mode="r"), perfil_de_json(entrada["perfil"])
+        )
+
+    def guardar(
+        self, chave: tuple, camada: str, regiao: str, raster: RasterMemoria
+    ) -> Path:
+        """
+        Guarda uma camada e remove as versões anteriores (fontes alteradas)
+
+        Retorna:
+        Path: .npy da camada guardada
+        """
+        chave_conteudo, identidade = chave
+        self.diretoria.mkdir(parents=True, exist_ok=True)
+        destino = self.diretoria / f"{chave_conteudo}.npy"
+
+        temporario = destino.with_suffix(
+            f".{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        )
+        np.save(temporario, np.asarray(raster.dados))
+        os.replace(temporario, destino)
+
+        with self._indice.alterar() as indice:
+            for antiga, entrada in list(indice.items()):
+                if entrada["identidade"] == identidade and antiga != chave_conteudo:
+                    (self.diretoria / entrada["ficheiro"]).unlink(missing_ok=True)
+                    del indice[antiga]
+                    logger.info(
+                        f"Cache de camadas: {camada} ({regiao}) invalidada "
+                        "(ficheiro de origem alterado)"
+                    )
+            agora = time.time()
+            indice[chave_conteudo] = {
+                "ficheiro": destino.name,
+                "identidade": identidade,
+                "camada": camada,
+                "regiao": regiao,
+                "tamanho": destino.stat().st_size,
+                "criado": agora,
+                "ultimo_acesso": agora,
+                "perfil": perfil_para_json(raster.perfil),
+            }
+
+        logger.info(f"Cache de camadas: {camada} ({regiao}) guardada")
+        return destino
+
+    def obter_ou_calcular(
+        self,
+        camada: str,
+        regiao: str,
+        calcular,
+        grelha: GrelhaAlvo = None,
+        fontes: list = (),
+        **parametros,
+    ) -> RasterMemoria:
+        """
+        Devolve a camada em cache ou calcula-a com calcular() e guarda-a
+
+        Em ambos os casos os dados vêm do .npy da cache, em memory-map (o
+        manifesto de etapas guarda só a referência a esse ficheiro).
+        """
+        chave = self.chave(camada, regiao, grelha, fontes, **parametros)
+        raster = self.obter(chave)
+        if raster is None:
+            raster = calcular()
+            destino = self.guardar(chave, camada, regiao, raster)
+            raster = raster._replace(dados=np.load(destino, mmap_mode="r"))
+        return raster
+
+    def entradas(self) -> list:
+        """Lista as entradas da cache, da usada mais recentemente para a mais antiga"""
+        return self._indice.entradas()
+
+    def limpar(self) -> int:
+        """Remove todas as camadas em cache e devolve o número de entradas removidas"""
+        removidas = self._indice.limpar()
+        logger.info(f"Cache de camadas limpa ({removidas} entradas)")
+        return removidas
+
+
+def _hash(conteudo: dict) -> str:
+    texto = json.dumps(conteudo, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+def perfil_para_json(perfil: dict) -> dict:
+    """Converte um perfil rasterio (CRS, Affine) num dict serializável"""
+    serializavel = {}
+    for nome, valor in perfil.items():
+        if nome == "crs" and valor is not None:
+            valor = CRS.from_user_input(valor).to_wkt()
+        elif nome == "transform":
+            valor = list(valor)[:6]
+        elif isinstance(valor, np.generic):
+            valor = valor.item()
+        serializavel[nome] = valor
+    return serializavel
+
+
+def perfil_de_json(serializavel: dict) -> dict:
+    """Reconstrói um perfil rasterio a partir de perfil_para_json"""
+    perfil = dict(serializavel)
+    if perfil.get("crs") is not None:
+        perfil["crs"] = CRS.from_wkt(perfil["crs"])
+    if perfil.get("transform") is not None:
+        perfil["transform"] = Affine(*perfil["transform"])
+    return perfil
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def obter_cache_camadas() -> CacheCamadas:
+    """Devolve a cache de camadas do processo (criada na primeira utilização)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CacheCamadas()
+        return _cache
+
+
+def definir_cache_camadas(cache: CacheCamadas):
+    """Substitui a cache de camadas do processo (ex.: outra diretoria)"""
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+if __name__ == "__main__":
+    parser = argumentos_cli(
+        "Inspecionar/limpar a cache de camadas estáticas", DIRETORIA_CACHE_CAMADAS
+    )
+    args = parser.parse_args()
+
+    cache = CacheCamadas(args.diretoria)
+    if args.limpar:
+        print(f"Entradas removidas: {cache.limpar()}")
+    else:
+        for entrada in cache.entradas():
+            print(linha_entrada(entrada, f"{entrada['camada']} {entrada['regiao']}"))
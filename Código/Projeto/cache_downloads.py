@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from indice_cache import IndiceCache, argumentos_cli, linha_entrada
+
+logger = logging.getLogger(__name__)
+
+# Diretoria e tamanho máximo por omissão da cache de downloads
+DIRETORIA_CACHE = Path(__file__).parent.resolve() / "CACHE" / "downloads"
+TAMANHO_MAX_CACHE = 5 * 1024**3  # 5 GB
+
+
+class CacheDownloads:
+    """
+    Cache local, endereçada por conteúdo, dos GeoTIFF devolvidos pelo openEO
+
+    Cada entrada é identificada pelo hash SHA-256 dos parâmetros do pedido
+    (coleção, bandas, nuvens, intervalo, dia/noite) e da geometria. Quando o
+    tamanho total ultrapassa tamanho_max_bytes, as entradas usadas há mais
+    tempo são removidas (LRU). O índice é partilhado entre processos (ver
+    IndiceCache).
+    """
+
+    def __init__(
+        self, diretoria: Path = DIRETORIA_CACHE, tamanho_max_bytes=TAMANHO_MAX_CACHE
+    ):
+        self.diretoria = Path(diretoria)
+        self.tamanho_max_bytes = tamanho_max_bytes
+        self._indice = IndiceCache(self.diretoria)
+
+    @staticmethod
+    def chave(**parametros) -> str:
+        """Calcula a chave (hash SHA-256) de um conjunto de parâmetros serializáveis em JSON"""
+        texto = json.dumps(parametros, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+    def obter(self, chave: str):
+        """
+        Procura uma entrada na cache
+
+        Retorna:
+        Path: Caminho do GeoTIFF em cache, ou None se não existir
+        """
+        with self._indice.alterar() as indice:
+            entrada = indice.get(chave)
+            if entrada is None:
+                return None
+
+            caminho = self.diretoria / entrada["ficheiro"]
+            if not caminho.exists():
+                # Ficheiro removido à mão: descartar a entrada
+                del indice[chave]
+                return None
+
+            entrada["ultimo_acesso"] = time.time()
+
+        logger.info(f"Cache de downloads: entrada encontrada ({chave[:12]})")
+        return caminho
+
+    def guardar(
+        self, chave: str, caminho_origem: Path, parametros: dict = None
+    ) -> Path:
+        """Copia um GeoTIFF descarregado para a cache e aplica a política LRU"""
+        caminho_origem = Path(caminho_origem)
+        self.diretoria.mkdir(parents=True, exist_ok=True)
+        destino = self.diretoria / f"{chave}.tif"
+
+        # Cópia para ficheiro temporário + rename, para nunca expor um ficheiro parcial
+        temporario = destino.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copyfile(caminho_origem, temporario)
+        os.replace(temporario, destino)
+
+        with self._indice.alterar() as indice:
+            agora = time.time()
+            indice[chave] = {
+                "ficheiro": destino.name,
+                "tamanho": destino.stat().st_size,
+                "criado": agora,
+                "ultimo_acesso": agora,
+                "parametros": parametros or {},
+            }
+            self._evictar(indice, manter=chave)
+
+        logger.info(f"Cache de downloads: entrada guardada ({chave[:12]})")
+        return destino
+
+    def entradas(self) -> list:
+        """Lista as entradas da cache, da usada mais recentemente para a mais antiga"""
+        return self._indice.entradas()
+
+    def tamanho_total(self) -> int:
+        """Tamanho total (bytes) das entradas em cache"""
+        return sum(entrada["tamanho"] for entrada in self.entradas())
+
+    def remover(self, chave: str) -> bool:
+        """Remove uma entrada da cache"""
+        with self._indice.alterar() as indice:
+            entrada = indice.pop(chave, None)
+            if entrada is None:
+                return False
+            (self.diretoria / entrada["ficheiro"]).unlink(missing_ok=True)
+        return True
+
+    def limpar(self) -> int:
+        """Remove todas as entradas da cache e devolve o número de entradas removidas"""
+        removidas = self._indice.limpar()
+        logger.info(f"Cache de downloads limpa ({removidas} entradas)")
+        return removidas
+
+    def _evictar(self, indice: dict, manter: str = None):
+        """Remove as entradas menos usadas até respeitar tamanho_max_bytes"""
+        total = sum(entrada["tamanho"] for entrada in indice.values())
+        por_acesso = sorted(indice.items(), key=lambda item: item[1]["ultimo_acesso"])
+        for chave, entrada in por_acesso:
+            if total <= self.tamanho_max_bytes:
+                break
+            if chave == manter:
+                continue
+            (self.diretoria / entrada["ficheiro"]).unlink(missing_ok=True)
+            del indice[chave]
+            total -= entrada["tamanho"]
+            logger.info(f"Cache de downloads: entrada removida por LRU ({chave[:12]})")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def obter_cache() -> CacheDownloads:
+    """Devolve a cache de downloads do processo (criada na primeira utilização)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CacheDownloads()
+        return _cache
+
+
+def definir_cache(cache: CacheDownloads):
+    """Substitui a cache de downloads do processo (ex.: outra diretoria ou limite)"""
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+if __name__ == "__main__":
+    parser = argumentos_cli("Inspecionar/limpar a cache de downloads", DIRETORIA_CACHE)
+    parser.add_argument("--remover", metavar="CHAVE", help="remove uma entrada")
+    args = parser.parse_args()
+
+    cache = CacheDownloads(args.diretoria)
+    if args.limpar:
+        print(f"Entradas removidas: {cache.limpar()}")
+    elif args.remover:
+        print("Removida" if cache.remover(args.remover) else "Chave nao encontrada")
+    else:
+        for entrada in cache.entradas():
+            parametros = entrada["parametros"]
+            print(
+                linha_entrada(
+                    entrada,
+                    f"{parametros.get('colecao', '')} {parametros.get('intervalo', '')} "
+                    f"{parametros.get('dia_noite', '')}",
+                )
+            )
+        print(f"Total: {cache.tamanho_total() / 1024**2:.1f} MB")
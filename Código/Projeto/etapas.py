@@ -0,0 +1,439 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import numpy as np
+import rasterio
+from rasterio.errors import RasterioIOError
+
+from cache_camadas import checksum_ficheiro, perfil_de_json, perfil_para_json
+from parametros.instrumentacao import ativa, contar_pixeis, medir
+from parametros.raster_io import GrelhaAlvo, RasterMemoria, guardar_raster
+
+logger = logging.getLogger(__name__)
+
+
+class FalhaEtapa(Exception):
+    """Falha de uma etapa do processamento (substitui o antigo sys.exit(1))"""
+
+    def __init__(self, etapa: str, causa: Exception):
+        super().__init__(f"FALHA na etapa '{etapa}': {causa}")
+        self.etapa = etapa
+        self.causa = causa
+
+
+class ExecucaoCancelada(Exception):
+    """Execução cancelada entre etapas (as etapas concluídas ficam no manifesto)"""
+
+    def __init__(self, etapa: str):
+        super().__init__(f"Cancelado antes da etapa '{etapa}'")
+        self.etapa = etapa
+
+
+class Etapa(NamedTuple):
+    """
+    Etapa do processamento de um mês
+
+    executar recebe {dependência: saídas da dependência} e devolve um dict de
+    saídas: RasterMemoria, GrelhaAlvo, caminhos (Path) de ficheiros
+    produzidos ou valores serializáveis em JSON. parametros e fontes
+    (ficheiros de entrada, por checksum) entram na assinatura da etapa, tal
+    como as assinaturas das dependências.
+
+    persistir=False para etapas baratas com saídas grandes (ex.: recorte):
+    só a assinatura fica no manifesto e, numa retoma, a etapa é recalculada
+    sempre que uma etapa que dela depende tiver de correr, mesmo que as suas
+    entradas não tenham mudado.
+    """
+
+    nome: str
+    executar: Callable
+    dependencias: tuple = ()
+    parametros: dict = {}
+    fontes: tuple = ()
+    persistir: bool = True
+
+
+def ordenar_etapas(etapas: list) -> list:
+    """Ordena as etapas de modo a que cada uma venha depois das suas dependências"""
+    por_nome = {etapa.nome: etapa for etapa in etapas}
+    for etapa in etapas:
+        for dependencia in etapa.dependencias:
+            if dependencia not in por_nome:
+                raise ValueError(
+                    f"Etapa '{etapa.nome}' depende de '{dependencia}', que nao existe"
+                )
+
+    ordenadas = []
+    pendentes = list(etapas)
+    while pendentes:
+        prontas = [
+            etapa
+            for etapa in pendentes
+            if all(d in {e.nome for e in ordenadas} for d in etapa.dependencias)
+        ]
+        if not prontas:
+            ciclo = ", ".join(etapa.nome for etapa in pendentes)
+            raise ValueError(f"Dependencias circulares entre as etapas: {ciclo}")
+        ordenadas.extend(prontas)
+        pendentes = [etapa for etapa in pendentes if etapa not in prontas]
+    return ordenadas
+
+
+def executar_etapas(
+    etapas: list,
+    diretoria: Path = None,
+    refazer: bool = False,
+    progresso: Callable = None,
+    cancelamento=None,
+) -> dict:
+    """
+    Executa as etapas pela ordem das dependências
+
+    Com diretoria, cada etapa concluída fica registada no manifesto
+    (diretoria/manifesto.json) com a sua assinatura - hash dos parâmetros,
+    dos checksums das fontes e das assinaturas das dependências - e, se a
+    etapa for persistida, as suas saídas (rasters em GeoTIFF da classe
+    intermedio, ou referência ao .npy de onde já estão em memory-map, ex.:
+    cache de camadas; ficheiros por checksum). Numa nova execução, as etapas
+    com a mesma assinatura e saídas intactas não são repetidas; a execução
+    retoma na primeira etapa que falhou ou cujas entradas (ou saídas
+    guardadas) mudaram, e todas as que dependem dela são recalculadas. As etapas não persistidas com a mesma
+    assinatura só são recalculadas quando uma etapa que delas depende tem de
+    correr (e não contam como refeitas). Com refazer=True todas as etapas
+    correm (e são registadas); sem diretoria correm sempre e as saídas ficam
+    só em memória.
+
+    progresso: chamada como progresso(etapa, concluidas, total, estado) com
+    estado "a correr" antes de cada etapa e "concluida" ou "reutilizada"
+    depois. cancelamento: threading.Event (ou semelhante, com is_set)
+    verificado antes de cada etapa; a etapa em curso termina sempre.
+
+    Retorna:
+    dict: {etapa: saídas} (sem as etapas não persistidas que não foi preciso
+    recalcular)
+
+    Lança:
+    FalhaEtapa: na primeira etapa que falhar (registada no manifesto)
+    ExecucaoCancelada: se cancelamento for ativado (nada é registado como falha)
+    """
+    manifesto = _Manifesto(diretoria) if diretoria is not None else None
+    saidas = {}
+    assinaturas = {}
+    executadas = set()
+    # Etapas não persistidas reutilizadas, recalculadas só se forem precisas
+    adiadas = {}
+
+    def entradas_de(etapa: Etapa) -> dict:
+        entradas = {}
+        for dependencia in etapa.dependencias:
+            if dependencia in adiadas:
+                adiada = adiadas.pop(dependencia)
+                logger.info(f"Etapa {dependencia}: recalculada (saidas nao guardadas)")
+                saidas[dependencia] = _correr(
+                    adiada, entradas_de(adiada), assinaturas[dependencia], manifesto
+                )
+            entradas[dependencia] = saidas[dependencia]
+        return entradas
+
+    ordenadas = ordenar_etapas(etapas)
+    for concluidas, etapa in enumerate(ordenadas):
+        if cancelamento is not None and cancelamento.is_set():
+            logger.info(f"Execucao cancelada antes da etapa {etapa.nome}")
+            raise ExecucaoCancelada(etapa.nome)
+
+        try:
+            assinaturas[etapa.nome] = _assinatura(etapa, assinaturas)
+        except Exception as e:
+            logger.error(f"FALHA na etapa {etapa.nome}: {e}")
+            raise FalhaEtapa(etapa.nome, e) from e
+
+        # Uma etapa só é reutilizada se nenhuma dependência tiver sido refeita
+        if (
+            manifesto is not None
+            and not refazer
+            and not executadas.intersection(etapa.dependencias)
+        ):
+            if not etapa.persistir:
+                guardadas = manifesto.concluida(etapa.nome, assinaturas[etapa.nome])
+            else:
+                guardadas = manifesto.obter(etapa.nome, assinaturas[etapa.nome])
+            if guardadas is not None:
+                logger.info(f"Etapa {etapa.nome}: entradas inalteradas, reutilizada")
+                if etapa.persistir:
+                    saidas[etapa.nome] = guardadas
+                else:
+                    adiadas[etapa.nome] = etapa
+                if progresso is not None:
+                    progresso(etapa.nome, concluidas + 1, len(ordenadas), "reutilizada")
+                continue
+
+        logger.info(f"--- Etapa {etapa.nome} ---")
+        if progresso is not None:
+            progresso(etapa.nome, concluidas, len(ordenadas), "a correr")
+        saidas[etapa.nome] = _correr(
+            etapa, entradas_de(etapa), assinaturas[etapa.nome], manifesto
+        )
+        executadas.add(etapa.nome)
+        if progresso is not None:
+            progresso(etapa.nome, concluidas + 1, len(ordenadas), "concluida")
+
+    return saidas
+
+
+def _correr(etapa: Etapa, entradas: dict, assinatura: str, manifesto) -> dict:
+    """Executa uma etapa e regista-a (ou a sua falha) no manifesto"""
+    inicio = time.perf_counter()
+    try:
+        with medir(f"etapa {etapa.nome}") as registo:
+            saidas = etapa.executar(entradas)
+            if ativa():
+                registo["pixeis"] = contar_pixeis(saidas)
+    except Exception as e:
+        logger.error(f"FALHA na etapa {etapa.nome}: {e}")
+        if manifesto is not None:
+            manifesto.registar_falha(etapa.nome, assinatura, e)
+        raise FalhaEtapa(etapa.nome, e) from e
+
+    if manifesto is not None:
+        manifesto.registar(
+            etapa.nome,
+            assinatura,
+            saidas if etapa.persistir else None,
+            time.perf_counter() - inicio,
+        )
+    return saidas
+
+
+def _assinatura(etapa: Etapa, assinaturas: dict) -> str:
+    conteudo = {
+        "etapa": etapa.nome,
+        "parametros": etapa.parametros,
+        "fontes": [checksum_ficheiro(fonte) for fonte in etapa.fontes],
+        "dependencias": {d: assinaturas[d] for d in etapa.dependencias},
+    }
+    texto = json.dumps(conteudo, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+class _Manifesto:
+    """Manifesto das etapas de uma diretoria de trabalho e respetivas saídas"""
+
+    def __init__(self, diretoria: Path):
+        self.diretoria = Path(diretoria)
+        self.caminho = self.diretoria / "manifesto.json"
+        if self.caminho.exists():
+            try:
+                with open(self.caminho, encoding="utf-8") as f:
+                    self.etapas = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"Manifesto ilegivel, a recomeçar: {self.caminho}")
+                self.etapas = {}
+        else:
+            self.etapas = {}
+
+    def concluida(self, etapa: str, assinatura: str) -> dict:
+        """Registo da etapa se estiver concluída com esta assinatura, ou None"""
+        registo = self.etapas.get(etapa)
+        if (
+            registo is None
+            or registo.get("estado") != "concluida"
+            or registo.get("assinatura") != assinatura
+        ):
+            return None
+        return registo
+
+    def obter(self, etapa: str, assinatura: str) -> dict:
+        """Saídas guardadas da etapa, ou None se estiver por fazer ou desatualizada"""
+        registo = self.concluida(etapa, assinatura)
+        if registo is None or registo.get("saidas") is None:
+            return None
+
+        saidas = {}
+        for nome, saida in registo["saidas"].items():
+            valor = self._ler_saida(saida)
+            if valor is _INVALIDA:
+                logger.info(f"Etapa {etapa}: saida '{nome}' alterada ou em falta")
+                return None
+            saidas[nome] = valor
+        return saidas
+
+    def registar(self, etapa: str, assinatura: str, saidas: dict, duracao: float):
+        """Regista uma etapa concluída (saidas=None: etapa não persistida)"""
+        anterior = self.etapas.get(etapa, {})
+        self.etapas[etapa] = {
+            "estado": "concluida",
+            "assinatura": assinatura,
+            "duracao_s": round(duracao, 3),
+            "concluida_em": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "saidas": (
+                None
+                if saidas is None
+                else {
+                    nome: self._guardar_saida(etapa, nome, valor)
+                    for nome, valor in saidas.items()
+                }
+            ),
+        }
+        self._escrever()
+        self._remover_rasters(anterior, manter=self.etapas[etapa])
+
+    def _remover_rasters(self, registo: dict, manter: dict):
+        """Remove os rasters de um registo antigo (os ainda abertos ficam para depois)"""
+        em_uso = {s.get("ficheiro") for s in (manter.get("saidas") or {}).values()}
+        for saida in (registo.get("saidas") or {}).values():
+            if saida["tipo"] == "raster" and saida["ficheiro"] not in em_uso:
+                try:
+                    (self.diretoria / saida["ficheiro"]).unlink(missing_ok=True)
+                except OSError:
+                    pass
+
+    def registar_falha(self, etapa: str, assinatura: str, erro: Exception):
+        anterior = self.etapas.get(etapa, {})
+        self.etapas[etapa] = {
+            "estado": "falhou",
+            "assinatura": assinatura,
+            "erro": repr(erro),
+            "falhou_em": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self._escrever()
+        self._remover_rasters(anterior, manter={})
+
+    def _guardar_saida(self, etapa: str, nome: str, valor) -> dict:
+        if isinstance(valor, RasterMemoria) and _npy_de_origem(valor.dados):
+            # Já está num .npy (ex.: cache de camadas): guarda só a referência
+            caminho = _npy_de_origem(valor.dados)
+            estado = caminho.stat()
+            return {
+                "tipo": "raster_externo",
+                "caminho": str(caminho),
+                "tamanho": estado.st_size,
+                "mtime_ns": estado.st_mtime_ns,
+                "perfil": perfil_para_json(valor.perfil),
+                "descricoes": list(valor.descricoes) if valor.descricoes else None,
+                "tags": valor.tags,
+            }
+        if isinstance(valor, RasterMemoria):
+            # GeoTIFF intermedio (ZSTD rápido); nome único: uma versão antiga
+            # ainda aberta não impede a escrita da nova (o manifesto só aponta
+            # para esta depois)
+            ficheiro = f"{etapa}__{nome}__{os.getpid()}_{time.time_ns()}.tif"
+            self.diretoria.mkdir(parents=True, exist_ok=True)
+            dados = np.asarray(valor.dados)
+            guardar_raster(
+                self.diretoria / ficheiro,
+                dados,
+                valor.perfil,
+                "intermedio",
+                descricoes=valor.descricoes,
+                tags=valor.tags,
+                dtype=dados.dtype.name,
+                height=dados.shape[-2],
+                width=dados.shape[-1],
+            )
+            return {
+                "tipo": "raster",
+                "ficheiro": ficheiro,
+                "bandas": dados.shape[0] if dados.ndim == 3 else None,
+                "perfil": perfil_para_json(valor.perfil),
+                "descricoes": list(valor.descricoes) if valor.descricoes else None,
+                "tags": valor.tags,
+            }
+        if isinstance(valor, GrelhaAlvo):
+            return {
+                "tipo": "grelha",
+                "perfil": perfil_para_json(
+                    {"crs": valor.crs, "transform": valor.transform}
+                ),
+                "largura": valor.largura,
+                "altura": valor.altura,
+            }
+        if isinstance(valor, Path):
+            estado = valor.stat()
+            return {
+                "tipo": "ficheiro",
+                "caminho": str(valor),
+                "tamanho": estado.st_size,
+                "mtime_ns": estado.st_mtime_ns,
+                "sha256": checksum_ficheiro(valor),
+            }
+        return {"tipo": "valor", "valor": valor}
+
+    def _ler_saida(self, saida: dict):
+        if saida["tipo"] == "grelha":
+            perfil = perfil_de_json(saida["perfil"])
+            return GrelhaAlvo(
+                perfil["crs"], perfil["transform"], saida["largura"], saida["altura"]
+            )
+        if saida["tipo"] in ("raster", "raster_externo"):
+            if saida["tipo"] == "raster":
+                caminho = self.diretoria / saida["ficheiro"]
+                try:
+                    with rasterio.open(caminho) as src:
+                        dados = src.read() if saida["bandas"] else src.read(1)
+                except RasterioIOError:
+                    return _INVALIDA
+            else:
+                # O .npy pode ter sido removido ou substituído pelo seu dono
+                caminho = Path(saida["caminho"])
+                if not caminho.exists():
+                    return _INVALIDA
+                estado = caminho.stat()
+                if (estado.st_size, estado.st_mtime_ns) != (
+                    saida["tamanho"],
+                    saida["mtime_ns"],
+                ):
+                    return _INVALIDA
+                dados = np.load(caminho, mmap_mode="r")
+            return RasterMemoria(
+                dados,
+                perfil_de_json(saida["perfil"]),
+                tuple(saida["descricoes"]) if saida["descricoes"] else None,
+                saida["tags"],
+            )
+        if saida["tipo"] == "ficheiro":
+            caminho = Path(saida["caminho"])
+            if not caminho.exists():
+                return _INVALIDA
+            estado = caminho.stat()
+            inalterado = (estado.st_size, estado.st_mtime_ns) == (
+                saida["tamanho"],
+                saida["mtime_ns"],
+            )
+            if not inalterado and checksum_ficheiro(caminho) != saida["sha256"]:
+                return _INVALIDA
+            return caminho
+        return saida["valor"]
+
+    def _escrever(self):
+        self.diretoria.mkdir(parents=True, exist_ok=True)
+        temporario = self.caminho.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(self.etapas, f, indent=2, default=str)
+        os.replace(temporario, self.caminho)
+
+
+def _npy_de_origem(dados: np.ndarray) -> Path:
+    """
+    .npy aberto em memory-map de onde vêm todos os dados do array, ou None
+    (arrays em memória ou só parte de um ficheiro)
+    """
+    if not isinstance(dados, np.memmap) or not dados.filename:
+        return None
+    caminho = Path(dados.filename)
+    if (
+        caminho.suffix != ".npy"
+        or not dados.flags.c_contiguous
+        or not caminho.exists()
+        or caminho.stat().st_size != dados.offset + dados.nbytes
+    ):
+        return None
+    return caminho
+
+
+# Marca de uma saída guardada que já não pode ser reutilizada
+_INVALIDA = object()
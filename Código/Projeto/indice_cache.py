@@ -0,0 +1,126 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+logger = logging.getLogger(__name__)
+
+
+class IndiceCache:
+    """
+    Índice JSON (chave -> entrada) de uma cache em disco
+
+    O índice é partilhado pelas threads de um processo e pelos processos de
+    trabalho (ex.: meses em paralelo em executar_intervalo): cada
+    leitura-alteração-escrita é feita com um lock de threads e um lock de
+    ficheiro (indice.json.lock), pelo que as alterações de um processo não
+    apagam as de outro. A escrita é atómica (temporário + rename), pelo que
+    uma leitura sem lock vê sempre um índice completo.
+    """
+
+    def __init__(self, diretoria: Path, nome: str = "indice.json"):
+        self.diretoria = Path(diretoria)
+        self.caminho = self.diretoria / nome
+        self._lock_path = self.diretoria / f"{nome}.lock"
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def alterar(self):
+        """
+        Bloqueia o índice e devolve-o para ser lido ou alterado; as alterações
+        são escritas à saída do bloco (se não houver erro)
+        """
+        with self._lock, _bloquear_ficheiro(self._lock_path):
+            indice = self.ler()
+            antes = json.dumps(indice, sort_keys=True)
+            yield indice
+            if json.dumps(indice, sort_keys=True) != antes:
+                self._escrever(indice)
+
+    def ler(self) -> dict:
+        if not self.caminho.exists():
+            return {}
+        try:
+            with open(self.caminho, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Indice da cache ilegivel, a recomeçar: {self.caminho}")
+            return {}
+
+    def entradas(self) -> list:
+        """Lista as entradas, da usada mais recentemente para a mais antiga"""
+        lista = [dict(entrada, chave=chave) for chave, entrada in self.ler().items()]
+        return sorted(lista, key=lambda e: e["ultimo_acesso"], reverse=True)
+
+    def limpar(self) -> int:
+        """Remove todas as entradas e os seus ficheiros; devolve quantas eram"""
+        with self.alterar() as indice:
+            removidas = len(indice)
+            for entrada in indice.values():
+                (self.diretoria / entrada["ficheiro"]).unlink(missing_ok=True)
+            indice.clear()
+        return removidas
+
+    def _escrever(self, indice: dict):
+        self.diretoria.mkdir(parents=True, exist_ok=True)
+        temporario = self.caminho.with_suffix(
+            f".{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(indice, f, indent=2)
+        os.replace(temporario, self.caminho)
+
+
+def argumentos_cli(descricao: str, diretoria: Path) -> argparse.ArgumentParser:
+    """Argumentos comuns da linha de comandos das caches (--diretoria, --limpar)"""
+    parser = argparse.ArgumentParser(description=descricao)
+    parser.add_argument("--diretoria", type=Path, default=diretoria)
+    parser.add_argument(
+        "--limpar", action="store_true", help="remove todas as entradas"
+    )
+    return parser
+
+
+def linha_entrada(entrada: dict, descricao: str) -> str:
+    """Linha da listagem de uma entrada: chave, tamanho, último acesso e descrição"""
+    return (
+        f"{entrada['chave'][:12]}  {entrada['tamanho'] / 1024**2:8.1f} MB  "
+        f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entrada['ultimo_acesso']))}  "
+        f"{descricao}"
+    )
+
+
+@contextmanager
+def _bloquear_ficheiro(caminho: Path):
+    """Lock exclusivo entre processos sobre um ficheiro (fcntl ou msvcrt)"""
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    with open(caminho, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            # LK_LOCK desiste ao fim de ~10 s: tentar de novo até conseguir
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -1,154 +1,427 @@
-import tkinter as tk
-from tkinter import ttk
-from main import main
-import sys
-import os
-import threading
-from pathlib import Path
-import logging
-from PIL import Image, ImageTk
-
-logger = logging.getLogger(__name__)
-projeto_dir = Path(__file__).parent.resolve()
-
-
-# Redirecionamento de saída
-class TextRedirector:
-    def __init__(self, widget, tag="stdout"):
-        self.widget = widget
-        self.tag = tag
-
-    def write(self, string):
-        self.widget.configure(state="normal")
-        self.widget.insert(tk.END, string)
-        self.widget.see(tk.END)
-        self.widget.configure(state="disabled")
-
-    def flush(self):
-        pass
-
-
-# Função principal chamada com ano e mês
-def executar_main_com_data(ano, mes):
-    relatorio_path = projeto_dir / "RESULT" / "RELATORIO_NPP.txt"
-    try:
-        ano = int(ano)
-        mes = int(mes)
-        main(ano, mes)
-
-        # Mostrar relatório
-        if os.path.exists(relatorio_path):
-            with open(relatorio_path, "r", encoding="utf-8") as f:
-                conteudo = f.read()
-                terminal_output.configure(state="normal")
-                terminal_output.insert(
-                    tk.END,
-                    "\n\n--- Resultados guardados na pasta RESULT ---\n\n\n--- Conteúdo do RELATÓRIO_NPP.txt ---\n",
-                )
-                terminal_output.insert(tk.END, conteudo)
-                terminal_output.configure(state="disabled")
-        else:
-            terminal_output.insert(tk.END, "\nArquivo de relatório não encontrado.")
-    except ValueError:
-        terminal_output.insert(tk.END, "Erro: ano e mês devem ser números válidos.\n")
-
-
-def iniciar_processamento():
-    ano = ano_var.get()
-    mes = mes_var.get()
-    threading.Thread(target=executar_main_com_data, args=(ano, mes)).start()
-
-
-# Criação da Janela
-root = tk.Tk()
-root.title("Calculadora de Absorção de CO₂ - Oeiras, Lisboa, Portugal")
-root.configure(bg="white")
-root.geometry("1000x900")
-root.grid_columnconfigure(0, weight=3)
-root.grid_columnconfigure(1, weight=1)
-
-icon_path = projeto_dir / "img" / "image-logo.ico"
-root.iconbitmap(icon_path)
-
-# titulo
-titulo_label = tk.Label(
-    root,
-    text="Calculadora de Absorção de CO₂ - Oeiras, Lisboa, Portugal",
-    font=("Helvetica", 18, "bold"),
-    bg="white",
-)
-titulo_label.grid(row=0, column=0, columnspan=2, pady=(20, 10))
-
-# forms
-form_frame = tk.Frame(root, bg="white")
-form_frame.grid(row=1, column=0, sticky="nw", padx=20)
-
-# Ano
-ttk.Label(form_frame, text="Ano:").grid(
-    row=0, column=0, padx=(400, 10), pady=5, sticky="e"
-)
-ano_var = tk.StringVar()
-ano_box = ttk.Combobox(form_frame, textvariable=ano_var, values=["2024"], width=10)
-ano_box.grid(row=0, column=1, padx=5, pady=5, sticky="w")
-ano_box.current(0)
-
-# Mês
-ttk.Label(form_frame, text="Mês:").grid(
-    row=1, column=0, padx=(400, 10), pady=5, sticky="e"
-)
-mes_var = tk.StringVar()
-mes_box = ttk.Combobox(
-    form_frame, textvariable=mes_var, values=[str(i) for i in range(1, 13)], width=10
-)
-mes_box.grid(row=1, column=1, padx=5, pady=5, sticky="w")
-mes_box.current(0)
-
-# Botão
-ttk.Button(form_frame, text="Iniciar", command=iniciar_processamento).grid(
-    row=2, column=0, padx=(400, 10), columnspan=2, pady=10
-)
-
-# imagem isel
-try:
-    img_path = projeto_dir / "img" / "ISEL-Logotipo.png"
-    if img_path.exists():
-        imagem = Image.open(img_path)
-        imagem = imagem.resize((285, 108))
-        foto = ImageTk.PhotoImage(imagem)
-        label_imagem = tk.Label(root, image=foto, bg="white")
-        label_imagem.image = foto
-        label_imagem.grid(row=1, column=1, rowspan=5, padx=0, pady=25, sticky="ne")
-    else:
-        logger.warning(f"Imagem não encontrada em: {img_path}")
-except Exception as e:
-    print(f"Erro ao carregar imagem: {e}")
-
-# t34minal output
-output_frame = tk.Frame(root, bg="white")
-output_frame.grid(row=2, column=0, columnspan=2, padx=20, pady=0, sticky="nsew")
-
-# Scrollbar
-scrollbar = tk.Scrollbar(output_frame)
-scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-
-# Caixa de texto
-terminal_output = tk.Text(
-    output_frame,
-    height=44,
-    width=110,
-    bg="#f5f5f5",
-    fg="black",
-    wrap="word",
-    yscrollcommand=scrollbar.set,
-)
-terminal_output.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-terminal_output.configure(state="disabled")
-
-scrollbar.config(command=terminal_output.yview)
-
-# Redirecionar stdout e stderr
-sys.stdout = TextRedirector(terminal_output, "stdout")
-sys.stderr = TextRedirector(terminal_output, "stderr")
-
-# Iniciar loop
-root.mainloop()
+import time
+
+# Início do arranque (medido até a janela ficar interativa, ver --medir-arranque)
+INICIO_ARRANQUE = time.perf_counter()
+
+import tkinter as tk
+from tkinter import ttk
+import argparse
+import sys
+import queue
+import threading
+from pathlib import Path
+import logging
+from PIL import Image, ImageTk
+
+# Só módulos leves: main e as dependências geoespaciais são carregados numa
+# thread depois de a janela aparecer (trabalhos.precarregar) ou pelo primeiro
+# trabalho
+from regioes import REGIOES
+from trabalhos import (
+    CONCLUIDO,
+    FALHOU,
+    MAX_TRABALHOS,
+    GestorTrabalhos,
+    Trabalho,
+    precarregar,
+)
+
+logger = logging.getLogger(__name__)
+projeto_dir = Path(__file__).parent.resolve()
+
+# Tempo máximo (s) até a janela ficar interativa
+ORCAMENTO_ARRANQUE_S = 1.0
+# Módulos que não devem estar carregados quando a janela aparece
+MODULOS_PESADOS = ("main", "openeo", "geopandas", "rasterio", "shapely")
+# Espera (ms) depois de a janela aparecer antes de carregar os módulos de cálculo
+ATRASO_PRECARREGAR_MS = 200
+# Tamanho (pixeis) do logótipo na janela
+TAMANHO_LOGOTIPO = (285, 108)
+
+FORMATO_LOG = "[%(asctime)s] %(levelname)s: %(message)s"
+FORMATO_DATA = "%Y-%m-%d %H:%M:%S"
+
+
+# Intervalo (ms) entre atualizações da caixa de texto a partir da fila
+INTERVALO_ATUALIZACAO_MS = 100
+# Máximo de escritas retiradas da fila em cada atualização
+MAX_ESCRITAS_POR_LOTE = 5000
+# Linhas mantidas na caixa de texto (as mais antigas são removidas)
+MAX_LINHAS_TERMINAL = 5000
+
+# Texto (tag, string) à espera de ser mostrado; escrito por qualquer thread,
+# lido só pelo ciclo principal do Tk (drenar_saida)
+fila_saida = queue.SimpleQueue()
+
+
+# Redirecionamento de saída
+class TextRedirector:
+    """
+    Substitui sys.stdout/sys.stderr: o texto vai para fila_saida e é inserido
+    na caixa de texto pelo ciclo principal do Tk (o Tk não é thread-safe)
+    """
+
+    def __init__(self, widget, tag="stdout"):
+        self.widget = widget
+        self.tag = tag
+
+    def write(self, string):
+        if string:
+            fila_saida.put((self.tag, string))
+
+    def flush(self):
+        pass
+
+
+class HandlerFila(logging.Handler):
+    """Envia os registos do logging para fila_saida (mostrados na interface)"""
+
+    def emit(self, record):
+        try:
+            fila_saida.put(
+                (
+                    "stderr" if record.levelno >= logging.WARNING else "stdout",
+                    self.format(record) + "\n",
+                )
+            )
+        except Exception:
+            self.handleError(record)
+
+
+def escrever_terminal(texto: str, tag: str = "stdout"):
+    """Mostra texto na caixa de texto (pode ser chamada de qualquer thread)"""
+    fila_saida.put((tag, texto))
+
+
+def drenar_saida():
+    """
+    Insere na caixa de texto, num único lote, o texto acumulado em fila_saida
+    desde a última chamada e volta a agendar-se no ciclo do Tk
+
+    Só desce até ao fim se a vista já estava no fim (não tira o utilizador
+    do ponto onde está a ler) e mantém no máximo MAX_LINHAS_TERMINAL linhas.
+    """
+    blocos = []  # [tag, texto] consecutivos com a mesma tag juntos
+    try:
+        for _ in range(MAX_ESCRITAS_POR_LOTE):
+            tag, texto = fila_saida.get_nowait()
+            if blocos and blocos[-1][0] == tag:
+                blocos[-1][1].append(texto)
+            else:
+                blocos.append([tag, [texto]])
+    except queue.Empty:
+        pass
+
+    if blocos:
+        no_fim = terminal_output.yview()[1] >= 1.0
+        terminal_output.configure(state="normal")
+        for tag, textos in blocos:
+            terminal_output.insert(tk.END, "".join(textos), tag)
+        linhas = int(terminal_output.index("end-1c").split(".")[0])
+        if linhas > MAX_LINHAS_TERMINAL:
+            terminal_output.delete("1.0", f"{linhas - MAX_LINHAS_TERMINAL + 1}.0")
+        terminal_output.configure(state="disabled")
+        if no_fim:
+            terminal_output.see(tk.END)
+
+    root.after(INTERVALO_ATUALIZACAO_MS, drenar_saida)
+
+
+# Trabalhos cujo estado mudou, passados pelas threads do gestor ao ciclo do Tk
+fila_trabalhos = queue.SimpleQueue()
+
+
+# Logótipo reduzido (ou o erro ao lê-lo), passado pela thread que o prepara
+fila_logotipo = queue.SimpleQueue()
+
+
+def preparar_logotipo(caminho: Path):
+    """Lê e reduz o logótipo (o PNG original tem ~9400x3500 pixeis)"""
+    try:
+        with Image.open(caminho) as imagem:
+            return imagem.resize(TAMANHO_LOGOTIPO)
+    except Exception as e:
+        return e
+
+
+def mostrar_logotipo():
+    """Mostra o logótipo quando preparar_logotipo terminar"""
+    try:
+        imagem = fila_logotipo.get_nowait()
+    except queue.Empty:
+        root.after(INTERVALO_ATUALIZACAO_MS, mostrar_logotipo)
+        return
+    try:
+        if isinstance(imagem, Exception):
+            raise imagem
+        foto = ImageTk.PhotoImage(imagem)
+        label_imagem.configure(image=foto)
+        label_imagem.image = foto
+    except Exception as e:
+        print(f"Erro ao carregar imagem: {e}")
+
+
+def mostrar_relatorio(trabalho: Trabalho):
+    if trabalho.relatorio.exists():
+        with open(trabalho.relatorio, "r", encoding="utf-8") as f:
+            conteudo = f.read()
+        escrever_terminal(
+            f"\n\n--- Resultados de {trabalho.descricao} guardados em {trabalho.diretoria / 'RESULT'} ---\n\n\n--- Conteúdo do RELATÓRIO_NPP.txt ---\n"
+        )
+        escrever_terminal(conteudo)
+    else:
+        escrever_terminal("\nArquivo de relatório não encontrado.")
+
+
+def atualizar_trabalhos():
+    """Atualiza a lista de trabalhos com os estados recebidos desde a última chamada"""
+    alterados = {}
+    try:
+        while True:
+            trabalho = fila_trabalhos.get_nowait()
+            alterados[trabalho.numero] = trabalho
+    except queue.Empty:
+        pass
+
+    for numero, trabalho in alterados.items():
+        progresso = ""
+        if trabalho.total:
+            progresso = f"{trabalho.concluidas}/{trabalho.total} ({100 * trabalho.concluidas // trabalho.total}%)"
+        valores = (
+            numero,
+            trabalho.descricao,
+            trabalho.estado,
+            trabalho.etapa or "",
+            progresso,
+            trabalho.mensagem,
+        )
+        iid = str(numero)
+        if lista_trabalhos.exists(iid):
+            lista_trabalhos.item(iid, values=valores)
+        else:
+            lista_trabalhos.insert("", tk.END, iid=iid, values=valores)
+
+        if trabalho.estado == CONCLUIDO and iid not in relatorios_mostrados:
+            relatorios_mostrados.add(iid)
+            mostrar_relatorio(trabalho)
+        elif trabalho.estado == FALHOU:
+            escrever_terminal(
+                f"\n{trabalho.descricao}: {trabalho.mensagem}\nIniciar de novo retoma a partir desta etapa.\n",
+                "stderr",
+            )
+
+    root.after(INTERVALO_ATUALIZACAO_MS, atualizar_trabalhos)
+
+
+relatorios_mostrados = set()
+
+
+def iniciar_processamento():
+    try:
+        ano = int(ano_var.get())
+        mes = int(mes_var.get())
+    except ValueError:
+        escrever_terminal("Erro: ano e mês devem ser números válidos.\n", "stderr")
+        return
+    try:
+        gestor.submeter(ano, mes, regiao_var.get())
+    except ValueError as e:
+        escrever_terminal(f"{e}\n", "stderr")
+
+
+def cancelar_selecionados():
+    for iid in lista_trabalhos.selection():
+        gestor.cancelar(int(iid))
+
+
+def verificar_arranque():
+    """
+    Com --medir-arranque: escreve o tempo até a janela ficar interativa e
+    os módulos pesados já carregados, fecha a interface e termina com código
+    1 se o orçamento (ORCAMENTO_ARRANQUE_S) for excedido
+    """
+    root.update()
+    duracao = time.perf_counter() - INICIO_ARRANQUE
+    carregados = [m for m in MODULOS_PESADOS if m in sys.modules]
+    print(
+        f"Janela interativa em {duracao:.2f}s (orcamento {ORCAMENTO_ARRANQUE_S:.1f}s)"
+        + (
+            f"; modulos pesados carregados: {', '.join(carregados)}"
+            if carregados
+            else ""
+        ),
+        file=sys.__stdout__,
+    )
+    root.destroy()
+    sys.exit(0 if duracao <= ORCAMENTO_ARRANQUE_S and not carregados else 1)
+
+
+def fechar():
+    # Os trabalhos a correr param no fim da etapa em curso
+    gestor.encerrar()
+    root.destroy()
+
+
+parser = argparse.ArgumentParser(description="Interface da calculadora de CO₂")
+parser.add_argument(
+    "--paralelo",
+    type=int,
+    default=MAX_TRABALHOS,
+    help="trabalhos (mês/região) processados em simultâneo",
+)
+parser.add_argument(
+    "--medir-arranque",
+    action="store_true",
+    help="mede o tempo até a janela ficar interativa e fecha-a",
+)
+args = parser.parse_args()
+logging.basicConfig(level=logging.INFO, format=FORMATO_LOG, datefmt=FORMATO_DATA)
+gestor = GestorTrabalhos(args.paralelo, ao_atualizar=fila_trabalhos.put)
+
+
+# Criação da Janela
+root = tk.Tk()
+root.title("Calculadora de Absorção de CO₂ - Oeiras, Lisboa, Portugal")
+root.configure(bg="white")
+root.geometry("1000x900")
+root.grid_columnconfigure(0, weight=3)
+root.grid_columnconfigure(1, weight=1)
+
+icon_path = projeto_dir / "img" / "image-logo.ico"
+try:
+    root.iconbitmap(icon_path)
+except tk.TclError:
+    # Fora do Windows o Tk não lê ícones .ico
+    logger.debug(f"Ícone não suportado nesta plataforma: {icon_path}")
+
+# titulo
+titulo_label = tk.Label(
+    root,
+    text="Calculadora de Absorção de CO₂ - Oeiras, Lisboa, Portugal",
+    font=("Helvetica", 18, "bold"),
+    bg="white",
+)
+titulo_label.grid(row=0, column=0, columnspan=2, pady=(20, 10))
+
+# forms
+form_frame = tk.Frame(root, bg="white")
+form_frame.grid(row=1, column=0, sticky="nw", padx=20)
+
+# Ano
+ttk.Label(form_frame, text="Ano:").grid(
+    row=0, column=0, padx=(400, 10), pady=5, sticky="e"
+)
+ano_var = tk.StringVar()
+ano_box = ttk.Combobox(form_frame, textvariable=ano_var, values=["2024"], width=10)
+ano_box.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+ano_box.current(0)
+
+# Mês
+ttk.Label(form_frame, text="Mês:").grid(
+    row=1, column=0, padx=(400, 10), pady=5, sticky="e"
+)
+mes_var = tk.StringVar()
+mes_box = ttk.Combobox(
+    form_frame, textvariable=mes_var, values=[str(i) for i in range(1, 13)], width=10
+)
+mes_box.grid(row=1, column=1, padx=5, pady=5, sticky="w")
+mes_box.current(0)
+
+# Região
+ttk.Label(form_frame, text="Região:").grid(
+    row=2, column=0, padx=(400, 10), pady=5, sticky="e"
+)
+regiao_var = tk.StringVar()
+regiao_box = ttk.Combobox(
+    form_frame, textvariable=regiao_var, values=list(REGIOES), width=10
+)
+regiao_box.grid(row=2, column=1, padx=5, pady=5, sticky="w")
+regiao_box.current(0)
+
+# Botões (cada clique acrescenta um trabalho à fila)
+ttk.Button(form_frame, text="Iniciar", command=iniciar_processamento).grid(
+    row=3, column=0, padx=(400, 10), columnspan=2, pady=10
+)
+
+# imagem isel (lida e reduzida numa thread, ver mostrar_logotipo)
+img_path = projeto_dir / "img" / "ISEL-Logotipo.png"
+label_imagem = tk.Label(root, bg="white")
+label_imagem.grid(row=1, column=1, rowspan=5, padx=0, pady=25, sticky="ne")
+if img_path.exists():
+    threading.Thread(
+        target=lambda: fila_logotipo.put(preparar_logotipo(img_path)),
+        name="logotipo",
+        daemon=True,
+    ).start()
+    root.after(INTERVALO_ATUALIZACAO_MS, mostrar_logotipo)
+else:
+    logger.warning(f"Imagem não encontrada em: {img_path}")
+
+# Trabalhos
+trabalhos_frame = tk.Frame(root, bg="white")
+trabalhos_frame.grid(row=2, column=0, columnspan=2, padx=20, pady=(0, 10), sticky="ew")
+
+colunas = {
+    "numero": ("#", 40),
+    "trabalho": ("Trabalho", 150),
+    "estado": ("Estado", 90),
+    "etapa": ("Etapa", 90),
+    "progresso": ("Etapas", 90),
+    "mensagem": ("", 420),
+}
+lista_trabalhos = ttk.Treeview(
+    trabalhos_frame, columns=list(colunas), show="headings", height=5
+)
+for coluna, (titulo, largura) in colunas.items():
+    lista_trabalhos.heading(coluna, text=titulo)
+    lista_trabalhos.column(coluna, width=largura, anchor="w")
+lista_trabalhos.pack(side=tk.LEFT, fill=tk.X, expand=True)
+ttk.Button(trabalhos_frame, text="Cancelar", command=cancelar_selecionados).pack(
+    side=tk.LEFT, padx=(10, 0)
+)
+
+# t34minal output
+output_frame = tk.Frame(root, bg="white")
+output_frame.grid(row=3, column=0, columnspan=2, padx=20, pady=0, sticky="nsew")
+
+# Scrollbar
+scrollbar = tk.Scrollbar(output_frame)
+scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+# Caixa de texto
+terminal_output = tk.Text(
+    output_frame,
+    height=34,
+    width=110,
+    bg="#f5f5f5",
+    fg="black",
+    wrap="word",
+    yscrollcommand=scrollbar.set,
+)
+terminal_output.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+terminal_output.configure(state="disabled")
+terminal_output.tag_configure("stderr", foreground="#b00020")
+
+scrollbar.config(command=terminal_output.yview)
+
+# Redirecionar stdout, stderr e logging (via fila_saida)
+sys.stdout = TextRedirector(terminal_output, "stdout")
+sys.stderr = TextRedirector(terminal_output, "stderr")
+handler_interface = HandlerFila()
+handler_interface.setFormatter(logging.Formatter(FORMATO_LOG, datefmt=FORMATO_DATA))
+logging.getLogger().addHandler(handler_interface)
+root.after(INTERVALO_ATUALIZACAO_MS, drenar_saida)
+root.after(INTERVALO_ATUALIZACAO_MS, atualizar_trabalhos)
+root.protocol("WM_DELETE_WINDOW", fechar)
+if args.medir_arranque:
+    root.after_idle(verificar_arranque)
+else:
+    root.after(
+        ATRASO_PRECARREGAR_MS,
+        lambda: threading.Thread(
+            target=precarregar, name="precarregar", daemon=True
+        ).start(),
+    )
+
+# Iniciar loop
+root.mainloop()
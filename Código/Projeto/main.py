@@ -1,367 +1,1033 @@
-from calendar import monthrange
-from shapely import wkt
-from shapely.geometry import mapping
-import logging
-import traceback
-import sys
-from pathlib import Path
-import rasterio
-import numpy as np
-from rasterio.warp import reproject, Resampling
-from rasterio.transform import Affine
-from datetime import date, timedelta
-
-from Download import download_sentinel_data
-from parametros.Param_FPAR import calcular_ndvi_fpar
-from parametros.Param_WSC import calculate_WSC_from_tif
-from parametros.Param_T1_T2 import calcular_T1_T2
-from parametros.Param_SOL import calcular_sol, determinar_mes_imagem
-from parametros.calc_NPP import executar_calculo_npp
-from parametros.analise_NPP import analisar_npp
-from App_Shapefile import aplicar_mascara_shapefile
-from parametros.Param_Emax import calcular_emax
-
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] %(levelname)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
-logger = logging.getLogger(__name__)
-
-
-def main(ano: int, mes: int):
-    projeto_dir = Path(__file__).parent.resolve()
-    logger.info(f"Diretoria do projeto: {projeto_dir}")
-
-    # Data inicial
-    data_inicial = date(ano, mes, 1)
-    data_final = data_inicial + timedelta(days=7)
-    data_alternativa = data_inicial + timedelta(days=8)
-    data_alternativa_fim = data_inicial.replace(day=28)
-
-    data = [data_inicial.isoformat(), data_final.isoformat()]
-    data2 = [data_alternativa.isoformat(), data_alternativa_fim.isoformat()]
-
-    # Constantes de configuração
-    POPULACAO = 172120  # N atual de pessoas em oeiras
-    EMISSOES_CO2_PER_CAPITA = 0.8917  # t CO₂/pessoa/mês
-
-    # Variação percentual (relativa à média diária anual) fornecida pelo utilizador
-    VAR_PCT_MES = {
-        1: -53.57138918,
-        2: -35.49327248,
-        3: -17.53257806,
-        4: 21.45016561,
-        5: 52.10518815,
-        6: 42.992943,
-        7: 63.0189765,
-        8: 55.56084036,
-        9: 20.07604713,
-        10: -32.22469972,
-        11: -49.63097221,
-        12: -49.23973522,
-    }
-
-    ANO_REFERENCIA = ano
-    FATOR_CONVERSAO = 44 / 12
-    RESOLUCAO_SOLAR = 1.0
-
-    # Diretórios
-    sentinel2_dir = projeto_dir / "INPUTS" / "SENTINEL2"
-    sentinel3_dir = projeto_dir / "INPUTS" / "SENTINEL3"
-    outputs_dir = projeto_dir / "OUTPUTS"
-    resultados_dir = projeto_dir / "RESULT"
-    oeiras_dir = projeto_dir / "OEIRAS"
-
-    sentinel2_dir.mkdir(parents=True, exist_ok=True)
-    sentinel3_dir.mkdir(parents=True, exist_ok=True)
-    outputs_dir.mkdir(parents=True, exist_ok=True)
-    resultados_dir.mkdir(parents=True, exist_ok=True)
-    oeiras_dir.mkdir(parents=True, exist_ok=True)
-
-    geojson_file = projeto_dir / "coordenadas.txt"
-    shapefile_path = oeiras_dir / "oeiras_shapefile.shp"
-
-    # Download Sentinel-2
-    s2_tif_original = sentinel2_dir / "Sentinel2_B04_B08_B11_B12_ORIGINAL.tif"
-    s2_tif_masked = sentinel2_dir / "Sentinel2_B04_B08_B11_B12_MASKED.tif"
-
-    # Variável para armazenar qual data foi usada
-    data_efetiva = None
-
-    try:
-        download_sentinel_data(
-            sentinel_version=2,
-            geojson_file=str(geojson_file),
-            cloud_coverage=10,
-            bands=["B04", "B08", "B11", "B12"],
-            date_interval=data,
-            output_filename=str(s2_tif_original),
-        )
-        logger.info(f"Download Sentinel-2 feito: {s2_tif_original}")
-        data_efetiva = data[0]
-
-        aplicar_mascara_shapefile(
-            shapefile_path=str(shapefile_path),
-            raster_path=str(s2_tif_original),
-            output_path=str(s2_tif_masked),
-            nodata=0,
-        )
-        logger.info(f"Imagem Sentinel-2 recortada: {s2_tif_masked}")
-
-    except Exception as e:
-        logger.error(f"Erro no download Sentinel-2: {e}")
-        logger.info("Tentando intervalo alternativo para Sentinel-2...")
-        try:
-            download_sentinel_data(
-                sentinel_version=2,
-                geojson_file=str(geojson_file),
-                cloud_coverage=20,
-                bands=["B04", "B08", "B11", "B12"],
-                date_interval=data2,
-                output_filename=str(s2_tif_original),
-            )
-            logger.info(
-                f"Download alternativo bem-sucedido (Sentinel-2): {s2_tif_original}"
-            )
-            data_efetiva = data2[0]
-
-            aplicar_mascara_shapefile(
-                shapefile_path=str(shapefile_path),
-                raster_path=str(s2_tif_original),
-                output_path=str(s2_tif_masked),
-                nodata=0,
-            )
-            logger.info(f"Imagem Sentinel-2 alternativa recortada: {s2_tif_masked}")
-
-        except Exception as e2:
-            logger.error(f"FALHA CRITICA no download Sentinel-2: {e2}")
-            sys.exit(1)
-
-    # Download LST diurno e noturno (Sentinel-3)
-    lst_day_tif_original = sentinel3_dir / "Sentinel3_LST_day_ORIGINAL.tif"
-    lst_day_tif_masked = sentinel3_dir / "Sentinel3_LST_day_MASKED.tif"
-    lst_night_tif_original = sentinel3_dir / "Sentinel3_LST_night_ORIGINAL.tif"
-    lst_night_tif_masked = sentinel3_dir / "Sentinel3_LST_night_MASKED.tif"
-
-    # Download LST diurno
-    try:
-        download_sentinel_data(
-            sentinel_version=3,
-            geojson_file=str(geojson_file),
-            cloud_coverage=10,
-            bands=["LST"],
-            date_interval=data,
-            output_filename=str(lst_day_tif_original),
-            s3_day_night="day",
-        )
-        logger.info(f"Download Sentinel-3 LST feito: {lst_day_tif_original}")
-
-        aplicar_mascara_shapefile(
-            shapefile_path=str(shapefile_path),
-            raster_path=str(lst_day_tif_original),
-            output_path=str(lst_day_tif_masked),
-            nodata=0,
-        )
-        logger.info(f"LST diurno recortado: {lst_day_tif_masked}")
-
-    except Exception as e:
-        logger.error(f"Erro no download LST diurno: {e}")
-        logger.info("Tentando intervalo alternativo para LST diurno...")
-        try:
-            download_sentinel_data(
-                sentinel_version=3,
-                geojson_file=str(geojson_file),
-                cloud_coverage=20,
-                bands=["LST"],
-                date_interval=data2,
-                output_filename=str(lst_day_tif_original),
-                s3_day_night="day",
-            )
-            logger.info(
-                f"Download alternativo bem-sucedido (LST diurno): {lst_day_tif_original}"
-            )
-
-            aplicar_mascara_shapefile(
-                shapefile_path=str(shapefile_path),
-                raster_path=str(lst_day_tif_original),
-                output_path=str(lst_day_tif_masked),
-                nodata=0,
-            )
-            logger.info(f"LST diurno alternativo recortado: {lst_day_tif_masked}")
-
-        except Exception as e2:
-            logger.error(f"FALHA no download LST diurno: {e2}")
-            sys.exit(1)
-
-    # Download LST noturno
-    try:
-        download_sentinel_data(
-            sentinel_version=3,
-            geojson_file=str(geojson_file),
-            cloud_coverage=10,
-            bands=["LST"],
-            date_interval=data,
-            output_filename=str(lst_night_tif_original),
-            s3_day_night="night",
-        )
-        logger.info(f"Download Sentinel-3 LST feito: {lst_night_tif_original}")
-
-        aplicar_mascara_shapefile(
-            shapefile_path=str(shapefile_path),
-            raster_path=str(lst_night_tif_original),
-            output_path=str(lst_night_tif_masked),
-            nodata=0,
-        )
-        logger.info(f"LST noturno recortado: {lst_night_tif_masked}")
-
-    except Exception as e:
-        logger.error(f"FALHA no download LST noturno: {e}")
-        logger.info("Tentando intervalo alternativo para LST noturno...")
-        try:
-            download_sentinel_data(
-                sentinel_version=3,
-                geojson_file=str(geojson_file),
-                cloud_coverage=20,
-                bands=["LST"],
-                date_interval=data2,
-                output_filename=str(lst_night_tif_original),
-                s3_day_night="night",
-            )
-            logger.info(
-                f"Download alternativo bem-sucedido (LST noturno): {lst_night_tif_original}"
-            )
-
-            aplicar_mascara_shapefile(
-                shapefile_path=str(shapefile_path),
-                raster_path=str(lst_night_tif_original),
-                output_path=str(lst_night_tif_masked),
-                nodata=0,
-            )
-            logger.info(f"LST noturno alternativo recortado: {lst_night_tif_masked}")
-
-        except Exception as e2:
-            logger.error(f"FALHA no download LST noturno: {e2}")
-            sys.exit(1)
-
-    # Calcular NDVI e FPAR
-    try:
-        fpar_file = calcular_ndvi_fpar(str(s2_tif_masked), str(outputs_dir))
-        logger.info(f"FPAR calculado com sucesso: {fpar_file}")
-    except Exception as e:
-        logger.error(f"FALHA no cálculo FPAR: {e}")
-        sys.exit(1)
-
-    # Calcular WSC
-    try:
-        wsc_out = outputs_dir / "WSC.tif"
-        calculate_WSC_from_tif(str(s2_tif_masked), str(wsc_out))
-        logger.info(f"WSC calculado com sucesso: {wsc_out}")
-    except Exception as e:
-        logger.error(f"FALHA no cálculo WSC: {e}")
-        sys.exit(1)
-
-    # Calcular parâmetros de temperatura
-    try:
-        T1 = calcular_T1_T2(
-            str(lst_day_tif_original), str(lst_night_tif_original), str(outputs_dir)
-        )
-        logger.info(f"T1 calculado com sucesso: {T1:.4f}")
-    except Exception as e:
-        logger.error(f"FALHA CRÍTICA no cálculo de temperatura: {e}")
-        sys.exit(1)
-
-    try:
-        mes_processamento = determinar_mes_imagem(
-            tif_path=s2_tif_masked,
-            data_fallback=data_efetiva,  # Usa a data efetivamente transferida
-        )
-        logger.info(f"Mês de processamento determinado: {mes_processamento}")
-
-    except Exception as e:
-        logger.error(f"Erro ao determinar mês: {e}")
-        sys.exit(1)
-
-    # Calcular radiação solar (SOL)
-    try:
-        sol_output = calcular_sol(
-            projeto_dir=projeto_dir,
-            outputs_dir=outputs_dir,
-            mes=mes_processamento,
-            ano_referencia=ANO_REFERENCIA,
-            var_pct_mes=VAR_PCT_MES,
-            fator_conversao=FATOR_CONVERSAO,
-            resolucao_solar=RESOLUCAO_SOLAR,
-        )
-    except Exception as e:
-        logger.error(f"FALHA no cálculo da radiação solar: {e}")
-        sys.exit(1)
-
-    # CALCULAR E_max
-    try:
-        # Obter dimensões da imagem Sentinel-2 recortada
-        with rasterio.open(s2_tif_masked) as src:
-            nova_largura = src.width
-            nova_altura = src.height
-
-        # Caminhos para E_max
-        emax_input = (
-            projeto_dir
-            / "INPUTS"
-            / "Subset_ESA_WorldCover_10m_2021_v200_N36W012_Map.tif"
-        )
-        emax_output = outputs_dir / "E_max.tif"
-
-        # Verificar se o arquivo de entrada existe
-        if not emax_input.exists():
-            logger.error(f"Arquivo de entrada para E_max não encontrado: {emax_input}")
-            sys.exit(1)
-
-        # Executar cálculo do E_max
-        calcular_emax(
-            caminho_entrada=emax_input,
-            caminho_saida=emax_output,
-            nova_largura=nova_largura,
-            nova_altura=nova_altura,
-        )
-        logger.info(f"E_max calculado com sucesso: {emax_output}")
-
-    except Exception as e:
-        logger.error(f"FALHA no cálculo de E_max: {e}")
-        sys.exit(1)
-
-    # Calcular NPP
-    try:
-        npp_result = executar_calculo_npp(projeto_dir)
-        logger.info(f"Cálculo do NPP completo: {npp_result}")
-    except Exception as e:
-        logger.error(f"FALHA no cálculo do NPP: {e}")
-        sys.exit(1)
-
-    # Análise do NPP
-    try:
-        resultados = analisar_npp(
-            npp_input_tif=npp_result,
-            resultados_dir=resultados_dir,
-            populacao=POPULACAO,
-            emissao_co2_per_capita=EMISSOES_CO2_PER_CAPITA,
-            tamanho_pixel_ha=0.01,  # para imagens de 10m x 10m
-            mes=mes_processamento,
-            ano_referencia=ANO_REFERENCIA,
-        )
-        logger.info(f"Analise do NPP completa. Relatório: {resultados['relatorio']}")
-    except Exception as e:
-        logger.error(f"FALHA na análise do NPP: {e}")
-        sys.exit(1)
-
-    logger.info("Processo completo com sucesso!")
-
-
-if __name__ == "__main__":
-    try:
-        main()
-    except Exception as e:
-        logger.error(f"ERRO NÃO TRATADO: {str(e)}")
-        logger.error(traceback.format_exc())
-        sys.exit(1)
+from calendar import monthrange
+from shapely import wkt
+from shapely.geometry import mapping
+import logging
+import traceback
+import sys
+from pathlib import Path
+import numpy as np
+from rasterio.warp import reproject, Resampling
+from rasterio.transform import Affine
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import json
+
+from Download import (
+    PRODUTOS_SENTINEL,
+    download_sentinel_data,
+    intervalos_do_mes,
+    meses_entre,
+)
+from parametros.Param_FPAR import calcular_ndvi_fpar
+from parametros.Param_WSC import calculate_WSC_from_tif
+from parametros.Param_T1_T2 import calcular_T1_T2
+from parametros.Param_SOL import calcular_sol, determinar_mes_imagem, recortar_ghi
+from parametros.calc_NPP import executar_calculo_npp
+from parametros.analise_NPP import analisar_npp
+from parametros.cubo_resultados import NOME_CUBO, CuboResultados
+from parametros import instrumentacao
+from parametros.estatisticas_zonais import (
+    CLASSES_WORLDCOVER,
+    classes_worldcover,
+    nomes_zonas_vetoriais,
+    rasterizar_zonas,
+)
+from App_Shapefile import aplicar_mascara_shapefile, carregar_geometria_shapefile
+from parametros.Param_Emax import TABELA_EPSILON, calcular_emax
+from parametros.raster_io import (
+    esta_na_grelha,
+    grelha_de_raster,
+    guardar_raster,
+    materializar,
+)
+from cache_camadas import obter_cache_camadas
+from etapas import Etapa, FalhaEtapa, executar_etapas
+from regioes import (
+    REGIOES,
+    agrupar_sobrepostas,
+    escrever_geojson_envolvente,
+    escrever_geojson_regiao,
+    obter_regiao,
+    recortar_extensao_regiao,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def configurar_logging():
+    """
+    Configura o logging (INFO, com data e hora) nos pontos de entrada e nos
+    processos de trabalho; importar os módulos já não o altera
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+
+def descarregar_e_recortar(
+    descricao: str,
+    sentinel_version: int,
+    bands: list,
+    geojson_file: Path,
+    shapefile_path: Path,
+    original: Path,
+    masked: Path,
+    intervalos: list,
+    s3_day_night: str = "both",
+    geometria=None,
+    recortar: bool = True,
+) -> tuple:
+    """
+    Descarrega um produto Sentinel e recorta-o pelo shapefile
+
+    Os intervalos [(date_interval, cloud_coverage), ...] são tentados por ordem
+    (principal e alternativo) até um deles ter sucesso. geometria é a geometria
+    do shapefile já carregada (ver carregar_geometria_shapefile), se existir.
+    O produto recortado fica em memória e só é escrito em masked se este não
+    for None. Com recortar=False o produto é só descarregado (download
+    partilhado entre regiões, recortado depois por cada uma).
+
+    Retorna:
+    tuple: (data inicial do intervalo efetivamente usado, RasterMemoria
+    recortado ou None sem recortar)
+    """
+    ultimo_erro = None
+    for tentativa, (date_interval, cloud_coverage) in enumerate(intervalos):
+        if tentativa > 0:
+            logger.info(f"Tentando intervalo alternativo para {descricao}...")
+        try:
+            download_sentinel_data(
+                sentinel_version=sentinel_version,
+                geojson_file=str(geojson_file),
+                cloud_coverage=cloud_coverage,
+                bands=list(bands),
+                date_interval=date_interval,
+                output_filename=str(original),
+                s3_day_night=s3_day_night,
+            )
+            logger.info(f"Download {descricao} feito: {original}")
+            if not recortar:
+                return date_interval[0], None
+
+            recorte = aplicar_mascara_shapefile(
+                shapefile_path=str(shapefile_path),
+                raster_path=str(original),
+                nodata=0,
+                geometria=geometria,
+            )
+            if masked is not None:
+                materializar(recorte, masked)
+            logger.info(f"{descricao} recortado: {masked or 'em memoria'}")
+            return date_interval[0], recorte
+
+        except Exception as e:
+            logger.error(f"Erro no download {descricao}: {e}")
+            ultimo_erro = e
+
+    raise ultimo_erro
+
+
+def ghi_recortado_em_cache(projeto_dir: Path, regiao, usar_cache: bool = True):
+    """GHI recortado da região (recortar_ghi), através da cache de camadas"""
+    regiao = obter_regiao(regiao)
+
+    def calcular():
+        return recortar_ghi(projeto_dir, regiao.ghi, regiao.wkt_quadrado)
+
+    if not usar_cache:
+        return calcular()
+    return obter_cache_camadas().obter_ou_calcular(
+        "GHI", regiao.nome, calcular, fontes=[regiao.ghi, regiao.wkt_quadrado]
+    )
+
+
+def emax_em_cache(regiao, grelha, usar_cache: bool = True):
+    """E_max da região na grelha alvo (calcular_emax), através da cache de camadas"""
+    regiao = obter_regiao(regiao)
+    mosaicos = regiao.mosaicos_worldcover()
+
+    def calcular():
+        return calcular_emax(regiao.worldcover, None, grelha=grelha)
+
+    if not usar_cache:
+        return calcular()
+    return obter_cache_camadas().obter_ou_calcular(
+        "E_max",
+        regiao.nome,
+        calcular,
+        grelha=grelha,
+        fontes=mosaicos,
+        tabela_epsilon={str(k): v for k, v in TABELA_EPSILON.items()},
+    )
+
+
+def fontes_vetoriais(caminho: Path) -> list:
+    """Ficheiros de uma camada vetorial (.shp e, se existirem, .dbf e .prj)"""
+    caminho = Path(caminho)
+    return [caminho] + [
+        caminho.with_suffix(sufixo)
+        for sufixo in (".dbf", ".prj")
+        if caminho.with_suffix(sufixo).exists()
+    ]
+
+
+def indices_zonas(regiao, grelha, usar_cache: bool = True) -> dict:
+    """
+    Índices de zonas da região na grelha do NPP, para as estatísticas zonais
+
+    Inclui sempre as classes WorldCover e as camadas vetoriais de
+    regiao.zonas; cada índice é rasterizado uma vez e guardado na cache de
+    camadas.
+
+    Retorna:
+    dict: {camada: (RasterMemoria com o índice, {índice: nome})}
+    """
+    regiao = obter_regiao(regiao)
+    cache = obter_cache_camadas() if usar_cache else None
+
+    def obter(camada, calcular, fontes):
+        if cache is None:
+            return calcular()
+        return cache.obter_ou_calcular(
+            f"zonas_{camada}", regiao.nome, calcular, grelha=grelha, fontes=fontes
+        )
+
+    zonas = {
+        "classe_worldcover": (
+            obter(
+                "classe_worldcover",
+                lambda: classes_worldcover(regiao.worldcover, grelha),
+                regiao.mosaicos_worldcover(),
+            ),
+            CLASSES_WORLDCOVER,
+        )
+    }
+    for camada, (caminho, campo) in regiao.zonas.items():
+        indice = obter(
+            camada,
+            lambda caminho=caminho, campo=campo: rasterizar_zonas(
+                caminho, campo, grelha
+            ),
+            fontes_vetoriais(caminho),
+        )
+        nomes = nomes_zonas_vetoriais(caminho, campo)
+        zonas[camada] = (indice, dict(enumerate(nomes, start=1)))
+    return zonas
+
+
+def preparar_camadas_estaticas(
+    projeto_dir: Path,
+    grelha,
+    geometria=None,
+    regiao="OEIRAS",
+    usar_cache: bool = True,
+) -> dict:
+    """
+    Calcula as camadas que não dependem do mês, para reutilizar em main
+
+    GHI e E_max vêm da cache de camadas (ver cache_camadas) quando a região,
+    a grelha e os ficheiros de origem não mudaram.
+
+    Retorna:
+    dict: {"grelha", "geometria" (shapefile combinado), "GHI" (recortado, sem
+    o fator mensal), "E_max" (na grelha)}
+    """
+    regiao = obter_regiao(regiao)
+    logger.info(
+        f"A preparar camadas estaticas de {regiao.nome} (geometria, GHI, E_max)"
+    )
+    if geometria is None:
+        geometria = carregar_geometria_shapefile(str(regiao.shapefile))
+    return {
+        "grelha": grelha,
+        "geometria": geometria,
+        "GHI": ghi_recortado_em_cache(projeto_dir, regiao, usar_cache),
+        "E_max": emax_em_cache(regiao, grelha, usar_cache),
+    }
+
+
+def etapas_do_mes(
+    ano: int,
+    mes: int,
+    trabalho_dir: Path,
+    regiao,
+    guardar_intermedios: bool = False,
+    camadas_estaticas: dict = None,
+    downloads_partilhados: dict = None,
+    usar_cache_camadas: bool = True,
+    cubo: Path = None,
+    linhas_bloco: int = None,
+) -> list:
+    """
+    Grafo de etapas do processamento de um mês (ver etapas.executar_etapas)
+
+    download -> recorte -> FPAR, WSC, grelha (grelha e mês da imagem);
+    grelha -> SOL, E_max; download -> T1/T2; todas -> NPP -> análise. Os
+    parâmetros de cada etapa são só os que a afetam (ex.: var_pct_mes só
+    entra no SOL), pelo que alterar um deles refaz apenas essa etapa e as
+    que dela dependem.
+
+    A exceção é o recorte, que não é guardado no manifesto (é um raster
+    grande e barato de refazer a partir do ORIGINAL.tif, ver
+    Etapa.persistir): é recalculado sempre que FPAR, WSC ou a grelha têm de
+    correr, mesmo sem alterações nas suas entradas. SOL, E_max, NPP e análise
+    só dependem da grelha e do mês, pelo que alterar var_pct_mes refaz só
+    SOL, NPP e análise. FPAR, WSC, T2 e SOL ficam no manifesto em GeoTIFF
+    intermedio e o E_max por referência à cache de camadas.
+
+    Retorna:
+    list: Etapa (na ordem natural; executar_etapas ordena pelas dependências)
+    """
+    projeto_dir = Path(__file__).parent.resolve()
+    estaticas = camadas_estaticas or {}
+    regiao = obter_regiao(regiao)
+
+    # Constantes de configuração (da região)
+    POPULACAO = regiao.populacao
+    EMISSOES_CO2_PER_CAPITA = regiao.emissoes_co2_per_capita  # t CO₂/pessoa/mês
+
+    # Variação percentual (relativa à média diária anual) fornecida pelo utilizador
+    VAR_PCT_MES = regiao.var_pct_mes
+    if VAR_PCT_MES is None:
+        raise ValueError(
+            f"Regiao {regiao.nome} sem variacao mensal do GHI (var_pct_mes em regioes.py)"
+        )
+
+    ANO_REFERENCIA = ano
+    FATOR_CONVERSAO = 44 / 12
+    RESOLUCAO_SOLAR = 1.0
+
+    # Diretórios
+    sentinel2_dir = trabalho_dir / "INPUTS" / "SENTINEL2"
+    sentinel3_dir = trabalho_dir / "INPUTS" / "SENTINEL3"
+    outputs_dir = trabalho_dir / "OUTPUTS"
+    resultados_dir = trabalho_dir / "RESULT"
+
+    sentinel2_dir.mkdir(parents=True, exist_ok=True)
+    sentinel3_dir.mkdir(parents=True, exist_ok=True)
+    outputs_dir.mkdir(parents=True, exist_ok=True)
+    resultados_dir.mkdir(parents=True, exist_ok=True)
+
+    # Produtos a descarregar (em paralelo) e respetivos ficheiros
+    s2_tif_original = sentinel2_dir / "Sentinel2_B04_B08_B11_B12_ORIGINAL.tif"
+    s2_tif_masked = sentinel2_dir / "Sentinel2_B04_B08_B11_B12_MASKED.tif"
+    lst_day_tif_original = sentinel3_dir / "Sentinel3_LST_day_ORIGINAL.tif"
+    lst_day_tif_masked = sentinel3_dir / "Sentinel3_LST_day_MASKED.tif"
+    lst_night_tif_original = sentinel3_dir / "Sentinel3_LST_night_ORIGINAL.tif"
+    lst_night_tif_masked = sentinel3_dir / "Sentinel3_LST_night_MASKED.tif"
+
+    ficheiros = {
+        "Sentinel-2": (s2_tif_original, s2_tif_masked),
+        "LST diurno": (lst_day_tif_original, lst_day_tif_masked),
+        "LST noturno": (lst_night_tif_original, lst_night_tif_masked),
+    }
+
+    # Intervalo principal e alternativo (data, cobertura de nuvens)
+    intervalos = intervalos_do_mes(ano, mes)
+
+    def obter_produto(nome: str, params: dict, geojson_file: Path) -> str:
+        """Descarrega um produto (ou recorta-o do download partilhado)"""
+        original = ficheiros[nome][0]
+        if downloads_partilhados:
+            origem, data_inicial = downloads_partilhados[nome]
+            recortar_extensao_regiao(origem, original, regiao)
+            logger.info(f"{regiao.nome}: {nome} recortado do download partilhado")
+            return data_inicial
+
+        data_inicial, _ = descarregar_e_recortar(
+            descricao=nome,
+            geojson_file=geojson_file,
+            shapefile_path=None,
+            original=original,
+            masked=None,
+            intervalos=intervalos,
+            recortar=False,
+            **params,
+        )
+        return data_inicial
+
+    def descarregar(entradas):
+        geojson_file = escrever_geojson_regiao(
+            regiao, trabalho_dir / "INPUTS" / f"coordenadas_{regiao.nome}.txt"
+        )
+        # Os três downloads são independentes: cada um corre na sua thread,
+        # com o seu próprio intervalo alternativo
+        with ThreadPoolExecutor(max_workers=len(PRODUTOS_SENTINEL)) as pool:
+            futuros = {
+                nome: pool.submit(obter_produto, nome, params, geojson_file)
+                for nome, params in PRODUTOS_SENTINEL.items()
+            }
+        saidas = {"datas": {}}
+        for nome, futuro in futuros.items():
+            saidas["datas"][nome] = futuro.result()
+            saidas[nome] = ficheiros[nome][0]
+        return saidas
+
+    def recortar(entradas):
+        originais = entradas["download"]
+        # Os LST só são recortados para escrever *_MASKED.tif: T1/T2 lê os originais
+        produtos = list(ficheiros) if guardar_intermedios else ["Sentinel-2"]
+        recortes = {}
+        for nome in produtos:
+            recortes[nome] = aplicar_mascara_shapefile(
+                shapefile_path=str(regiao.shapefile),
+                raster_path=str(originais[nome]),
+                nodata=0,
+                geometria=estaticas.get("geometria"),
+            )
+            if guardar_intermedios:
+                materializar(recortes[nome], ficheiros[nome][1])
+            logger.info(
+                f"{nome} recortado: {ficheiros[nome][1] if guardar_intermedios else 'em memoria'}"
+            )
+
+        mes_processamento = determinar_mes_imagem(
+            tif_path=recortes["Sentinel-2"],
+            # Usa a data efetivamente transferida
+            data_fallback=originais["datas"]["Sentinel-2"],
+        )
+        logger.info(f"Mês de processamento determinado: {mes_processamento}")
+        return {"Sentinel-2": recortes["Sentinel-2"], "mes": mes_processamento}
+
+    def grelha_e_mes(entradas):
+        # Saída pequena de que dependem SOL, E_max, NPP e análise, para que
+        # estas não obriguem a refazer o recorte
+        recorte = entradas["recorte"]
+        return {
+            "grelha": grelha_de_raster(recorte["Sentinel-2"]),
+            "mes": recorte["mes"],
+        }
+
+    def fpar(entradas):
+        s2_recortado = entradas["recorte"]["Sentinel-2"]
+        if guardar_intermedios:
+            fpar_file = Path(
+                calcular_ndvi_fpar(s2_recortado, str(outputs_dir), linhas_bloco)
+            )
+            logger.info(f"FPAR calculado com sucesso: {fpar_file}")
+            return {"FPAR": fpar_file}
+        logger.info("FPAR calculado com sucesso (em memoria)")
+        return {"FPAR": calcular_ndvi_fpar(s2_recortado, linhas_bloco=linhas_bloco)}
+
+    def wsc(entradas):
+        s2_recortado = entradas["recorte"]["Sentinel-2"]
+        if guardar_intermedios:
+            wsc_out = outputs_dir / "WSC.tif"
+            calculate_WSC_from_tif(s2_recortado, str(wsc_out), linhas_bloco)
+            logger.info(f"WSC calculado com sucesso: {wsc_out}")
+            return {"WSC": wsc_out}
+        logger.info("WSC calculado com sucesso (em memoria)")
+        return {"WSC": calculate_WSC_from_tif(s2_recortado, linhas_bloco=linhas_bloco)}
+
+    def temperatura(entradas):
+        originais = entradas["download"]
+        if guardar_intermedios:
+            T1 = calcular_T1_T2(
+                str(originais["LST diurno"]),
+                str(originais["LST noturno"]),
+                str(outputs_dir),
+            )
+            T2 = outputs_dir / "T2.tif"
+        else:
+            T1, T2 = calcular_T1_T2(
+                str(originais["LST diurno"]), str(originais["LST noturno"])
+            )
+        logger.info(f"T1 calculado com sucesso: {T1:.4f}")
+        return {"T1": float(T1), "T2": T2}
+
+    def sol(entradas):
+        sol_output = calcular_sol(
+            projeto_dir=projeto_dir,
+            outputs_dir=outputs_dir if guardar_intermedios else None,
+            mes=entradas["grelha"]["mes"],
+            ano_referencia=ANO_REFERENCIA,
+            var_pct_mes=VAR_PCT_MES,
+            fator_conversao=FATOR_CONVERSAO,
+            resolucao_solar=RESOLUCAO_SOLAR,
+            ghi_recortado=(
+                estaticas["GHI"]
+                if "GHI" in estaticas
+                else ghi_recortado_em_cache(projeto_dir, regiao, usar_cache_camadas)
+            ),
+        )
+        return {"SOL": sol_output}
+
+    def emax(entradas):
+        # Grelha alvo: imagem Sentinel-2 recortada
+        grelha = entradas["grelha"]["grelha"]
+        emax_output = outputs_dir / "E_max.tif"
+
+        if "E_max" in estaticas and esta_na_grelha(
+            grelha.crs, grelha.transform, grelha.forma, estaticas["grelha"]
+        ):
+            # Camada estática já calculada para esta grelha
+            emax_result = estaticas["E_max"]
+            logger.info("E_max reutilizado das camadas estaticas")
+        else:
+            # Executar cálculo do E_max (ou ler da cache de camadas)
+            emax_result = emax_em_cache(regiao, grelha, usar_cache_camadas)
+            logger.info(
+                f"E_max calculado com sucesso: {emax_output if guardar_intermedios else 'em memoria'}"
+            )
+        if guardar_intermedios:
+            guardar_raster(emax_output, emax_result.dados, emax_result.perfil)
+        return {"E_max": emax_result}
+
+    def npp(entradas):
+        camadas = {
+            "FPAR": entradas["fpar"]["FPAR"],
+            "T2": entradas["t1_t2"]["T2"],
+            "WSC": entradas["wsc"]["WSC"],
+            "SOL": entradas["sol"]["SOL"],
+            "E_max": entradas["emax"]["E_max"],
+        }
+        npp_result = executar_calculo_npp(
+            trabalho_dir,
+            camadas=camadas,
+            T1=entradas["t1_t2"]["T1"],
+            grelha=entradas["grelha"]["grelha"],
+        )
+        logger.info(f"Cálculo do NPP completo: {npp_result}")
+        return {"NPP": npp_result}
+
+    def analise(entradas):
+        # Índices de zonas para as estatísticas por zona (não crítico)
+        try:
+            zonas = indices_zonas(
+                regiao, entradas["grelha"]["grelha"], usar_cache_camadas
+            )
+        except Exception as e:
+            logger.warning(f"Estatisticas zonais indisponiveis: {e}")
+            zonas = None
+
+        resultados = analisar_npp(
+            npp_input_tif=entradas["npp"]["NPP"],
+            resultados_dir=resultados_dir,
+            populacao=POPULACAO,
+            emissao_co2_per_capita=EMISSOES_CO2_PER_CAPITA,
+            tamanho_pixel_ha=0.01,  # para imagens de 10m x 10m
+            mes=entradas["grelha"]["mes"],
+            ano_referencia=ANO_REFERENCIA,
+            descricao_regiao=regiao.descricao,
+            zonas=zonas,
+            cubo=cubo,
+        )
+        logger.info(f"Analise do NPP completa. Relatório: {resultados['relatorio']}")
+        return resultados
+
+    mosaicos = regiao.mosaicos_worldcover()
+    fontes_zonas = [
+        f for caminho, _ in regiao.zonas.values() for f in fontes_vetoriais(caminho)
+    ]
+    return [
+        Etapa(
+            "download",
+            descarregar,
+            parametros={
+                "ano": ano,
+                "mes": mes,
+                "regiao": regiao.nome,
+                "limites": regiao.limites(),
+                "produtos": PRODUTOS_SENTINEL,
+                "intervalos": intervalos,
+                "partilhados": downloads_partilhados,
+            },
+        ),
+        Etapa(
+            "recorte",
+            recortar,
+            ("download",),
+            {"guardar_intermedios": guardar_intermedios},
+            tuple(fontes_vetoriais(regiao.shapefile)),
+            persistir=False,
+        ),
+        Etapa("grelha", grelha_e_mes, ("recorte",)),
+        Etapa("fpar", fpar, ("recorte",), {"guardar_intermedios": guardar_intermedios}),
+        Etapa("wsc", wsc, ("recorte",), {"guardar_intermedios": guardar_intermedios}),
+        Etapa(
+            "t1_t2",
+            temperatura,
+            ("download",),
+            {"guardar_intermedios": guardar_intermedios},
+        ),
+        Etapa(
+            "sol",
+            sol,
+            ("grelha",),
+            {
+                "ano_referencia": ANO_REFERENCIA,
+                "var_pct_mes": VAR_PCT_MES,
+                "fator_conversao": FATOR_CONVERSAO,
+                "resolucao_solar": RESOLUCAO_SOLAR,
+                "guardar_intermedios": guardar_intermedios,
+            },
+            (regiao.ghi, regiao.wkt_quadrado),
+        ),
+        Etapa(
+            "emax",
+            emax,
+            ("grelha",),
+            {
+                "tabela_epsilon": TABELA_EPSILON,
+                "guardar_intermedios": guardar_intermedios,
+            },
+            tuple(mosaicos),
+        ),
+        Etapa("npp", npp, ("grelha", "fpar", "wsc", "t1_t2", "sol", "emax")),
+        Etapa(
+            "analise",
+            analise,
+            ("grelha", "npp"),
+            {
+                "populacao": POPULACAO,
+                "emissoes_co2_per_capita": EMISSOES_CO2_PER_CAPITA,
+                "fator_conversao": FATOR_CONVERSAO,
+                "descricao": regiao.descricao,
+                "zonas": regiao.zonas,
+                "cubo": cubo,
+            },
+            tuple(mosaicos) + tuple(fontes_zonas),
+        ),
+    ]
+
+
+def main(
+    ano: int,
+    mes: int,
+    guardar_intermedios: bool = False,
+    diretoria_trabalho: Path = None,
+    camadas_estaticas: dict = None,
+    regiao="OEIRAS",
+    downloads_partilhados: dict = None,
+    usar_cache_camadas: bool = True,
+    cubo=True,
+    retomar: bool = True,
+    instrumentar: bool = False,
+    perfilar: bool = False,
+    linhas_bloco: int = None,
+    progresso=None,
+    cancelamento=None,
+):
+    """
+    Executa o processamento completo de um mês
+
+    O mês é processado como um grafo de etapas (ver etapas_do_mes): download,
+    recorte, grelha, FPAR, WSC, T1/T2, SOL, E_max, NPP e análise. Cada etapa
+    fica registada em OUTPUTS/ETAPAS/manifesto.json com o hash dos seus
+    parâmetros, ficheiros de entrada e dependências, e as suas saídas são
+    guardadas (exceto as do recorte, refeito do ORIGINAL.tif quando FPAR,
+    WSC ou a grelha têm de correr); voltar a correr o mesmo mês só refaz as
+    etapas que falharam ou cujas entradas mudaram (ex.: alterar var_pct_mes
+    refaz só SOL, NPP e análise). retomar=False ignora o manifesto e refaz
+    todas as etapas.
+
+    Por omissão os parâmetros intermédios (NDVI, FPAR, WSC, T1/T2, SOL, E_max)
+    passam entre etapas em memória; com guardar_intermedios=True são também
+    escritos em OUTPUTS, como anteriormente.
+
+    diretoria_trabalho: onde ficam INPUTS/SENTINEL2|3, OUTPUTS e RESULT deste
+    mês (por omissão a diretoria do projeto). camadas_estaticas: resultado de
+    preparar_camadas_estaticas, para não recalcular E_max, o recorte do GHI e
+    a geometria do shapefile (o E_max só é reutilizado se a grelha coincidir).
+
+    regiao: nome no registo de regiões (ver regioes.REGIOES) ou um Regiao, de
+    onde vêm o shapefile, a extensão, a população e as entradas estáticas.
+    downloads_partilhados: {produto: (GeoTIFF, data inicial)} já descarregados
+    para um grupo de regiões sobrepostas; cada produto é recortado para a
+    extensão desta região em vez de voltar a ser pedido ao openEO.
+    usar_cache_camadas: ler o GHI recortado e o E_max da cache de camadas
+    estáticas (calculados e guardados na primeira execução).
+    cubo: cubo Zarr onde o mês é acrescentado (ver parametros.cubo_resultados);
+    True para Resultados/<REGIAO>/CUBO_NPP.zarr, None para não o atualizar.
+    instrumentar: mede tempo, CPU, memória, I/O e pixeis de cada etapa e
+    função de cálculo e escreve RESULT/RELATORIO_EXECUCAO.json (ver
+    parametros.instrumentacao); com perfilar, guarda também um perfil
+    cProfile por etapa em RESULT/PERFIS.
+    linhas_bloco: calcula NDVI/FPAR e WSC por blocos desse número de linhas,
+    com normalização global em duas passagens (mesmo resultado, menos
+    memória de pico em rasters grandes).
+    progresso e cancelamento: ver etapas.executar_etapas (usados pelo gestor
+    de trabalhos da interface, ver trabalhos.py).
+
+    Retorna:
+    dict: Resultados de analisar_npp
+
+    Lança:
+    FalhaEtapa: se uma etapa falhar (antes terminava com sys.exit(1))
+    ExecucaoCancelada: se cancelamento for ativado entre etapas
+    """
+    projeto_dir = Path(__file__).parent.resolve()
+    trabalho_dir = Path(diretoria_trabalho) if diretoria_trabalho else projeto_dir
+    regiao = obter_regiao(regiao)
+    logger.info(f"Diretoria do projeto: {projeto_dir} (regiao {regiao.nome})")
+
+    if cubo is True:
+        cubo = projeto_dir / "Resultados" / regiao.nome / NOME_CUBO
+
+    etapas = etapas_do_mes(
+        ano,
+        mes,
+        trabalho_dir,
+        regiao,
+        guardar_intermedios=guardar_intermedios,
+        camadas_estaticas=camadas_estaticas,
+        downloads_partilhados=downloads_partilhados,
+        usar_cache_camadas=usar_cache_camadas,
+        cubo=cubo,
+        linhas_bloco=linhas_bloco,
+    )
+    if instrumentar or perfilar:
+        instrumentacao.ativar(perfilar, trabalho_dir / "RESULT" / "PERFIS")
+    try:
+        saidas = executar_etapas(
+            etapas,
+            trabalho_dir / "OUTPUTS" / "ETAPAS",
+            refazer=not retomar,
+            progresso=progresso,
+            cancelamento=cancelamento,
+        )
+    finally:
+        if instrumentacao.ativa():
+            instrumentacao.escrever_relatorio(
+                trabalho_dir / "RESULT" / "RELATORIO_EXECUCAO.json",
+                ano=ano,
+                mes=mes,
+                regiao=regiao.nome,
+            )
+            instrumentacao.desativar()
+
+    logger.info("Processo completo com sucesso!")
+    return saidas["analise"]
+
+
+def _processar_mes(ano: int, mes: int, diretoria_trabalho: Path, **kwargs):
+    """Executa main num processo de trabalho e devolve os resultados do mês"""
+    configurar_logging()
+    logger.info(f"--- A processar {mes:02d}/{ano} em {diretoria_trabalho} ---")
+    return main(ano, mes, diretoria_trabalho=diretoria_trabalho, **kwargs)
+
+
+def executar_intervalo(
+    inicio: str,
+    fim: str,
+    max_processos: int = None,
+    guardar_intermedios: bool = False,
+    resultados_base: Path = None,
+    regiao="OEIRAS",
+    retomar: bool = True,
+    instrumentar: bool = False,
+    perfilar: bool = False,
+    linhas_bloco: int = None,
+) -> dict:
+    """
+    Processa todos os meses de inicio a fim (AAAA-MM), em paralelo
+
+    As camadas que não dependem do mês (geometria do shapefile, recorte do
+    GHI e E_max) são calculadas uma única vez; a grelha do E_max é a do
+    Sentinel-2 recortado do primeiro mês, descarregado aqui (os processos
+    de cada mês reutilizam esse download através da cache de downloads).
+    Cada mês corre num processo próprio e escreve em
+    resultados_base/<ano>.RESULTS.BY.MONTH/<mes>.<REGIAO>; à medida que os
+    meses terminam, o processo principal acrescenta-os (um de cada vez) ao
+    cubo resultados_base/CUBO_NPP.zarr.
+
+    Retorna:
+    dict: (ano, mes) -> resultados de analisar_npp, ou a exceção do mês
+    """
+    projeto_dir = Path(__file__).parent.resolve()
+    regiao = obter_regiao(regiao)
+    resultados_base = Path(resultados_base or projeto_dir / "Resultados" / regiao.nome)
+    meses = meses_entre(inicio, fim)
+
+    def diretoria_mes(ano, mes):
+        return resultados_base / f"{ano}.RESULTS.BY.MONTH" / f"{mes:02d}.{regiao.nome}"
+
+    # Camadas estáticas: geometria primeiro (necessária ao recorte do S2)
+    geometria = carregar_geometria_shapefile(str(regiao.shapefile))
+
+    ano0, mes0 = meses[0]
+    s2_dir = diretoria_mes(ano0, mes0) / "INPUTS" / "SENTINEL2"
+    s2_dir.mkdir(parents=True, exist_ok=True)
+    _, s2_recortado = descarregar_e_recortar(
+        descricao="Sentinel-2 (grelha de referencia)",
+        geojson_file=escrever_geojson_regiao(
+            regiao,
+            diretoria_mes(ano0, mes0) / "INPUTS" / f"coordenadas_{regiao.nome}.txt",
+        ),
+        shapefile_path=regiao.shapefile,
+        original=s2_dir / "Sentinel2_B04_B08_B11_B12_ORIGINAL.tif",
+        masked=None,
+        intervalos=intervalos_do_mes(ano0, mes0),
+        geometria=geometria,
+        **PRODUTOS_SENTINEL["Sentinel-2"],
+    )
+    estaticas = preparar_camadas_estaticas(
+        projeto_dir, grelha_de_raster(s2_recortado), geometria, regiao
+    )
+
+    resultados = {}
+    with ProcessPoolExecutor(max_workers=max_processos) as pool:
+        futuros = {
+            (ano, mes): pool.submit(
+                _processar_mes,
+                ano,
+                mes,
+                diretoria_mes(ano, mes),
+                guardar_intermedios=guardar_intermedios,
+                camadas_estaticas=estaticas,
+                regiao=regiao,
+                cubo=None,
+                retomar=retomar,
+                instrumentar=instrumentar,
+                perfilar=perfilar,
+                linhas_bloco=linhas_bloco,
+            )
+            for ano, mes in meses
+        }
+        cubo = CuboResultados(resultados_base / NOME_CUBO)
+        for (ano, mes), futuro in futuros.items():
+            try:
+                resultados[(ano, mes)] = futuro.result()
+                logger.info(f"Mes {mes:02d}/{ano} concluido")
+            except Exception as e:
+                # main lança FalhaEtapa numa etapa falhada
+                logger.error(f"FALHA no mes {mes:02d}/{ano}: {e!r}")
+                resultados[(ano, mes)] = e
+                continue
+
+            try:
+                cubo.acrescentar_mes(
+                    ano, mes, resultados[(ano, mes)]["npp"], regiao=regiao.nome
+                )
+            except Exception as e:
+                logger.warning(f"Mes {mes:02d}/{ano} nao acrescentado ao cubo: {e}")
+
+    return resultados
+
+
+def descarregar_grupo(regioes: list, ano: int, mes: int, destino_dir: Path) -> dict:
+    """
+    Descarrega uma única vez os produtos do mês para um grupo de regiões
+
+    O pedido cobre o retângulo que envolve todas as regiões do grupo (ver
+    regioes.agrupar_sobrepostas).
+
+    Retorna:
+    dict: {produto: (GeoTIFF partilhado, data inicial do intervalo usado)}
+    """
+    geojson_file = escrever_geojson_envolvente(
+        regioes, destino_dir / "coordenadas_grupo.txt"
+    )
+    with ThreadPoolExecutor(max_workers=len(PRODUTOS_SENTINEL)) as pool:
+        futuros = {
+            nome: pool.submit(
+                descarregar_e_recortar,
+                descricao=f"{nome} (partilhado)",
+                geojson_file=geojson_file,
+                shapefile_path=None,
+                original=destino_dir / f"{nome.replace(' ', '_')}_PARTILHADO.tif",
+                masked=None,
+                intervalos=intervalos_do_mes(ano, mes),
+                recortar=False,
+                **params,
+            )
+            for nome, params in PRODUTOS_SENTINEL.items()
+        }
+    return {
+        nome: (
+            destino_dir / f"{nome.replace(' ', '_')}_PARTILHADO.tif",
+            futuro.result()[0],
+        )
+        for nome, futuro in futuros.items()
+    }
+
+
+def _processar_regiao(ano: int, mes: int, nome_regiao: str, **kwargs):
+    """Executa main de uma região num processo de trabalho"""
+    configurar_logging()
+    logger.info(f"--- A processar {nome_regiao} ({mes:02d}/{ano}) ---")
+    return main(ano, mes, regiao=nome_regiao, **kwargs)
+
+
+def executar_regioes(
+    ano: int,
+    mes: int,
+    regioes: list = None,
+    max_processos: int = None,
+    guardar_intermedios: bool = False,
+    resultados_base: Path = None,
+    retomar: bool = True,
+    instrumentar: bool = False,
+    perfilar: bool = False,
+    linhas_bloco: int = None,
+) -> dict:
+    """
+    Processa um mês para várias regiões em paralelo (uma por processo)
+
+    As regiões cujos retângulos envolventes se sobrepõem (ex.: Oeiras e
+    Monsanto) partilham um único download por produto, feito aqui sobre a
+    extensão conjunta; cada região recorta-o depois para a sua extensão.
+    Cada região escreve em
+    resultados_base/<REGIAO>/<ano>.RESULTS.BY.MONTH/<mes>.<REGIAO> e
+    acrescenta o mês ao cubo resultados_base/<REGIAO>/CUBO_NPP.zarr.
+
+    Retorna:
+    dict: nome da região -> resultados de analisar_npp, ou a exceção da região
+    """
+    projeto_dir = Path(__file__).parent.resolve()
+    resultados_base = Path(resultados_base or projeto_dir / "Resultados")
+    regioes = [obter_regiao(r) for r in (regioes or REGIOES)]
+
+    resultados = {}
+    trabalhos = []  # (regiao, downloads_partilhados)
+    for grupo in agrupar_sobrepostas(regioes):
+        if len(grupo) == 1:
+            trabalhos.append((grupo[0], None))
+            continue
+
+        nomes = "_".join(r.nome for r in grupo)
+        logger.info(f"Regioes sobrepostas, download partilhado: {nomes}")
+        try:
+            partilhados = descarregar_grupo(
+                grupo,
+                ano,
+                mes,
+                resultados_base / "PARTILHADO" / f"{ano}-{mes:02d}.{nomes}",
+            )
+        except Exception as e:
+            logger.error(f"FALHA no download partilhado ({nomes}): {e!r}")
+            for regiao in grupo:
+                resultados[regiao.nome] = e
+            continue
+        trabalhos.extend((regiao, partilhados) for regiao in grupo)
+
+    with ProcessPoolExecutor(max_workers=max_processos) as pool:
+        futuros = {
+            regiao.nome: pool.submit(
+                _processar_regiao,
+                ano,
+                mes,
+                regiao.nome,
+                diretoria_trabalho=resultados_base
+                / regiao.nome
+                / f"{ano}.RESULTS.BY.MONTH"
+                / f"{mes:02d}.{regiao.nome}",
+                guardar_intermedios=guardar_intermedios,
+                downloads_partilhados=partilhados,
+                cubo=resultados_base / regiao.nome / NOME_CUBO,
+                retomar=retomar,
+                instrumentar=instrumentar,
+                perfilar=perfilar,
+                linhas_bloco=linhas_bloco,
+            )
+            for regiao, partilhados in trabalhos
+        }
+        for nome, futuro in futuros.items():
+            try:
+                resultados[nome] = futuro.result()
+                logger.info(f"Regiao {nome} concluida")
+            except Exception as e:
+                # main lança FalhaEtapa numa etapa falhada
+                logger.error(f"FALHA na regiao {nome}: {e!r}")
+                resultados[nome] = e
+
+    return resultados
+
+
+if __name__ == "__main__":
+    configurar_logging()
+    parser = argparse.ArgumentParser(description="Calculadora de absorção de CO₂")
+    parser.add_argument("inicio", help="mês a processar, ou primeiro mês (AAAA-MM)")
+    parser.add_argument("fim", nargs="?", help="último mês do intervalo (AAAA-MM)")
+    parser.add_argument("--processos", type=int, default=None)
+    parser.add_argument("--guardar-intermedios", action="store_true")
+    parser.add_argument(
+        "--refazer",
+        action="store_true",
+        help="ignora o manifesto de etapas e refaz todas as etapas",
+    )
+    parser.add_argument(
+        "--instrumentar",
+        action="store_true",
+        help="escreve RESULT/RELATORIO_EXECUCAO.json com tempos, memória e I/O",
+    )
+    parser.add_argument(
+        "--perfilar",
+        action="store_true",
+        help="como --instrumentar, com um perfil cProfile por etapa",
+    )
+    parser.add_argument(
+        "--linhas-bloco",
+        type=int,
+        default=None,
+        help="calcula FPAR e WSC por blocos deste número de linhas (rasters grandes)",
+    )
+    parser.add_argument(
+        "--backend-local",
+        nargs="?",
+        const="{}",
+        metavar="OPCOES_JSON",
+        help="usa o backend openEO local (sintético, sem rede); opções de "
+        'openeo_local.ConexaoLocal em JSON, ex.: \'{"latencia": 2, "taxa_falhas": 0.1}\'',
+    )
+    parser.add_argument(
+        "--regioes",
+        nargs="+",
+        default=["OEIRAS"],
+        help=f"regiões a processar ({', '.join(REGIOES)}; 'todas' para todas)",
+    )
+    args = parser.parse_args()
+    regioes = list(REGIOES) if args.regioes == ["todas"] else args.regioes
+    if args.backend_local is not None:
+        from openeo_local import ativar_backend_local
+
+        ativar_backend_local(**json.loads(args.backend_local))
+
+    try:
+        if args.fim:
+            for regiao in regioes:
+                executar_intervalo(
+                    args.inicio,
+                    args.fim,
+                    max_processos=args.processos,
+                    guardar_intermedios=args.guardar_intermedios,
+                    regiao=regiao,
+                    retomar=not args.refazer,
+                    instrumentar=args.instrumentar,
+                    perfilar=args.perfilar,
+                    linhas_bloco=args.linhas_bloco,
+                )
+        elif len(regioes) > 1:
+            ano, mes = map(int, args.inicio.split("-"))
+            executar_regioes(
+                ano,
+                mes,
+                regioes,
+                max_processos=args.processos,
+                guardar_intermedios=args.guardar_intermedios,
+                retomar=not args.refazer,
+                instrumentar=args.instrumentar,
+                perfilar=args.perfilar,
+                linhas_bloco=args.linhas_bloco,
+            )
+        else:
+            ano, mes = map(int, args.inicio.split("-"))
+            main(
+                ano,
+                mes,
+                guardar_intermedios=args.guardar_intermedios,
+                regiao=regioes[0],
+                retomar=not args.refazer,
+                instrumentar=args.instrumentar,
+                perfilar=args.perfilar,
+                linhas_bloco=args.linhas_bloco,
+            )
+    except FalhaEtapa as e:
+        logger.error(f"{e} (volte a correr para retomar a partir desta etapa)")
+        sys.exit(1)
+    except Exception as e:
+        logger.error(f"ERRO NÃO TRATADO: {str(e)}")
+        logger.error(traceback.format_exc())
+        sys.exit(1)
@@ -0,0 +1,519 @@
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from openeo.rest import OpenEoApiError
+from rasterio.transform import from_bounds
+from rasterio.warp import transform_bounds
+from shapely.geometry import shape
+
+from Download import (
+    VARIAVEL_BACKEND_LOCAL,
+    SessaoOpenEO,
+    definir_sessao,
+    parametros_pedido,
+)
+from cache_downloads import CacheDownloads
+
+logger = logging.getLogger(__name__)
+
+# URL da sessão local (entra na chave da cache de downloads, ver parametros_pedido)
+URL_LOCAL = "local"
+
+# Resolução dos compósitos sintéticos: Sentinel-2 em UTM (m), LST em graus
+RESOLUCAO_S2 = 10.0
+RESOLUCAO_S3 = 0.01
+
+# Temperatura média (K) do LST sintético por passagem
+LST_MEDIA = {"day": 303.0, "night": 290.0, "both": 296.0}
+
+
+class ConexaoLocal:
+    """
+    Substituto local de uma ligação openEO, sem rede nem credenciais
+
+    Implementa a parte da API usada por construir_composicao, download_sentinel_data
+    e backfill_openeo (load_collection, filtros, máscara, redução, download
+    síncrono e batch jobs). Cada compósito pedido é servido a partir de uma
+    gravação (GeoTIFF de uma cache de downloads real em gravacoes, para a
+    mesma coleção, geometria, bandas, nuvens, intervalo e dia/noite) ou, na
+    falta dela, gerado de forma sintética e determinística para a extensão e
+    as bandas pedidas.
+
+    latencia (s, mais até variacao_latencia) é aplicada a cada download;
+    taxa_falhas é a probabilidade de um pedido falhar com codigo_falha (ex.:
+    500, ou 401 para exercitar a renovação da autenticação) e
+    falhar_intervalos as datas iniciais de intervalos sem dados (para
+    exercitar o intervalo alternativo). Latências e falhas dependem apenas de
+    semente, do pedido e do número da tentativa, pelo que se repetem de
+    execução para execução independentemente da ordem das threads.
+    """
+
+    def __init__(
+        self,
+        gravacoes: Path = None,
+        latencia: float = 0.0,
+        variacao_latencia: float = 0.0,
+        taxa_falhas: float = 0.0,
+        codigo_falha: int = 500,
+        falhar_intervalos: list = (),
+        semente: int = 0,
+    ):
+        self.gravacoes = CacheDownloads(gravacoes) if gravacoes else None
+        self.latencia = latencia
+        self.variacao_latencia = variacao_latencia
+        self.taxa_falhas = taxa_falhas
+        self.codigo_falha = codigo_falha
+        self.falhar_intervalos = set(falhar_intervalos)
+        self.semente = semente
+        self._lock = threading.Lock()
+        self._tentativas = {}
+        self._jobs = {}
+        self._ids_jobs = itertools.count(1)
+        self._ativos = 0
+        self._estatisticas = {
+            "pedidos": 0,
+            "falhas": 0,
+            "gravados": 0,
+            "sinteticos": 0,
+            "bytes": 0,
+            "simultaneos_max": 0,
+        }
+
+    def load_collection(
+        self,
+        collection_id,
+        temporal_extent=None,
+        spatial_extent=None,
+        bands=None,
+        properties=None,
+        **_,
+    ):
+        # O filtro de nuvens é uma função (v <= limite): recuperar o limite
+        filtro = (properties or {}).get("eo:cloud_cover")
+        nuvens = (
+            max((v for v in range(101) if filtro(v)), default=None) if filtro else None
+        )
+        return ComposicaoLocal(
+            self,
+            {
+                "colecao": collection_id,
+                "intervalo": list(temporal_extent or ()),
+                "geometria": spatial_extent,
+                "bandas": list(bands or ()),
+                "nuvens": nuvens,
+                "dia_noite": "both",
+            },
+        )
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs[job_id]
+
+    def estatisticas(self) -> dict:
+        """Contagens de pedidos, falhas, origem dos compósitos e concorrência máxima"""
+        with self._lock:
+            return dict(self._estatisticas)
+
+    def _criar_job(self, pedido: dict):
+        with self._lock:
+            job = JobLocal(f"local-{next(self._ids_jobs)}", self, pedido)
+            self._jobs[job.job_id] = job
+            return job
+
+    def _servir(self, pedido: dict, destino: Path):
+        """Aplica a latência e as falhas configuradas e escreve o compósito"""
+        chave = _chave_pedido(pedido)
+        with self._lock:
+            tentativa = self._tentativas.get(chave, 0)
+            self._tentativas[chave] = tentativa + 1
+            self._estatisticas["pedidos"] += 1
+            self._ativos += 1
+            self._estatisticas["simultaneos_max"] = max(
+                self._estatisticas["simultaneos_max"], self._ativos
+            )
+        try:
+            rng = np.random.default_rng(_semente(self.semente, chave, tentativa))
+            time.sleep(self.latencia + self.variacao_latencia * rng.random())
+            if pedido["intervalo"][0] in self.falhar_intervalos:
+                self._falhar(
+                    400, "NoDataAvailable", f"Sem dados em {pedido['intervalo']}"
+                )
+            if rng.random() < self.taxa_falhas:
+                self._falhar(
+                    self.codigo_falha,
+                    "FalhaSimulada",
+                    f"Falha simulada (tentativa {tentativa + 1})",
+                )
+
+            destino = Path(destino)
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            gravado = self._gravacao(pedido)
+            if gravado is not None:
+                shutil.copyfile(gravado, destino)
+                origem = "gravados"
+            else:
+                escrever_composicao_sintetica(pedido, destino, self.semente)
+                origem = "sinteticos"
+            with self._lock:
+                self._estatisticas[origem] += 1
+                self._estatisticas["bytes"] += destino.stat().st_size
+        finally:
+            with self._lock:
+                self._ativos -= 1
+
+    def _falhar(self, codigo: int, erro: str, mensagem: str):
+        with self._lock:
+            self._estatisticas["falhas"] += 1
+        raise OpenEoApiError(http_status_code=codigo, code=erro, message=mensagem)
+
+    def _gravacao(self, pedido: dict):
+        """GeoTIFF gravado (cache de downloads real) para o mesmo pedido, se existir"""
+        if self.gravacoes is None:
+            return None
+        versao = 2 if pedido["colecao"] == "SENTINEL2_L2A" else 3
+        parametros = parametros_pedido(
+            versao,
+            pedido.get("nuvens"),
+            pedido["bandas"],
+            pedido["intervalo"],
+            pedido["dia_noite"],
+        )
+        return self.gravacoes.obter(
+            self.gravacoes.chave(geometria=pedido["geometria"], **parametros)
+        )
+
+
+class ComposicaoLocal:
+    """Datacube local: regista os filtros do pedido e serve-o em download"""
+
+    def __init__(self, conexao: ConexaoLocal, pedido: dict):
+        self._conexao = conexao
+        self.pedido = pedido
+
+    def _com(self, **alteracoes):
+        return ComposicaoLocal(self._conexao, dict(self.pedido, **alteracoes))
+
+    def filter_temporal(self, start_date=None, end_date=None, **_):
+        # Passagem diurna (06:00-19:00 UTC) ou noturna, como em construir_composicao
+        dia_noite = "day" if str(start_date).endswith("T06:00:00Z") else "night"
+        return self._com(dia_noite=dia_noite)
+
+    def filter_bands(self, bands):
+        return self._com(bandas=list(bands))
+
+    def band(self, nome):
+        return _ExpressaoLocal()
+
+    def mask(self, mascara):
+        return self._com(mascara=True)
+
+    def reduce_dimension(self, dimension, reducer):
+        return self._com(reducao=reducer)
+
+    def download(self, outputfile, format="GTiff", options=None):
+        self._conexao._servir(self.pedido, outputfile)
+
+    def create_job(self, out_format="GTiff", title=None, **opcoes):
+        return self._conexao._criar_job(self.pedido)
+
+
+class JobLocal:
+    """Batch job local: termina latencia segundos depois de arrancar"""
+
+    def __init__(self, job_id: str, conexao: ConexaoLocal, pedido: dict):
+        self.job_id = job_id
+        self._conexao = conexao
+        self._pedido = pedido
+        self._ficheiro = None
+        self._erro = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._executar, daemon=True)
+        self._thread.start()
+        return self
+
+    def _executar(self):
+        self._ficheiro = Path(
+            os.path.join(_diretoria_jobs(), f"{self.job_id}_{os.getpid()}.tif")
+        )
+        try:
+            self._conexao._servir(self._pedido, self._ficheiro)
+        except OpenEoApiError as e:
+            self._erro = e
+
+    def status(self) -> str:
+        if self._thread is None:
+            return "created"
+        if self._thread.is_alive():
+            return "running"
+        return "error" if self._erro is not None else "finished"
+
+    def get_results(self):
+        return self
+
+    def download_file(self, destino):
+        destino = Path(destino)
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(self._ficheiro, destino)
+        return destino
+
+
+class _ExpressaoLocal:
+    """Expressão de banda (máscara de qualidade), aceite e ignorada"""
+
+    def __and__(self, outro):
+        return self
+
+    __rand__ = __and__
+
+    def __eq__(self, outro):
+        return self
+
+    __hash__ = object.__hash__
+
+
+def escrever_composicao_sintetica(pedido: dict, destino: Path, semente: int = 0):
+    """
+    Escreve um compósito sintético para a extensão, bandas e passagem pedidas
+
+    Sentinel-2: uint16 (reflectância x10000) em UTM a 10 m, uma banda por
+    banda pedida, com o nome da banda. LST do Sentinel-3: float32 (K) em
+    EPSG:4326 a ~1 km. Os valores dependem só da semente e do pedido.
+    """
+    oeste, sul, este, norte = _limites(pedido["geometria"])
+    rng = np.random.default_rng(_semente(semente, _chave_pedido(pedido), "dados"))
+    bandas = pedido["bandas"]
+
+    if pedido["colecao"] == "SENTINEL2_L2A":
+        zona = int((oeste + este) / 2 + 180) // 6 + 1
+        crs = f"EPSG:{(32600 if sul >= 0 else 32700) + zona}"
+        limites = transform_bounds("EPSG:4326", crs, oeste, sul, este, norte)
+        largura = max(1, math.ceil((limites[2] - limites[0]) / RESOLUCAO_S2))
+        altura = max(1, math.ceil((limites[3] - limites[1]) / RESOLUCAO_S2))
+        limites = (
+            limites[0],
+            limites[3] - altura * RESOLUCAO_S2,
+            limites[0] + largura * RESOLUCAO_S2,
+            limites[3],
+        )
+        # Vermelho baixo e infravermelho próximo alto: NDVI de vegetação
+        intervalos = {"B04": (300, 1500), "B08": (1500, 4000)}
+        dados = np.stack(
+            [
+                rng.integers(*intervalos.get(banda, (500, 3000)), (altura, largura))
+                for banda in bandas
+            ]
+        ).astype(np.uint16)
+        perfil = {"dtype": "uint16", "nodata": 0}
+    else:
+        crs = "EPSG:4326"
+        largura = max(1, math.ceil((este - oeste) / RESOLUCAO_S3))
+        altura = max(1, math.ceil((norte - sul) / RESOLUCAO_S3))
+        limites = (oeste, sul, este, norte)
+        media = LST_MEDIA.get(pedido["dia_noite"], LST_MEDIA["both"])
+        dados = rng.normal(media, 3.0, (len(bandas), altura, largura)).astype(
+            np.float32
+        )
+        perfil = {"dtype": "float32", "nodata": None}
+
+    perfil.update(
+        driver="GTiff",
+        width=largura,
+        height=altura,
+        count=len(bandas),
+        crs=crs,
+        transform=from_bounds(*limites, largura, altura),
+    )
+    with rasterio.open(destino, "w", **perfil) as dst:
+        dst.write(dados)
+        dst.descriptions = tuple(bandas)
+    return destino
+
+
+def sessao_local(**opcoes) -> SessaoOpenEO:
+    """
+    Sessão openEO servida por uma ConexaoLocal (opcoes: ver ConexaoLocal)
+
+    A mesma ligação é reutilizada quando a sessão renova a autenticação, pelo
+    que as estatísticas e as tentativas de cada pedido se mantêm.
+    """
+    conexao = ConexaoLocal(**opcoes)
+    return SessaoOpenEO(URL_LOCAL, fabrica_conexao=lambda url: conexao)
+
+
+def ativar_backend_local(**opcoes) -> SessaoOpenEO:
+    """
+    Usa o backend local em todos os downloads deste processo e dos seus
+    processos de trabalho (através de VARIAVEL_BACKEND_LOCAL)
+    """
+    os.environ[VARIAVEL_BACKEND_LOCAL] = json.dumps(opcoes, default=str)
+    sessao = sessao_local(**opcoes)
+    definir_sessao(sessao)
+    logger.info(f"Backend openEO local ativo: {opcoes}")
+    return sessao
+
+
+def _limites(geometria: dict) -> tuple:
+    if geometria.get("type") == "FeatureCollection":
+        geometrias = [shape(f["geometry"]) for f in geometria["features"]]
+    elif geometria.get("type") == "Feature":
+        geometrias = [shape(geometria["geometry"])]
+    else:
+        geometrias = [shape(geometria)]
+    limites = np.array([g.bounds for g in geometrias])
+    return (
+        limites[:, 0].min(),
+        limites[:, 1].min(),
+        limites[:, 2].max(),
+        limites[:, 3].max(),
+    )
+
+
+def _chave_pedido(pedido: dict) -> str:
+    texto = json.dumps(
+        {
+            k: pedido.get(k)
+            for k in (
+                "colecao",
+                "intervalo",
+                "geometria",
+                "bandas",
+                "nuvens",
+                "dia_noite",
+            )
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+def _semente(semente: int, chave: str, extra) -> int:
+    texto = f"{semente}:{chave}:{extra}"
+    return int.from_bytes(hashlib.sha256(texto.encode("utf-8")).digest()[:8], "little")
+
+
+def _diretoria_jobs() -> Path:
+    diretoria = Path(__file__).parent.resolve() / "CACHE" / "openeo_local"
+    diretoria.mkdir(parents=True, exist_ok=True)
+    return diretoria
+
+
+def teste_carga(
+    meses: list,
+    geojson_file: Path,
+    destino_dir: Path,
+    max_threads: int = 3,
+    cache: Path = None,
+    **opcoes,
+) -> dict:
+    """
+    Descarrega todos os produtos dos meses pelo backend local, com o
+    intervalo alternativo de main.descarregar_e_recortar, e mede o tempo
+
+    Com cache, os pedidos passam pela cache de downloads nessa diretoria
+    (corra duas vezes para medir os acertos); sem ela é usada uma cache
+    vazia, temporária.
+
+    Retorna:
+    dict: Duração, pedidos concluídos e falhados e estatísticas da ligação
+    """
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    from Download import PRODUTOS_SENTINEL, intervalos_do_mes
+    from cache_downloads import definir_cache
+    from main import descarregar_e_recortar
+
+    sessao = ativar_backend_local(**opcoes)
+    definir_cache(CacheDownloads(cache or tempfile.mkdtemp(prefix="cache_carga_")))
+    destino_dir = Path(destino_dir)
+
+    def descarregar(ano, mes, nome, params):
+        return descarregar_e_recortar(
+            descricao=f"{nome} {ano}-{mes:02d}",
+            geojson_file=geojson_file,
+            shapefile_path=None,
+            original=destino_dir / f"{ano}-{mes:02d}_{nome.replace(' ', '_')}.tif",
+            masked=None,
+            intervalos=intervalos_do_mes(ano, mes),
+            recortar=False,
+            **params,
+        )
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_threads) as pool:
+        futuros = [
+            pool.submit(descarregar, ano, mes, nome, params)
+            for ano, mes in meses
+            for nome, params in PRODUTOS_SENTINEL.items()
+        ]
+        erros = [futuro.exception() for futuro in futuros]
+
+    return {
+        "duracao_s": round(time.perf_counter() - inicio, 3),
+        "concluidos": sum(e is None for e in erros),
+        "falhados": sum(e is not None for e in erros),
+        **sessao.conexao().estatisticas(),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    projeto_dir = Path(__file__).parent.resolve()
+
+    parser = argparse.ArgumentParser(
+        description="Teste de carga da camada de download com o backend openEO local"
+    )
+    parser.add_argument("inicio", help="primeiro mês (AAAA-MM)")
+    parser.add_argument("fim", help="último mês (AAAA-MM)")
+    parser.add_argument("--geojson", type=Path, default=projeto_dir / "coordenadas.txt")
+    parser.add_argument(
+        "--destino", type=Path, default=projeto_dir / "CACHE" / "openeo_local" / "carga"
+    )
+    parser.add_argument("--threads", type=int, default=3)
+    parser.add_argument("--cache", type=Path, help="diretoria da cache de downloads")
+    parser.add_argument(
+        "--gravacoes", type=Path, help="cache de downloads real a reproduzir"
+    )
+    parser.add_argument("--latencia", type=float, default=0.5)
+    parser.add_argument("--variacao-latencia", type=float, default=0.5)
+    parser.add_argument("--taxa-falhas", type=float, default=0.0)
+    parser.add_argument("--codigo-falha", type=int, default=500)
+    parser.add_argument("--falhar-intervalos", nargs="*", default=[])
+    parser.add_argument("--semente", type=int, default=0)
+    args = parser.parse_args()
+
+    from Download import meses_entre
+
+    resultado = teste_carga(
+        meses_entre(args.inicio, args.fim),
+        args.geojson,
+        args.destino,
+        max_threads=args.threads,
+        cache=args.cache,
+        gravacoes=args.gravacoes,
+        latencia=args.latencia,
+        variacao_latencia=args.variacao_latencia,
+        taxa_falhas=args.taxa_falhas,
+        codigo_falha=args.codigo_falha,
+        falhar_intervalos=args.falhar_intervalos,
+        semente=args.semente,
+    )
+    print(json.dumps(resultado, indent=2))
@@ -1,96 +1,234 @@
-import numpy as np
-import rasterio
-from rasterio.warp import reproject, Resampling
-from rasterio.transform import Affine
-from pathlib import Path
-
-
-def calcular_emax(
-    caminho_entrada: Path,
-    caminho_saida: Path,
-    nova_largura: int,
-    nova_altura: int,
-    substituicoes: dict = None,
-    metodo_reamostragem: Resampling = Resampling.nearest,
-) -> None:
-    """
-    Processamento de um raster de uso do solo para introduzir valores de eficiência (Emax)
-    com redimensionamento e conversão de classes.
-
-    Parâmetros:
-    caminho_entrada (Path): Caminho para o raster de entrada (ex: ESA WorldCover)
-    caminho_saida (Path): Caminho para salvar o raster resultante
-    nova_largura (int): Número de colunas do raster de saída
-    nova_altura (int): Número de linhas do raster de saída
-    substituicoes (dict): Dicionário de mapeamento classe->eficiência (padrão: tabela ESA)
-    metodo_reamostragem (Resampling): Método de reamostragem (padrão: nearest neighbor)
-    """
-
-    # Tabela padrão de eficiência
-    tabela_epsilon = substituicoes or {
-        10: 1.0,  # treecover
-        20: 0.7,  # shrubland
-        30: 1.04,  # grassland
-        40: 0.9,  # cropland
-        60: 0.25,  # bare/sparse vegetation
-    }
-
-    with rasterio.open(caminho_entrada) as src:
-        src_data = src.read(1)
-        src_transform = src.transform
-        src_crs = src.crs
-        src_nodata = src.nodata
-        perfil = src.profile.copy()
-
-        # Calcula nova resolução espacial
-        pixel_x = src_transform.a * src.width / nova_largura
-        pixel_y = -src_transform.e * src.height / nova_altura
-        nova_transform = Affine(
-            pixel_x, 0, src_transform.c, 0, -pixel_y, src_transform.f
-        )
-
-        # Prepara array para dados redimensionados
-        nodata_valor = src_nodata if src_nodata is not None else 0
-        dados_redimensionados = np.full(
-            (nova_altura, nova_largura), nodata_valor, dtype=src_data.dtype
-        )
-
-        # Redimensionamento
-        reproject(
-            source=src_data,
-            destination=dados_redimensionados,
-            src_transform=src_transform,
-            src_crs=src_crs,
-            dst_transform=nova_transform,
-            dst_crs=src_crs,
-            dst_nodata=src_nodata,
-            resampling=metodo_reamostragem,
-        )
-
-    # Substituição das classes pelos valores de eficiência
-    epsilon_raster = np.zeros_like(dados_redimensionados, dtype=np.float32)
-    for codigo, valor in tabela_epsilon.items():
-        epsilon_raster[dados_redimensionados == codigo] = valor
-
-    # Converte nodata para 0
-    if src_nodata is not None:
-        epsilon_raster[dados_redimensionados == src_nodata] = 0
-
-    # Atualiza metadados do arquivo de saída
-    perfil.update(
-        {
-            "height": nova_altura,
-            "width": nova_largura,
-            "transform": nova_transform,
-            "dtype": "float32",
-            "nodata": 0,
-            "count": 1,
-            "compress": "lzw",
-        }
-    )
-
-    # Salva o raster
-    with rasterio.open(caminho_saida, "w", **perfil) as dst:
-        dst.write(epsilon_raster, 1)
-
-    print(f"Raster E_max gerado em: {caminho_saida.resolve()}")
+import math
+import numpy as np
+import rasterio
+from rasterio.errors import WindowError
+from rasterio.warp import reproject, Resampling, transform_bounds
+from rasterio.transform import Affine, array_bounds
+from rasterio.windows import Window, from_bounds
+from pathlib import Path
+
+from parametros.raster_io import GrelhaAlvo, RasterMemoria, guardar_raster
+from parametros.instrumentacao import instrumentar
+
+# Pixeis lidos à volta da área de estudo, para a reamostragem nas margens
+MARGEM_JANELA = 8
+
+# Fração da grelha sem dados WorldCover a partir da qual se avisa
+LIMITE_SEM_DADOS = 0.01
+
+# Tabela padrão de eficiência (classe ESA WorldCover -> epsilon)
+TABELA_EPSILON = {
+    10: 1.0,  # treecover
+    20: 0.7,  # shrubland
+    30: 1.04,  # grassland
+    40: 0.9,  # cropland
+    60: 0.25,  # bare/sparse vegetation
+}
+
+
+@instrumentar()
+def calcular_emax(
+    caminho_entrada: Path,
+    caminho_saida: Path,
+    nova_largura: int = None,
+    nova_altura: int = None,
+    substituicoes: dict = None,
+    metodo_reamostragem: Resampling = Resampling.nearest,
+    grelha: GrelhaAlvo = None,
+):
+    """
+    Processamento de um raster de uso do solo para introduzir valores de eficiência (Emax)
+    com redimensionamento e conversão de classes.
+
+    Parâmetros:
+    caminho_entrada (Path): Caminho para o raster de entrada (ex: ESA WorldCover),
+        ou lista de mosaicos quando a área de estudo atravessa vários (exige grelha)
+    caminho_saida (Path): Caminho para salvar o raster resultante (None para
+        devolver um RasterMemoria sem escrever em disco)
+    nova_largura (int): Número de colunas do raster de saída
+    nova_altura (int): Número de linhas do raster de saída
+    substituicoes (dict): Dicionário de mapeamento classe->eficiência (padrão: tabela ESA)
+    metodo_reamostragem (Resampling): Método de reamostragem (padrão: nearest neighbor)
+    grelha (GrelhaAlvo): Grelha alvo (CRS, transform, dimensões). Se indicada, o
+        raster é reprojetado diretamente para ela e nova_largura/nova_altura
+        são ignoradas; só é lida a janela do mosaico que cobre a grelha
+    """
+
+    tabela_epsilon = substituicoes or TABELA_EPSILON
+
+    mosaicos = (
+        list(caminho_entrada)
+        if isinstance(caminho_entrada, (list, tuple))
+        else [caminho_entrada]
+    )
+
+    if grelha is not None:
+        dados_redimensionados, perfil, src_nodata = ler_mosaicos_na_grelha(
+            mosaicos, grelha, metodo_reamostragem
+        )
+        nova_largura, nova_altura = grelha.largura, grelha.altura
+        nova_transform = grelha.transform
+        dst_crs = grelha.crs
+    else:
+        if len(mosaicos) > 1:
+            raise ValueError("Varios mosaicos WorldCover exigem uma grelha alvo")
+
+        with rasterio.open(mosaicos[0]) as src:
+            src_data = src.read(1)
+            src_transform = src.transform
+            src_crs = src.crs
+            src_nodata = src.nodata
+            perfil = src.profile.copy()
+
+            # Calcula nova resolução espacial
+            pixel_x = src_transform.a * src.width / nova_largura
+            pixel_y = -src_transform.e * src.height / nova_altura
+            nova_transform = Affine(
+                pixel_x, 0, src_transform.c, 0, -pixel_y, src_transform.f
+            )
+            dst_crs = src_crs
+
+            # Prepara array para dados redimensionados
+            nodata_valor = src_nodata if src_nodata is not None else 0
+            dados_redimensionados = np.full(
+                (nova_altura, nova_largura), nodata_valor, dtype=src_data.dtype
+            )
+
+            # Redimensionamento
+            reproject(
+                source=src_data,
+                destination=dados_redimensionados,
+                src_transform=src_transform,
+                src_crs=src_crs,
+                dst_transform=nova_transform,
+                dst_crs=dst_crs,
+                dst_nodata=src_nodata,
+                resampling=metodo_reamostragem,
+            )
+
+    # Substituição das classes pelos valores de eficiência (nodata -> 0)
+    epsilon_raster = tabela_consulta(tabela_epsilon, dados_redimensionados, src_nodata)
+
+    # Atualiza metadados do arquivo de saída
+    perfil.update(
+        {
+            "height": nova_altura,
+            "width": nova_largura,
+            "transform": nova_transform,
+            "crs": dst_crs,
+            "dtype": "float32",
+            "nodata": 0,
+            "count": 1,
+        }
+    )
+
+    if caminho_saida is None:
+        print("Raster E_max gerado em memoria")
+        return RasterMemoria(epsilon_raster, perfil)
+
+    # Salva o raster
+    guardar_raster(caminho_saida, epsilon_raster, perfil)
+
+    print(f"Raster E_max gerado em: {caminho_saida.resolve()}")
+    return caminho_saida
+
+
+def tabela_consulta(tabela_epsilon: dict, classes: np.ndarray, nodata=None):
+    """
+    Converte classes de uso do solo em eficiência com uma única indexação
+
+    Constrói uma tabela (lookup table) indexada pelo código da classe, com 0
+    para classes fora de tabela_epsilon e para nodata, e aplica-a de uma vez
+    em vez de comparar o raster inteiro com cada classe.
+    """
+    if not np.issubdtype(classes.dtype, np.integer):
+        classes = classes.astype(np.int64)
+
+    maximo = max(int(classes.max(initial=0)), max(tabela_epsilon, default=0))
+    lut = np.zeros(maximo + 1, dtype=np.float32)
+    for codigo, valor in tabela_epsilon.items():
+        lut[codigo] = valor
+    if nodata is not None and 0 <= nodata <= maximo:
+        lut[int(nodata)] = 0
+
+    # Códigos negativos (ex.: nodata -1) não são classes ESA
+    if classes.min(initial=0) < 0:
+        return np.where(classes >= 0, lut[np.clip(classes, 0, None)], 0).astype(
+            np.float32
+        )
+    return lut[classes]
+
+
+def ler_mosaicos_na_grelha(
+    mosaicos: list, grelha: GrelhaAlvo, metodo_reamostragem: Resampling
+):
+    """
+    Lê dos mosaicos WorldCover apenas a janela que cobre a grelha alvo
+    (mais MARGEM_JANELA pixeis) e reprojeta-a para a grelha
+
+    Mosaicos que não intersetam a grelha não são lidos; quando a área de
+    estudo atravessa o limite entre mosaicos, cada um preenche a sua parte.
+
+    Retorna:
+    tuple: (classes na grelha, perfil do primeiro mosaico, nodata)
+    """
+    destino = None
+    perfil = None
+    src_nodata = None
+    limites_grelha = array_bounds(grelha.altura, grelha.largura, grelha.transform)
+
+    for caminho in mosaicos:
+        with rasterio.open(caminho) as src:
+            if destino is None:
+                perfil = src.profile.copy()
+                src_nodata = src.nodata
+                destino = np.full(
+                    grelha.forma,
+                    src_nodata if src_nodata is not None else 0,
+                    dtype=src.dtypes[0],
+                )
+
+            limites = transform_bounds(grelha.crs, src.crs, *limites_grelha)
+            exata = from_bounds(*limites, transform=src.transform)
+            coluna = math.floor(exata.col_off) - MARGEM_JANELA
+            linha = math.floor(exata.row_off) - MARGEM_JANELA
+            try:
+                janela = Window(
+                    coluna,
+                    linha,
+                    math.ceil(exata.col_off + exata.width) + MARGEM_JANELA - coluna,
+                    math.ceil(exata.row_off + exata.height) + MARGEM_JANELA - linha,
+                ).intersection(Window(0, 0, src.width, src.height))
+            except WindowError:
+                print(f"Mosaico fora da area de estudo, ignorado: {caminho}")
+                continue
+
+            print(
+                f"WorldCover {Path(caminho).name}: janela {janela.width}x"
+                f"{janela.height} de {src.width}x{src.height}"
+            )
+            reproject(
+                source=src.read(1, window=janela),
+                destination=destino,
+                src_transform=src.window_transform(janela),
+                src_crs=src.crs,
+                src_nodata=src_nodata,
+                dst_transform=grelha.transform,
+                dst_crs=grelha.crs,
+                dst_nodata=src_nodata,
+                resampling=metodo_reamostragem,
+                # Não apagar o que os mosaicos anteriores já preencheram
+                init_dest_nodata=False,
+            )
+
+    if destino is None:
+        raise ValueError("Nenhum mosaico WorldCover indicado")
+
+    # Pixeis que nenhum mosaico cobriu ficam com E_max 0 (e NPP 0)
+    sem_dados = np.mean(destino == (src_nodata if src_nodata is not None else 0))
+    if sem_dados > LIMITE_SEM_DADOS:
+        print(
+            f"AVISO: os mosaicos WorldCover nao cobrem {100 * sem_dados:.0f}% "
+            "da area de estudo (E_max 0 nesses pixeis)"
+        )
+    return destino, perfil, src_nodata
@@ -1,87 +1,165 @@
-import rasterio
-import numpy as np
-from pathlib import Path
-
-
-def calcular_ndvi_fpar(input_s2_path, output_dir_path):
-    """
-    Calcula NDVI e FPAR em sequência
-    """
-    print("\n" + "=" * 50)
-    print("Iniciar calculo do NDVI e FPAR")
-    print("=" * 50)
-
-    # Calcular NDVI
-    ndvi_file = Path(output_dir_path) / "NDVI.tif"
-    calcular_ndvi(input_s2_path, str(ndvi_file))
-
-    # Calcular FPAR
-    fpar_file = Path(output_dir_path) / "FPAR.tif"
-    calcular_fpar(str(ndvi_file), str(fpar_file))
-
-    print(f"Processo NDVI/FPAR concluido com sucesso!")
-    return str(fpar_file)
-
-
-def calcular_fpar(ndvi_file_path, fpar_output_file_path):
-    """
-    Calcula FPAR a partir do arquivo NDVI
-    """
-    with rasterio.open(ndvi_file_path) as src:
-        ndvi = src.read(1).astype(np.float32)
-        profile = src.profile
-        nodata = src.nodata
-
-    # Máscara de dados válidos
-    valid_mask = (ndvi != nodata) & (~np.isnan(ndvi))
-
-    # Calcular estatísticas
-    if np.count_nonzero(valid_mask) == 0:
-        raise ValueError("Nenhum dado valido encontrado no arquivo NDVI")
-
-    NDVImin = np.min(ndvi[valid_mask])
-    NDVImax = np.max(ndvi[valid_mask])
-
-    if np.isclose(NDVImax, NDVImin):
-        NDVImax = NDVImin + 1e-5
-
-    # Parâmetros FPAR
-    FPARmax = 0.95
-    FPARmin = 0.001
-
-    # Calcular FPAR
-    fpar = np.full(ndvi.shape, nodata, dtype=np.float32)
-    fpar[valid_mask] = (
-        (ndvi[valid_mask] - NDVImin) * (FPARmax - FPARmin) / (NDVImax - NDVImin)
-    ) + FPARmin
-
-    profile.update(dtype=rasterio.float32, count=1, compress="lzw", nodata=nodata)
-    with rasterio.open(fpar_output_file_path, "w", **profile) as dst:
-        dst.write(fpar, 1)
-
-    print(f"FPAR calculado, salvo em: {fpar_output_file_path}")
-    return fpar_output_file_path
-
-
-def calcular_ndvi(input_s2_path, output_ndvi_path):
-    """
-    Calcula NDVI a partir de arquivo Sentinel-2 (GeoTIFF)
-    """
-    with rasterio.open(input_s2_path) as src:
-        red = src.read(1).astype(np.float32)
-        nir = src.read(2).astype(np.float32)
-        profile = src.profile
-
-    # Calcular NDVI
-    denominator = nir + red
-    ndvi = np.zeros_like(red, dtype=np.float32)
-    valid_mask = denominator != 0
-    ndvi[valid_mask] = (nir[valid_mask] - red[valid_mask]) / denominator[valid_mask]
-    ndvi[~valid_mask] = np.nan
-
-    profile.update(dtype=rasterio.float32, count=1, nodata=np.nan, compress="lzw")
-    with rasterio.open(output_ndvi_path, "w", **profile) as dst:
-        dst.write(ndvi, 1)
-
-    print(f"NDVI calculado, salvo em: {output_ndvi_path}")
-    return output_ndvi_path
+import rasterio
+import numpy as np
+from pathlib import Path
+
+from parametros import kernels
+from parametros.normalizacao import limitar, limites_normalizacao
+from parametros.raster_io import (
+    EscritaPorBlocos,
+    RasterMemoria,
+    guardar_raster,
+    ler_banda,
+    ler_blocos,
+    ler_perfil,
+)
+from parametros.instrumentacao import instrumentar
+
+
+@instrumentar()
+def calcular_ndvi_fpar(input_s2_path, output_dir_path=None, linhas_bloco=None):
+    """
+    Calcula NDVI e FPAR em sequência
+
+    Se output_dir_path for None, NDVI e FPAR são calculados em memória e é
+    devolvido o RasterMemoria do FPAR em vez do caminho do ficheiro.
+    linhas_bloco: calcula ambos por blocos desse número de linhas (ver
+    calcular_fpar).
+    """
+    print("\n" + "=" * 50)
+    print("Iniciar calculo do NDVI e FPAR")
+    print("=" * 50)
+
+    if output_dir_path is None:
+        ndvi = calcular_ndvi(input_s2_path, linhas_bloco=linhas_bloco)
+        fpar = calcular_fpar(ndvi, linhas_bloco=linhas_bloco)
+        print(f"Processo NDVI/FPAR concluido com sucesso (em memoria)!")
+        return fpar
+
+    # Calcular NDVI
+    ndvi_file = Path(output_dir_path) / "NDVI.tif"
+    calcular_ndvi(input_s2_path, str(ndvi_file), linhas_bloco=linhas_bloco)
+
+    # Calcular FPAR
+    fpar_file = Path(output_dir_path) / "FPAR.tif"
+    calcular_fpar(str(ndvi_file), str(fpar_file), linhas_bloco=linhas_bloco)
+
+    print(f"Processo NDVI/FPAR concluido com sucesso!")
+    return str(fpar_file)
+
+
+@instrumentar()
+def calcular_fpar(
+    ndvi_file_path, fpar_output_file_path=None, linhas_bloco=None, percentis=None
+):
+    """
+    Calcula FPAR a partir do arquivo NDVI (ou de um RasterMemoria com o NDVI)
+
+    Se fpar_output_file_path for None devolve um RasterMemoria em vez de escrever.
+    linhas_bloco: lê o NDVI por blocos desse número de linhas, em duas
+    passagens (mínimo e máximo globais, depois o FPAR de cada bloco), sem ter
+    em memória o NDVI inteiro nem as cópias dos valores válidos; o resultado
+    é igual ao do cálculo em memória. percentis: (inferior, superior) do
+    NDVI a usar como NDVImin/NDVImax em vez do mínimo e máximo, ex. (2, 98)
+    (os valores fora ficam limitados a esse intervalo).
+    """
+    if linhas_bloco is not None:
+        return _calcular_fpar_por_blocos(
+            ndvi_file_path, fpar_output_file_path, linhas_bloco, percentis
+        )
+
+    ndvi, profile = ler_banda(ndvi_file_path)
+    nodata = profile.get("nodata")
+
+    # Máscara de dados válidos
+    valid_mask = _validos(ndvi, nodata)
+
+    # Calcular estatísticas
+    NDVImin, NDVImax = _limites_ndvi(
+        limites_normalizacao(lambda: iter([ndvi[valid_mask]]), percentis)
+    )
+    if percentis is not None:
+        ndvi = limitar(ndvi, NDVImin, NDVImax, valid_mask)
+
+    # Calcular FPAR (escala linear entre FPAR_MIN e FPAR_MAX, numa passagem)
+    fpar = kernels.fpar(ndvi, NDVImin, NDVImax, nodata)
+
+    profile.update(dtype=rasterio.float32, count=1, nodata=nodata)
+    if fpar_output_file_path is None:
+        print("FPAR calculado em memoria")
+        return RasterMemoria(fpar, profile)
+
+    guardar_raster(fpar_output_file_path, fpar, profile)
+
+    print(f"FPAR calculado, salvo em: {fpar_output_file_path}")
+    return fpar_output_file_path
+
+
+def _calcular_fpar_por_blocos(ndvi_file_path, fpar_output_file_path, linhas, percentis):
+    """calcular_fpar em duas passagens por blocos de linhas"""
+    profile = ler_perfil(ndvi_file_path)
+    nodata = profile.get("nodata")
+
+    def valores_validos():
+        for _, (ndvi,) in ler_blocos(ndvi_file_path, linhas=linhas):
+            yield ndvi[_validos(ndvi, nodata)]
+
+    NDVImin, NDVImax = _limites_ndvi(limites_normalizacao(valores_validos, percentis))
+
+    profile.update(dtype=rasterio.float32, count=1, nodata=nodata)
+    with EscritaPorBlocos(fpar_output_file_path, profile) as destino:
+        for janela, (ndvi,) in ler_blocos(ndvi_file_path, linhas=linhas):
+            if percentis is not None:
+                ndvi = limitar(ndvi, NDVImin, NDVImax, _validos(ndvi, nodata))
+            destino.escrever(janela, kernels.fpar(ndvi, NDVImin, NDVImax, nodata))
+
+    print(f"FPAR calculado por blocos de {linhas} linhas")
+    return destino.resultado()
+
+
+def _validos(ndvi, nodata):
+    return (ndvi != nodata) & (~np.isnan(ndvi))
+
+
+def _limites_ndvi(limites):
+    if limites is None:
+        raise ValueError("Nenhum dado valido encontrado no arquivo NDVI")
+
+    NDVImin, NDVImax = limites
+    if np.isclose(NDVImax, NDVImin):
+        NDVImax = NDVImin + 1e-5
+    return NDVImin, NDVImax
+
+
+@instrumentar()
+def calcular_ndvi(input_s2_path, output_ndvi_path=None, linhas_bloco=None):
+    """
+    Calcula NDVI a partir de arquivo Sentinel-2 (GeoTIFF)
+
+    Se output_ndvi_path for None devolve um RasterMemoria em vez de escrever.
+    linhas_bloco: lê as bandas e escreve o NDVI por blocos desse número de
+    linhas.
+    """
+    if linhas_bloco is not None:
+        profile = ler_perfil(input_s2_path)
+        profile.update(dtype=rasterio.float32, count=1, nodata=np.nan)
+        with EscritaPorBlocos(output_ndvi_path, profile) as destino:
+            for janela, (red, nir) in ler_blocos(input_s2_path, (1, 2), linhas_bloco):
+                destino.escrever(janela, kernels.ndvi(red, nir))
+        print(f"NDVI calculado por blocos de {linhas_bloco} linhas")
+        return destino.resultado()
+
+    red, profile = ler_banda(input_s2_path, 1)
+    nir, _ = ler_banda(input_s2_path, 2)
+
+    # Calcular NDVI
+    ndvi = kernels.ndvi(red, nir)
+
+    profile.update(dtype=rasterio.float32, count=1, nodata=np.nan)
+    if output_ndvi_path is None:
+        print("NDVI calculado em memoria")
+        return RasterMemoria(ndvi, profile)
+
+    guardar_raster(output_ndvi_path, ndvi, profile)
+
+    print(f"NDVI calculado, salvo em: {output_ndvi_path}")
+    return output_ndvi_path
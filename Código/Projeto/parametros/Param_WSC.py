@@ -1,80 +1,124 @@
-import numpy as np
-import rasterio
-
-
-def calculate_WSC_from_tif(tif_path, output_path):
-    """
-    Calcula o Water Canopy Stress (WSC) a partir de um arquivo .tif
-    """
-    try:
-        # Abrir o arquivo .tif
-        with rasterio.open(tif_path) as src:
-            band_descriptions = src.descriptions
-            band_names = [
-                desc or f"band_{i+1}" for i, desc in enumerate(band_descriptions)
-            ]
-            print("Bandas disponiveis:", band_names)
-
-            # Encontrar índices das bandas SWIR (B11 e B12)
-            band11_idx = None
-            band12_idx = None
-
-            for i, name in enumerate(band_names):
-                if "B11" in name or "11" in name:
-                    band11_idx = i + 1
-                elif "B12" in name or "12" in name:
-                    band12_idx = i + 1
-
-            if band11_idx is None or band12_idx is None:
-                if len(band_names) >= 4:
-                    band11_idx = 3
-                    band12_idx = 4
-                    print("Utilizar as bandas por posição (idx 3 e 4)")
-                else:
-                    raise ValueError(
-                        f"Bandas SWIR (B11/B12) não encontradas. Bandas disponiveis: {band_names}"
-                    )
-
-            print(
-                f"Utilizando banda B11: índice {band11_idx} - {band_names[band11_idx-1]}"
-            )
-            print(
-                f"Utilizando banda B12: índice {band12_idx} - {band_names[band12_idx-1]}"
-            )
-
-            # Ler as bandas SWIR
-            b11 = src.read(band11_idx).astype(np.float32)
-            b12 = src.read(band12_idx).astype(np.float32)
-
-            # Normalizar valores
-            b11 = b11 / 10000.0
-            b12 = b12 / 10000.0
-
-            # Calcular SIMI
-            simi = 0.7071 * np.sqrt(np.square(b11) + np.square(b12))
-
-            # Normalizar SIMI
-            simi_valid = simi[np.isfinite(simi)]
-            simi_min = np.min(simi_valid)
-            simi_max = np.max(simi_valid)
-            nsimi = (simi - simi_min) / (simi_max - simi_min)
-
-            # Calcular WSC
-            wsc = 0.5 + 0.5 * (1 - nsimi)
-            wsc[~np.isfinite(wsc)] = np.nan
-
-            # Perfil do arquivo de saída
-            profile = src.profile
-            profile.update(
-                {"count": 1, "dtype": "float32", "nodata": np.nan, "compress": "lzw"}
-            )
-
-            # Salvar como GeoTIFF
-            with rasterio.open(output_path, "w", **profile) as dst:
-                dst.write(wsc.astype(np.float32), 1)
-
-        return output_path
-
-    except Exception as e:
-        print(f"Erro no calculo do WSC: {str(e)}")
-        raise
+import numpy as np
+
+from parametros import kernels
+from parametros.normalizacao import limitar, limites_normalizacao
+from parametros.raster_io import (
+    EscritaPorBlocos,
+    RasterMemoria,
+    descricoes_bandas,
+    guardar_raster,
+    ler_banda,
+    ler_blocos,
+    ler_perfil,
+)
+from parametros.instrumentacao import instrumentar
+
+
+@instrumentar()
+def calculate_WSC_from_tif(
+    tif_path, output_path=None, linhas_bloco=None, percentis=None
+):
+    """
+    Calcula o Water Canopy Stress (WSC) a partir de um arquivo .tif (ou de um
+    RasterMemoria com as bandas e respetivos nomes)
+
+    Se output_path for None devolve um RasterMemoria em vez de escrever o GeoTIFF.
+    linhas_bloco: lê B11/B12 por blocos desse número de linhas, em duas
+    passagens (mínimo e máximo globais do SIMI, depois o WSC de cada bloco),
+    com o mesmo resultado do cálculo em memória. percentis: (inferior,
+    superior) do SIMI a usar na normalização em vez do mínimo e máximo.
+    """
+    try:
+        band_descriptions = descricoes_bandas(tif_path)
+        band_names = [desc or f"band_{i+1}" for i, desc in enumerate(band_descriptions)]
+        print("Bandas disponiveis:", band_names)
+
+        # Encontrar índices das bandas SWIR (B11 e B12)
+        band11_idx = None
+        band12_idx = None
+
+        for i, name in enumerate(band_names):
+            if "B11" in name or "11" in name:
+                band11_idx = i + 1
+            elif "B12" in name or "12" in name:
+                band12_idx = i + 1
+
+        if band11_idx is None or band12_idx is None:
+            if len(band_names) >= 4:
+                band11_idx = 3
+                band12_idx = 4
+                print("Utilizar as bandas por posição (idx 3 e 4)")
+            else:
+                raise ValueError(
+                    f"Bandas SWIR (B11/B12) não encontradas. Bandas disponiveis: {band_names}"
+                )
+
+        print(f"Utilizando banda B11: índice {band11_idx} - {band_names[band11_idx-1]}")
+        print(f"Utilizando banda B12: índice {band12_idx} - {band_names[band12_idx-1]}")
+
+        if linhas_bloco is not None:
+            return _calcular_wsc_por_blocos(
+                tif_path, (band11_idx, band12_idx), output_path, linhas_bloco, percentis
+            )
+
+        # Ler as bandas SWIR
+        b11, profile = ler_banda(tif_path, band11_idx)
+        b12, _ = ler_banda(tif_path, band12_idx)
+
+        # Calcular SIMI (bandas normalizadas de x10000 para reflectância)
+        simi = kernels.simi(b11, b12)
+
+        # Normalizar SIMI
+        validos = np.isfinite(simi)
+        simi_min, simi_max = _limites_simi(
+            limites_normalizacao(lambda: iter([simi[validos]]), percentis)
+        )
+        if percentis is not None:
+            simi = limitar(simi, simi_min, simi_max, validos)
+
+        # Calcular WSC (0.5 + 0.5 * (1 - SIMI normalizado))
+        wsc = kernels.wsc(simi, simi_min, simi_max)
+
+        # Perfil do arquivo de saída
+        profile.update({"count": 1, "dtype": "float32", "nodata": np.nan})
+
+        if output_path is None:
+            return RasterMemoria(wsc.astype(np.float32, copy=False), profile)
+
+        # Salvar como GeoTIFF
+        guardar_raster(output_path, wsc, profile)
+
+        return output_path
+
+    except Exception as e:
+        print(f"Erro no calculo do WSC: {str(e)}")
+        raise
+
+
+def _calcular_wsc_por_blocos(tif_path, bandas, output_path, linhas, percentis):
+    """calculate_WSC_from_tif em duas passagens por blocos de linhas"""
+
+    def valores_validos():
+        for _, (b11, b12) in ler_blocos(tif_path, bandas, linhas):
+            simi = kernels.simi(b11, b12)
+            yield simi[np.isfinite(simi)]
+
+    simi_min, simi_max = _limites_simi(limites_normalizacao(valores_validos, percentis))
+
+    profile = ler_perfil(tif_path)
+    profile.update({"count": 1, "dtype": "float32", "nodata": np.nan})
+    with EscritaPorBlocos(output_path, profile) as destino:
+        for janela, (b11, b12) in ler_blocos(tif_path, bandas, linhas):
+            simi = kernels.simi(b11, b12)
+            if percentis is not None:
+                simi = limitar(simi, simi_min, simi_max, np.isfinite(simi))
+            destino.escrever(janela, kernels.wsc(simi, simi_min, simi_max))
+
+    print(f"WSC calculado por blocos de {linhas} linhas")
+    return destino.resultado()
+
+
+def _limites_simi(limites):
+    if limites is None:
+        raise ValueError("Nenhum valor de SIMI valido (B11/B12)")
+    return limites
@@ -1,108 +1,229 @@
-import os
-import numpy as np
-import rasterio
-from PIL import Image
-from pathlib import Path
-import logging
-
-# Configura logging
-logger = logging.getLogger(__name__)
-
-
-def redimensionar_imagens(input_dir: Path, tamanho_alvo=(1032, 876)):
-    """Redimensiona todas as imagens TIFF no diretório especificado"""
-    logger.info("--- A INICIAR REDIMENSIONAMENTO ---")
-
-    for arquivo in input_dir.glob("*.tif*"):
-        try:
-            with Image.open(arquivo) as img:
-                if img.size != tamanho_alvo:
-                    logger.info(
-                        f"A redimensionar: {arquivo.name} ({img.size} → {tamanho_alvo})"
-                    )
-                    img_redim = img.resize(tamanho_alvo, Image.Resampling.NEAREST)
-                    img_redim.save(arquivo, format="TIFF", compression="tiff_deflate")
-                else:
-                    logger.debug(f"Tamanho OK: {arquivo.name}")
-        except Exception as e:
-            logger.error(f"ERRO ao processar {arquivo.name}: {str(e)}")
-
-    logger.info("--- REDIMENSIONAMENTO CONCLUÍDO ---")
-
-
-def calcular_npp(outputs_dir: Path, results_dir: Path):
-    """Calcula o NPP usando as imagens processadas"""
-    logger.info("---INICIO DO CALCULO DO NPP ---")
-
-    # Carrega valor T1 do arquivo
-    t1_path = outputs_dir / "T1.txt"
-    try:
-        with open(t1_path, "r") as f:
-            conteudo = f.read().strip()
-            T1 = float(conteudo.split("=")[1])
-            logger.info(f"Valor T1 carregado: {T1:.4f}")
-    except Exception as e:
-        logger.error(f"ERRO ao ler T1: {str(e)}")
-        raise
-
-    arquivos_necessarios = ["FPAR.tif", "T2.tif", "WSC.tif", "SOL.tif", "E_max.tif"]
-    caminhos = {}
-
-    for arquivo in arquivos_necessarios:
-        caminho = outputs_dir / arquivo
-        if not caminho.exists():
-            logger.error(f"Arquivo nao encontrado: {caminho}")
-            raise FileNotFoundError(f"Arquivo {arquivo} não encontrado")
-        caminhos[arquivo.split(".")[0]] = caminho
-
-    # Processa as imagens e calcular NPP
-    try:
-        with rasterio.open(caminhos["FPAR"]) as src_fpar, rasterio.open(
-            caminhos["T2"]
-        ) as src_t2, rasterio.open(caminhos["WSC"]) as src_wsc, rasterio.open(
-            caminhos["SOL"]
-        ) as src_sol, rasterio.open(
-            caminhos["E_max"]
-        ) as src_emax:
-
-            # Carregar dados
-            def carregar_banda(src):
-                data = src.read(1).astype(np.float32)
-                nodata = src.nodata if src.nodata is not None else np.nan
-                return np.where(data == nodata, np.nan, data)
-
-            FPAR = carregar_banda(src_fpar)
-            T2 = carregar_banda(src_t2)
-            WSC = carregar_banda(src_wsc)
-            SOL = carregar_banda(src_sol)
-            Emax = carregar_banda(src_emax)
-
-            # Cálculo do NPP
-            npp = 0.5 * SOL * FPAR * T1 * T2 * WSC * Emax
-
-            # Salvar resultado
-            perfil = src_fpar.profile
-            perfil.update(dtype=rasterio.float32, count=1, nodata=np.nan)
-
-            results_dir.mkdir(exist_ok=True)
-            caminho_npp = results_dir / "NPP_RESULT.tif"
-
-            with rasterio.open(caminho_npp, "w", **perfil) as dst:
-                dst.write(npp.astype(np.float32), 1)
-
-            logger.info(f"NPP salvo em: {caminho_npp}")
-            return caminho_npp
-
-    except Exception as e:
-        logger.error(f"ERRO durante o calculo do NPP: {str(e)}")
-        raise
-
-
-def executar_calculo_npp(projeto_dir: Path):
-    """Função principal para executar o calculo do NPP"""
-    outputs_dir = projeto_dir / "OUTPUTS"
-    results_dir = projeto_dir / "RESULT"
-
-    redimensionar_imagens(outputs_dir)
-
-    return calcular_npp(outputs_dir, results_dir)
+import os
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from pathlib import Path
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from parametros import kernels
+from parametros.escrita_raster import DestinoBlocos
+from parametros.raster_io import (
+    GrelhaAlvo,
+    RasterMemoria,
+    abrir_alinhado,
+    alinhar_raster,
+    grelha_de_raster,
+)
+from parametros.instrumentacao import instrumentar
+
+# Configura logging
+logger = logging.getLogger(__name__)
+
+# Blocos (em píxeis) do cálculo do NPP e threads de leitura por bloco
+TAMANHO_BLOCO = 512
+NUM_THREADS_LEITURA = 5
+
+
+def alinhar_camadas(camadas: dict, grelha: GrelhaAlvo) -> dict:
+    """
+    Alinha as camadas do NPP com a grelha alvo (produto Sentinel-2 recortado)
+
+    Camadas em memória fora da grelha são reprojetadas uma única vez; ficheiros
+    são mantidos como caminho e, se estiverem fora da grelha, lidos através de um
+    WarpedVRT durante o cálculo. Camadas já na grelha não são tocadas.
+    """
+    logger.info("--- A ALINHAR CAMADAS COM A GRELHA ALVO ---")
+
+    alinhadas = {}
+    for nome, fonte in camadas.items():
+        if isinstance(fonte, RasterMemoria):
+            alinhadas[nome] = alinhar_raster(fonte, grelha)
+            if alinhadas[nome] is fonte:
+                logger.debug(f"Grelha OK: {nome}")
+            else:
+                logger.info(f"Camada {nome} reprojetada para a grelha alvo")
+        else:
+            alinhadas[nome] = fonte
+
+    return alinhadas
+
+
+def _abrir_leitor_blocos(fonte, grelha: GrelhaAlvo, pilha: ExitStack):
+    """
+    Prepara a leitura por janelas de uma camada (ficheiro ou RasterMemoria)
+    alinhada com a grelha alvo
+
+    Retorna:
+    function: ler(janela) -> bloco float32 com nodata convertido em NaN
+    """
+    if isinstance(fonte, RasterMemoria):
+        dados = fonte.dados if fonte.dados.ndim == 2 else fonte.dados[0]
+        nodata = fonte.perfil.get("nodata")
+        if dados.shape != grelha.forma:
+            raise ValueError(
+                f"Camada em memoria {dados.shape} fora da grelha alvo {grelha.forma}"
+            )
+
+        def ler_bloco(janela):
+            bloco = dados[janela.toslices()].astype(np.float32)
+            return _nodata_para_nan(bloco, nodata)
+
+    else:
+        src = abrir_alinhado(fonte, grelha, pilha)
+        nodata = src.nodata
+
+        def ler_bloco(janela):
+            bloco = src.read(1, window=janela).astype(np.float32, copy=False)
+            return _nodata_para_nan(bloco, nodata)
+
+    return ler_bloco
+
+
+def _nodata_para_nan(bloco: np.ndarray, nodata) -> np.ndarray:
+    """Substitui (no próprio bloco) o valor nodata por NaN"""
+    if nodata is not None and not np.isnan(nodata):
+        bloco[bloco == nodata] = np.nan
+    return bloco
+
+
+def _janelas(altura: int, largura: int, tamanho_bloco: int):
+    """Gera as janelas (blocos tamanho_bloco x tamanho_bloco) que cobrem a grelha"""
+    for lin in range(0, altura, tamanho_bloco):
+        for col in range(0, largura, tamanho_bloco):
+            yield Window(
+                col,
+                lin,
+                min(tamanho_bloco, largura - col),
+                min(tamanho_bloco, altura - lin),
+            )
+
+
+@instrumentar()
+def calcular_npp(
+    outputs_dir: Path,
+    results_dir: Path,
+    camadas: dict = None,
+    T1: float = None,
+    tamanho_bloco: int = TAMANHO_BLOCO,
+    num_threads: int = NUM_THREADS_LEITURA,
+    grelha: GrelhaAlvo = None,
+):
+    """
+    Calcula o NPP usando as imagens processadas
+
+    Por omissão lê T1.txt e FPAR/T2/WSC/SOL/E_max de outputs_dir. Em modo em
+    memória recebe em camadas um dicionário {"FPAR", "T2", "WSC", "SOL", "E_max"}
+    de RasterMemoria (ou caminhos) e o valor de T1.
+
+    Todas as camadas são lidas na grelha alvo (por omissão a grelha do FPAR,
+    ou seja, do Sentinel-2 recortado), alinhadas via alinhar_camadas.
+
+    O cálculo é feito por blocos de tamanho_bloco x tamanho_bloco píxeis: em cada
+    bloco as cinco camadas são lidas em paralelo (num_threads) e o resultado é
+    escrito de imediato, pelo que a memória usada depende do tamanho do bloco e
+    não da área de estudo. NPP_RESULT.tif é escrito como COG com overviews
+    (classe de saída "resultado", ver escrita_raster).
+    """
+    logger.info("---INICIO DO CALCULO DO NPP ---")
+
+    # Carrega valor T1 do arquivo
+    if T1 is None:
+        t1_path = outputs_dir / "T1.txt"
+        try:
+            with open(t1_path, "r") as f:
+                conteudo = f.read().strip()
+                T1 = float(conteudo.split("=")[1])
+                logger.info(f"Valor T1 carregado: {T1:.4f}")
+        except Exception as e:
+            logger.error(f"ERRO ao ler T1: {str(e)}")
+            raise
+
+    if camadas is None:
+        arquivos_necessarios = ["FPAR.tif", "T2.tif", "WSC.tif", "SOL.tif", "E_max.tif"]
+        camadas = {}
+
+        for arquivo in arquivos_necessarios:
+            caminho = outputs_dir / arquivo
+            if not caminho.exists():
+                logger.error(f"Arquivo nao encontrado: {caminho}")
+                raise FileNotFoundError(f"Arquivo {arquivo} não encontrado")
+            camadas[arquivo.split(".")[0]] = caminho
+
+    # Processa as imagens e calcular NPP
+    try:
+        # Grelha de referência: por omissão a do FPAR
+        if grelha is None:
+            grelha = grelha_de_raster(camadas["FPAR"])
+        camadas = alinhar_camadas(camadas, grelha)
+
+        fpar = camadas["FPAR"]
+        if isinstance(fpar, RasterMemoria):
+            perfil = fpar.perfil.copy()
+        else:
+            with rasterio.open(fpar) as src_fpar:
+                perfil = src_fpar.profile.copy()
+
+        perfil.update(
+            crs=grelha.crs,
+            transform=grelha.transform,
+            width=grelha.largura,
+            height=grelha.altura,
+            dtype=rasterio.float32,
+            count=1,
+            nodata=np.nan,
+        )
+
+        results_dir.mkdir(exist_ok=True)
+        caminho_npp = results_dir / "NPP_RESULT.tif"
+
+        nomes = ["SOL", "FPAR", "T2", "WSC", "E_max"]
+        with ExitStack() as pilha, ThreadPoolExecutor(max_workers=num_threads) as pool:
+            leitores = [
+                _abrir_leitor_blocos(camadas[nome], grelha, pilha) for nome in nomes
+            ]
+            dst = pilha.enter_context(
+                DestinoBlocos(caminho_npp, perfil, classe="resultado")
+            )
+
+            for janela in _janelas(grelha.altura, grelha.largura, tamanho_bloco):
+                SOL, FPAR, T2, WSC, Emax = pool.map(lambda ler: ler(janela), leitores)
+
+                # Cálculo do NPP (0.5 * SOL * FPAR * T1 * T2 * WSC * Emax)
+                npp = kernels.npp(SOL, FPAR, T1, T2, WSC, Emax)
+
+                dst.write(npp, 1, window=janela)
+
+        logger.info(f"NPP salvo em: {caminho_npp}")
+        return caminho_npp
+
+    except Exception as e:
+        logger.error(f"ERRO durante o calculo do NPP: {str(e)}")
+        raise
+
+
+def executar_calculo_npp(
+    projeto_dir: Path,
+    camadas: dict = None,
+    T1: float = None,
+    tamanho_bloco: int = TAMANHO_BLOCO,
+    grelha: GrelhaAlvo = None,
+):
+    """
+    Função principal para executar o calculo do NPP
+
+    Com camadas (e T1) em memória OUTPUTS não é lido. grelha é a grelha alvo
+    (tipicamente a do Sentinel-2 recortado) para onde as camadas são alinhadas.
+    """
+    outputs_dir = projeto_dir / "OUTPUTS"
+    results_dir = projeto_dir / "RESULT"
+
+    return calcular_npp(
+        outputs_dir,
+        results_dir,
+        camadas=camadas,
+        T1=T1,
+        tamanho_bloco=tamanho_bloco,
+        grelha=grelha,
+    )
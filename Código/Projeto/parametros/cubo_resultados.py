@@ -0,0 +1,359 @@
+import argparse
+import logging
+import numpy as np
+from pathlib import Path
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine, rowcol
+from rasterio.warp import transform as transformar_coordenadas
+
+from parametros.raster_io import (
+    FonteRaster,
+    GrelhaAlvo,
+    RasterMemoria,
+    alinhar_raster,
+    guardar_raster,
+    ler_banda,
+)
+from parametros.instrumentacao import instrumentar
+
+logger = logging.getLogger(__name__)
+
+# Chunks (tempo, y, x): 12 meses por chunk, alinhados com o ano civil (ver
+# ANO_BASE), para que a soma de um ano leia um chunk temporal por bloco
+# espacial e a série de um pixel um chunk por ano, e 256x256 pixeis no
+# espaço. O mapa de um mês lê, em cada bloco espacial, o chunk do ano inteiro
+# desse mês (12 meses descomprimidos por bloco)
+CHUNK_TEMPO = 12
+CHUNK_ESPACO = 256
+
+# Ano da posição 0 do eixo do tempo: cada mês ocupa a posição
+# (ano - ANO_BASE) * 12 + mes - 1, pelo que janeiro começa sempre um chunk.
+# Sentinel-2 opera desde 2015; as posições sem mês não ocupam espaço.
+ANO_BASE = 2015
+
+# Variáveis do cubo e respetivas unidades
+VARIAVEIS = {
+    "npp_c": "gC/m²/mês",
+    "npp_co2": "gCO₂/m²/mês",
+}
+
+NOME_CUBO = "CUBO_NPP.zarr"
+
+
+def _codigo_mes(ano: int, mes: int) -> int:
+    return ano * 100 + mes
+
+
+def _posicao_mes(ano: int, mes: int) -> int:
+    """Posição de um mês no eixo do tempo (meses desde janeiro de ANO_BASE)"""
+    if ano < ANO_BASE:
+        raise ValueError(
+            f"Cubo de resultados: meses anteriores a {ANO_BASE} nao suportados"
+        )
+    return (ano - ANO_BASE) * 12 + mes - 1
+
+
+def _codigo_de_texto(texto: str) -> int:
+    """'AAAA-MM' -> AAAAMM"""
+    ano, mes = texto.split("-")
+    return _codigo_mes(int(ano), int(mes))
+
+
+class CuboResultados:
+    """
+    Cubo (tempo, y, x) com os resultados mensais de NPP de uma região, em Zarr
+
+    Cada mês processado é guardado (ou substituído, se já existir) na sua
+    posição do calendário no eixo do tempo (meses desde janeiro de ANO_BASE),
+    qualquer que seja a ordem em que os meses chegam; o array "tempo" guarda
+    o mês (AAAAMM) de cada posição, ou 0 se estiver vazia. Os dados são
+    comprimidos com o compressor por omissão do Zarr e divididos em chunks de
+    CHUNK_TEMPO meses x CHUNK_ESPACO x CHUNK_ESPACO pixeis, com um ano civil
+    por chunk temporal, pelo que as consultas (série de um pixel, mapa de um
+    mês, soma de um período) só leem os chunks dos anos de que precisam.
+
+    Um cubo aceita um escritor de cada vez: em execuções paralelas os meses
+    são acrescentados pelo processo principal (ver main.executar_intervalo).
+    """
+
+    def __init__(self, caminho: Path):
+        self.caminho = Path(caminho)
+
+    def existe(self) -> bool:
+        return self.caminho.exists()
+
+    def _abrir(self, modo: str = "r"):
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError(
+                "O cubo de resultados precisa do pacote zarr (pip install zarr)"
+            )
+        return zarr.open_group(str(self.caminho), mode=modo)
+
+    def meses(self) -> list:
+        """Meses guardados no cubo, como (ano, mes), por ordem cronológica"""
+        codigos = self._abrir()["tempo"][:]
+        return [(int(c) // 100, int(c) % 100) for c in sorted(codigos) if c]
+
+    def grelha(self) -> GrelhaAlvo:
+        """Grelha (CRS, transform, dimensões) comum a todos os meses do cubo"""
+        return _grelha_de_atributos(self._abrir().attrs)
+
+    @instrumentar()
+    def acrescentar_mes(
+        self,
+        ano: int,
+        mes: int,
+        npp: FonteRaster,
+        fator_conversao: float = 44 / 12,
+        regiao: str = None,
+    ):
+        """
+        Acrescenta (ou substitui) o NPP de um mês
+
+        O primeiro mês define a grelha do cubo; os seguintes são reprojetados
+        para ela se o recorte do Sentinel-2 tiver mudado. Pixeis sem dados
+        ficam NaN.
+
+        Args:
+            ano, mes: Mês dos resultados
+            npp: NPP do mês (gC/m²/mês), GeoTIFF ou RasterMemoria
+            fator_conversao: Fator C -> CO₂
+            regiao: Nome da região (só informativo, nos atributos do cubo)
+        """
+        dados, perfil = ler_banda(npp)
+        nodata = perfil.get("nodata")
+        if nodata is not None and not np.isnan(nodata):
+            dados = np.where(dados == nodata, np.nan, dados)
+
+        if not self.existe():
+            grupo = self._criar(perfil, dados.shape, regiao)
+        else:
+            grupo = self._abrir("r+")
+            grelha = _grelha_de_atributos(grupo.attrs)
+            raster = alinhar_raster(
+                RasterMemoria(dados, dict(perfil, nodata=np.nan)),
+                grelha,
+                Resampling.nearest,
+            )
+            dados = raster.dados
+
+        posicao = _posicao_mes(ano, mes)
+        if posicao < grupo["tempo"].shape[0] and grupo["tempo"][posicao]:
+            logger.info(f"Cubo de resultados: {mes:02d}/{ano} substituido")
+        else:
+            for nome in ("tempo", *VARIAVEIS):
+                array = grupo[nome]
+                if array.shape[0] <= posicao:
+                    array.resize((posicao + 1, *array.shape[1:]))
+            grupo["tempo"][posicao] = _codigo_mes(ano, mes)
+
+        grupo["npp_c"][posicao] = dados
+        grupo["npp_co2"][posicao] = dados * fator_conversao
+        logger.info(f"Cubo de resultados: {mes:02d}/{ano} guardado em {self.caminho}")
+
+    def mapa_mes(self, ano: int, mes: int, variavel: str = "npp_co2") -> RasterMemoria:
+        """Mapa de um mês (lê, em cada bloco espacial, o chunk temporal do seu ano)"""
+        grupo = self._abrir()
+        codigos = list(grupo["tempo"][:])
+        codigo = _codigo_mes(ano, mes)
+        if codigo not in codigos:
+            raise KeyError(f"Mes {mes:02d}/{ano} nao existe no cubo {self.caminho}")
+        dados = grupo[_validar_variavel(variavel)][codigos.index(codigo)]
+        return RasterMemoria(dados, _perfil(grupo.attrs))
+
+    def serie_pixel(
+        self,
+        x: float,
+        y: float,
+        crs=None,
+        inicio: str = None,
+        fim: str = None,
+        variavel: str = "npp_co2",
+    ) -> tuple:
+        """
+        Série temporal de um pixel
+
+        Args:
+            x, y: Coordenadas do ponto, no CRS do cubo ou em crs
+                (ex.: "EPSG:4326" para longitude, latitude)
+            inicio, fim: Limites do período ('AAAA-MM', inclusivos)
+
+        Returns:
+            tuple: (lista de (ano, mes), array de valores), por ordem cronológica
+        """
+        grupo = self._abrir()
+        grelha = _grelha_de_atributos(grupo.attrs)
+        if crs is not None:
+            xs, ys = transformar_coordenadas(crs, grelha.crs, [x], [y])
+            x, y = xs[0], ys[0]
+        linha, coluna = rowcol(grelha.transform, x, y)
+        if not (0 <= linha < grelha.altura and 0 <= coluna < grelha.largura):
+            raise ValueError(f"Ponto ({x}, {y}) fora da extensao do cubo")
+
+        posicoes, meses = _selecionar_meses(grupo["tempo"][:], inicio, fim)
+        valores = grupo[_validar_variavel(variavel)].get_orthogonal_selection(
+            (posicoes, int(linha), int(coluna))
+        )
+        return meses, valores
+
+    def soma_periodo(
+        self, inicio: str = None, fim: str = None, variavel: str = "npp_co2"
+    ) -> RasterMemoria:
+        """
+        Soma, pixel a pixel, dos meses de inicio a fim ('AAAA-MM', inclusivos)
+
+        O cubo é percorrido por blocos espaciais do tamanho dos chunks, pelo
+        que a memória usada não depende do número de meses. Pixeis sem dados
+        em todos os meses ficam NaN.
+        """
+        grupo = self._abrir()
+        array = grupo[_validar_variavel(variavel)]
+        posicoes, meses = _selecionar_meses(grupo["tempo"][:], inicio, fim)
+        _, altura, largura = array.shape
+        soma = np.full((altura, largura), np.nan, dtype=np.float32)
+        if not posicoes:
+            return RasterMemoria(soma, _perfil(grupo.attrs))
+
+        _, chunk_y, chunk_x = array.chunks
+        for y0 in range(0, altura, chunk_y):
+            for x0 in range(0, largura, chunk_x):
+                janela = (slice(y0, y0 + chunk_y), slice(x0, x0 + chunk_x))
+                bloco = array.get_orthogonal_selection((posicoes, *janela))
+                validos = np.isfinite(bloco).any(axis=0)
+                soma[janela] = np.where(validos, np.nansum(bloco, axis=0), np.nan)
+
+        logger.info(
+            f"Cubo de resultados: soma de {variavel} em {len(meses)} meses "
+            f"({meses[0][1]:02d}/{meses[0][0]} a {meses[-1][1]:02d}/{meses[-1][0]})"
+        )
+        return RasterMemoria(soma, _perfil(grupo.attrs))
+
+    def soma_anual(self, ano: int, variavel: str = "npp_co2") -> RasterMemoria:
+        """Soma, pixel a pixel, dos meses de um ano"""
+        return self.soma_periodo(f"{ano}-01", f"{ano}-12", variavel)
+
+    def _criar(self, perfil: dict, forma: tuple, regiao: str):
+        grupo = self._abrir("a")
+        altura, largura = forma
+        chunks = (
+            CHUNK_TEMPO,
+            min(CHUNK_ESPACO, altura),
+            min(CHUNK_ESPACO, largura),
+        )
+        _criar_array(
+            grupo, "tempo", shape=(0,), chunks=(1024,), dtype="int32", fill_value=0
+        )
+        for nome in VARIAVEIS:
+            _criar_array(
+                grupo,
+                nome,
+                shape=(0, altura, largura),
+                chunks=chunks,
+                dtype="float32",
+                fill_value=np.nan,
+            )
+        grupo.attrs.update(
+            {
+                "regiao": regiao,
+                "crs": CRS.from_user_input(perfil["crs"]).to_wkt(),
+                "transform": list(perfil["transform"])[:6],
+                "largura": largura,
+                "altura": altura,
+                "unidades": VARIAVEIS,
+            }
+        )
+        logger.info(f"Cubo de resultados criado: {self.caminho}")
+        return grupo
+
+
+def _criar_array(grupo, nome: str, **opcoes):
+    """Cria um array no grupo (create_array no Zarr 3, create_dataset no 2)"""
+    criar = getattr(grupo, "create_array", None) or grupo.create_dataset
+    return criar(nome, **opcoes)
+
+
+def _validar_variavel(variavel: str) -> str:
+    if variavel not in VARIAVEIS:
+        raise ValueError(
+            f"Variavel desconhecida: '{variavel}'. Disponiveis: {', '.join(VARIAVEIS)}"
+        )
+    return variavel
+
+
+def _selecionar_meses(codigos, inicio: str = None, fim: str = None) -> tuple:
+    """Posições no eixo do tempo dos meses do período, por ordem cronológica"""
+    minimo = _codigo_de_texto(inicio) if inicio else 1
+    maximo = _codigo_de_texto(fim) if fim else 999999
+    selecionados = sorted(
+        (int(c), i) for i, c in enumerate(codigos) if c and minimo <= c <= maximo
+    )
+    posicoes = [i for _, i in selecionados]
+    meses = [(c // 100, c % 100) for c, _ in selecionados]
+    return posicoes, meses
+
+
+def _grelha_de_atributos(atributos) -> GrelhaAlvo:
+    return GrelhaAlvo(
+        CRS.from_wkt(atributos["crs"]),
+        Affine(*atributos["transform"]),
+        atributos["largura"],
+        atributos["altura"],
+    )
+
+
+def _perfil(atributos) -> dict:
+    grelha = _grelha_de_atributos(atributos)
+    return {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "nodata": np.nan,
+        "count": 1,
+        "width": grelha.largura,
+        "height": grelha.altura,
+        "crs": grelha.crs,
+        "transform": grelha.transform,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Consultar o cubo de resultados NPP")
+    parser.add_argument("cubo", type=Path, help=f"caminho do {NOME_CUBO}")
+    parser.add_argument("--variavel", default="npp_co2", choices=list(VARIAVEIS))
+    parser.add_argument("--inicio", help="primeiro mês (AAAA-MM)")
+    parser.add_argument("--fim", help="último mês (AAAA-MM)")
+    parser.add_argument(
+        "--pixel",
+        nargs=2,
+        type=float,
+        metavar=("LON", "LAT"),
+        help="série temporal do pixel que contém o ponto (graus)",
+    )
+    parser.add_argument(
+        "--soma", type=Path, metavar="TIF", help="escreve a soma do período"
+    )
+    parser.add_argument(
+        "--classe",
+        default="resultado",
+        choices=["resultado", "arquivo"],
+        help="classe de saída da soma (COG ZSTD ou COG DEFLATE, ver escrita_raster)",
+    )
+    args = parser.parse_args()
+
+    cubo = CuboResultados(args.cubo)
+    if args.pixel:
+        meses, valores = cubo.serie_pixel(
+            *args.pixel, "EPSG:4326", args.inicio, args.fim, args.variavel
+        )
+        for (ano, mes), valor in zip(meses, valores):
+            print(f"{ano}-{mes:02d}  {valor:10.3f} {VARIAVEIS[args.variavel]}")
+    elif args.soma:
+        soma = cubo.soma_periodo(args.inicio, args.fim, args.variavel)
+        guardar_raster(args.soma, soma.dados, soma.perfil, classe=args.classe)
+        print(f"Soma escrita em: {args.soma}")
+    else:
+        for ano, mes in cubo.meses():
+            print(f"{ano}-{mes:02d}")
@@ -0,0 +1,207 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+
+# Opções de escrita por classe de saída:
+#   intermedio - GeoTIFF em blocos, compressão rápida, sem overviews (NDVI,
+#                FPAR, WSC, T2, SOL, E_max, recortes): lido por janelas no pipeline
+#   resultado  - Cloud-Optimized GeoTIFF com overviews internas (NPP, CO₂),
+#                abre rapidamente no QGIS ou num servidor de tiles
+#   arquivo    - COG com DEFLATE, lido por qualquer versão do GDAL/QGIS
+# codec: ZSTD ou DEFLATE, com PREDICTOR 3 em float e 2 em inteiros; nivel:
+# nível de compressão do codec. definir_classe altera estas opções.
+CLASSES_SAIDA = {
+    "intermedio": {"cog": False, "codec": "ZSTD", "nivel": 1},
+    "resultado": {"cog": True, "codec": "ZSTD", "nivel": 9},
+    "arquivo": {"cog": True, "codec": "DEFLATE", "nivel": 6},
+}
+
+# Lado (pixeis) dos blocos internos do GeoTIFF/COG
+TAMANHO_BLOCO = 512
+
+# Threads de compressão do GDAL (NUM_THREADS)
+THREADS_COMPRESSAO = "ALL_CPUS"
+
+# Chaves de um perfil rasterio que dizem respeito à codificação e que são
+# substituídas pelas da classe de saída
+_CHAVES_CODIFICACAO = {
+    "driver",
+    "compress",
+    "predictor",
+    "zlevel",
+    "zstd_level",
+    "tiled",
+    "blockxsize",
+    "blockysize",
+    "interleave",
+    "bigtiff",
+    "num_threads",
+}
+
+
+def definir_classe(classe: str, **opcoes):
+    """Altera as opções de uma classe de saída (ex.: codec="DEFLATE", cog=True)"""
+    if classe not in CLASSES_SAIDA:
+        raise ValueError(
+            f"Classe de saida desconhecida: {classe} (validas: {', '.join(CLASSES_SAIDA)})"
+        )
+    CLASSES_SAIDA[classe].update(opcoes)
+
+
+def _preditor(dtype) -> int:
+    return 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+
+
+def _opcoes_codec(classe: str, dtype, cog: bool) -> dict:
+    """Opções de criação GDAL do codec da classe (o COG usa LEVEL em vez de ZLEVEL/ZSTD_LEVEL)"""
+    opcoes = CLASSES_SAIDA[classe]
+    codec = opcoes["codec"].upper()
+    resultado = {
+        "compress": codec,
+        "predictor": _preditor(dtype),
+        "num_threads": THREADS_COMPRESSAO,
+        "bigtiff": "IF_SAFER",
+    }
+    if opcoes.get("nivel") is not None:
+        chave = "level" if cog else {"ZSTD": "zstd_level", "DEFLATE": "zlevel"}[codec]
+        resultado[chave] = opcoes["nivel"]
+    return resultado
+
+
+def perfil_escrita(perfil: dict, classe: str = "intermedio", **atualizacoes) -> dict:
+    """
+    Perfil rasterio para escrever diretamente um GeoTIFF em blocos com o codec
+    da classe (as opções de codificação do perfil de origem são descartadas)
+    """
+    prof = {k: v for k, v in perfil.items() if k.lower() not in _CHAVES_CODIFICACAO}
+    prof.update(atualizacoes)
+    prof.update(
+        driver="GTiff",
+        tiled=True,
+        blockxsize=TAMANHO_BLOCO,
+        blockysize=TAMANHO_BLOCO,
+        **_opcoes_codec(classe, prof["dtype"], cog=False),
+    )
+    return prof
+
+
+def _perfil_temporario(perfil: dict, **atualizacoes) -> dict:
+    """GeoTIFF em blocos sem compressão, para converter depois em COG"""
+    prof = {k: v for k, v in perfil.items() if k.lower() not in _CHAVES_CODIFICACAO}
+    prof.update(atualizacoes)
+    prof.update(
+        driver="GTiff",
+        tiled=True,
+        blockxsize=TAMANHO_BLOCO,
+        blockysize=TAMANHO_BLOCO,
+        bigtiff="IF_SAFER",
+    )
+    return prof
+
+
+def e_cog(classe: str) -> bool:
+    return CLASSES_SAIDA[classe]["cog"]
+
+
+def converter_cog(src, destino, classe: str = "resultado"):
+    """
+    Copia um dataset aberto para um COG com overviews internas
+
+    As overviews usam média em float e vizinho mais próximo em inteiros
+    (classes); nomes das bandas e tags são mantidos.
+    """
+    dtype = src.dtypes[0]
+    rasterio.shutil.copy(
+        src,
+        destino,
+        driver="COG",
+        blocksize=TAMANHO_BLOCO,
+        overviews="AUTO",
+        overview_resampling=(
+            "AVERAGE" if np.issubdtype(np.dtype(dtype), np.floating) else "NEAREST"
+        ),
+        **_opcoes_codec(classe, dtype, cog=True),
+    )
+    return destino
+
+
+def _metadados(dst, descricoes, tags):
+    for i, descricao in enumerate(descricoes or (), start=1):
+        dst.set_band_description(i, descricao or f"band_{i}")
+    if tags:
+        dst.update_tags(**tags)
+
+
+def escrever_raster(
+    caminho,
+    dados: np.ndarray,
+    perfil: dict,
+    classe: str = "intermedio",
+    descricoes: tuple = None,
+    tags: dict = None,
+    **atualizacoes,
+):
+    """
+    Escreve um array 2D (uma banda) ou 3D (várias bandas) com as opções da
+    classe de saída (ver CLASSES_SAIDA)
+
+    Nas classes COG os dados passam por um GeoTIFF em memória, de onde o
+    GDAL gera as overviews e o COG final.
+    """
+    bandas = dados if dados.ndim == 3 else dados[np.newaxis]
+    atualizacoes.update(count=bandas.shape[0])
+
+    if not e_cog(classe):
+        prof = perfil_escrita(perfil, classe, **atualizacoes)
+        with rasterio.open(caminho, "w", **prof) as dst:
+            dst.write(bandas.astype(prof["dtype"], copy=False))
+            _metadados(dst, descricoes, tags)
+        return caminho
+
+    prof = _perfil_temporario(perfil, **atualizacoes)
+    with MemoryFile() as memoria:
+        with memoria.open(**prof) as tmp:
+            tmp.write(bandas.astype(prof["dtype"], copy=False))
+            _metadados(tmp, descricoes, tags)
+        with memoria.open() as tmp:
+            converter_cog(tmp, caminho, classe)
+    return caminho
+
+
+class DestinoBlocos:
+    """
+    GeoTIFF escrito por janelas com as opções da classe de saída
+
+    Nas classes COG as janelas vão para um GeoTIFF temporário sem compressão
+    ao lado do destino, convertido em COG (e apagado) no fecho sem erros.
+    """
+
+    def __init__(self, caminho, perfil: dict, classe: str = "intermedio"):
+        self.caminho = Path(caminho)
+        self.classe = classe
+        if e_cog(classe):
+            self._escrita = self.caminho.with_name(self.caminho.stem + ".parcial.tif")
+            self.perfil = _perfil_temporario(perfil)
+        else:
+            self._escrita = self.caminho
+            self.perfil = perfil_escrita(perfil, classe)
+        self._dst = None
+
+    def __enter__(self):
+        self._dst = rasterio.open(self._escrita, "w", **self.perfil)
+        return self._dst
+
+    def __exit__(self, tipo, *exc):
+        self._dst.close()
+        if self._escrita == self.caminho:
+            return
+        try:
+            if tipo is None:
+                with rasterio.open(self._escrita) as src:
+                    converter_cog(src, self.caminho, self.classe)
+        finally:
+            os.remove(self._escrita)
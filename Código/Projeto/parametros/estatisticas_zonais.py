@@ -0,0 +1,200 @@
+import csv
+import os
+import logging
+import numpy as np
+from pathlib import Path
+from rasterio.enums import Resampling
+from rasterio.features import rasterize
+
+from parametros.raster_io import GrelhaAlvo, RasterMemoria
+from parametros.Param_Emax import ler_mosaicos_na_grelha
+from parametros.instrumentacao import instrumentar
+
+logger = logging.getLogger(__name__)
+
+# Percentis calculados por zona
+PERCENTIS = (10, 50, 90)
+
+# Legenda das classes ESA WorldCover
+CLASSES_WORLDCOVER = {
+    10: "Arvores",
+    20: "Arbustos",
+    30: "Pastagem",
+    40: "Agricultura",
+    50: "Construido",
+    60: "Solo nu / vegetacao esparsa",
+    70: "Neve e gelo",
+    80: "Agua",
+    90: "Zona humida herbacea",
+    95: "Mangal",
+    100: "Musgo e liquen",
+}
+
+
+def nomes_zonas_vetoriais(caminho_zonas, campo: str) -> list:
+    """
+    Nomes das zonas de uma camada vetorial, pela ordem do índice (1, 2, ...)
+
+    Só a tabela de atributos é lida (sem geometrias).
+    """
+    import geopandas as gpd
+
+    os.environ["SHAPE_RESTORE_SHX"] = "YES"
+    tabela = gpd.read_file(caminho_zonas, ignore_geometry=True)
+    return sorted(str(valor) for valor in tabela[campo].unique())
+
+
+@instrumentar()
+def rasterizar_zonas(caminho_zonas, campo: str, grelha: GrelhaAlvo) -> RasterMemoria:
+    """
+    Rasteriza uma camada vetorial de zonas (freguesias, parques, ...) na grelha
+
+    Cada pixel recebe o índice (1..N) da zona que o contém, pela ordem de
+    nomes_zonas_vetoriais; 0 fica fora de todas as zonas. Polígonos com o
+    mesmo valor de campo partilham o índice. Todas as zonas são rasterizadas
+    numa única chamada.
+    """
+    import geopandas as gpd
+
+    os.environ["SHAPE_RESTORE_SHX"] = "YES"
+    gdf = gpd.read_file(caminho_zonas).to_crs(grelha.crs)
+    nomes = sorted(str(valor) for valor in gdf[campo].unique())
+    codigo = {nome: i for i, nome in enumerate(nomes, start=1)}
+
+    indice = rasterize(
+        (
+            (geom, codigo[str(valor)])
+            for geom, valor in zip(gdf.geometry, gdf[campo])
+            if geom is not None
+        ),
+        out_shape=grelha.forma,
+        transform=grelha.transform,
+        fill=0,
+        dtype="int32",
+    )
+    logger.info(f"Zonas rasterizadas: {caminho_zonas} ({len(nomes)} zonas)")
+
+    perfil = {
+        "driver": "GTiff",
+        "dtype": "int32",
+        "nodata": 0,
+        "count": 1,
+        "width": grelha.largura,
+        "height": grelha.altura,
+        "crs": grelha.crs,
+        "transform": grelha.transform,
+    }
+    return RasterMemoria(indice, perfil)
+
+
+@instrumentar()
+def classes_worldcover(mosaicos, grelha: GrelhaAlvo) -> RasterMemoria:
+    """Classes ESA WorldCover na grelha, para usar como índice de zonas"""
+    if not isinstance(mosaicos, (list, tuple)):
+        mosaicos = [mosaicos]
+    classes, perfil, nodata = ler_mosaicos_na_grelha(
+        mosaicos, grelha, Resampling.nearest
+    )
+    perfil.update(
+        width=grelha.largura,
+        height=grelha.altura,
+        crs=grelha.crs,
+        transform=grelha.transform,
+        count=1,
+        nodata=nodata,
+    )
+    return RasterMemoria(classes, perfil)
+
+
+@instrumentar()
+def estatisticas_zonais(
+    valores: np.ndarray,
+    indice: np.ndarray,
+    nomes: dict = None,
+    percentis: tuple = PERCENTIS,
+) -> list:
+    """
+    Contagem, soma, média, mínimo, máximo e percentis de valores por zona
+
+    Todas as zonas são calculadas de uma vez: somas e contagens com
+    np.bincount e percentis a partir de uma única ordenação por (zona, valor),
+    em vez de um recorte por polígono. Pixeis com índice <= 0 ou valor não
+    finito são ignorados.
+
+    Args:
+        valores: Raster de valores (ex.: NPP), na mesma grelha que indice
+        indice: Raster inteiro com o índice da zona de cada pixel
+        nomes: {índice: nome} das zonas (por omissão o próprio índice)
+        percentis: Percentis (0-100) a calcular
+
+    Returns:
+        list: Uma linha (dict) por zona com pelo menos um pixel válido
+    """
+    if valores.shape != indice.shape:
+        raise ValueError(
+            f"Valores {valores.shape} e zonas {indice.shape} em grelhas diferentes"
+        )
+
+    validos = (indice > 0) & np.isfinite(valores)
+    zonas = indice[validos].astype(np.int64)
+    v = valores[validos].astype(np.float64)
+    if zonas.size == 0:
+        return []
+
+    n = int(zonas.max()) + 1
+    contagem = np.bincount(zonas, minlength=n)
+    soma = np.bincount(zonas, weights=v, minlength=n)
+
+    # Ordenação única por zona e, dentro da zona, por valor
+    ordem = np.lexsort((v, zonas))
+    ordenados = v[ordem]
+    inicio = np.concatenate(([0], np.cumsum(contagem)[:-1]))
+    presentes = np.nonzero(contagem)[0]
+    inicio_p = inicio[presentes]
+    contagem_p = contagem[presentes]
+
+    minimo = ordenados[inicio_p]
+    maximo = ordenados[inicio_p + contagem_p - 1]
+
+    # Percentis por interpolação linear (como np.percentile), para todas as zonas
+    valores_percentis = {}
+    for q in percentis:
+        posicao = (contagem_p - 1) * (q / 100.0)
+        abaixo = np.floor(posicao).astype(np.int64)
+        acima = np.minimum(abaixo + 1, contagem_p - 1)
+        fracao = posicao - abaixo
+        inferior = ordenados[inicio_p + abaixo]
+        superior = ordenados[inicio_p + acima]
+        valores_percentis[q] = inferior + (superior - inferior) * fracao
+
+    nomes = nomes or {}
+    linhas = []
+    for i, zona in enumerate(presentes):
+        linha = {
+            "zona": int(zona),
+            "nome": nomes.get(int(zona), str(zona)),
+            "contagem": int(contagem_p[i]),
+            "soma": float(soma[zona]),
+            "media": float(soma[zona] / contagem_p[i]),
+            "minimo": float(minimo[i]),
+            "maximo": float(maximo[i]),
+        }
+        for q in percentis:
+            linha[f"p{q}"] = float(valores_percentis[q][i])
+        linhas.append(linha)
+    return linhas
+
+
+def exportar_csv(linhas: list, caminho: Path) -> Path:
+    """Escreve as linhas de estatísticas (dicts) numa tabela CSV"""
+    if not linhas:
+        logger.warning(f"Sem estatisticas zonais para exportar: {caminho}")
+        return None
+
+    colunas = list(linhas[0].keys())
+    with open(caminho, "w", newline="", encoding="utf-8") as f:
+        escritor = csv.DictWriter(f, fieldnames=colunas, delimiter=";")
+        escritor.writeheader()
+        escritor.writerows(linhas)
+    logger.info(f"Estatisticas zonais salvas em: {caminho}")
+    return caminho
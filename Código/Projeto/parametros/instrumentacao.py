@@ -0,0 +1,337 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Intervalo (s) entre leituras da memória residente durante uma sessão
+INTERVALO_AMOSTRAGEM = 0.02
+
+try:
+    import psutil
+except ImportError:  # opcional: sem psutil usa-se /proc (Linux) ou resource
+    psutil = None
+
+
+def _rss_bytes() -> int:
+    """Memória residente atual do processo (None se não for possível obtê-la)"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+
+        # Sem valor instantâneo: pico do processo (kB em Linux, bytes em macOS)
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico if sys.platform == "darwin" else pico * 1024
+    except ImportError:
+        return None
+
+
+def _io_bytes() -> tuple:
+    """(bytes lidos, bytes escritos) pelo processo até agora, ou (None, None)"""
+    try:
+        with open("/proc/self/io") as f:
+            contadores = dict(linha.split(": ") for linha in f.read().splitlines())
+        return int(contadores["rchar"]), int(contadores["wchar"])
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            io = psutil.Process().io_counters()
+            return io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    return None, None
+
+
+def contar_pixeis(resultado) -> int:
+    """
+    Pixeis (x bandas) de um resultado: raster em memória, array, GeoTIFF ou
+    tuplo/dict destes (None se não tiver rasters)
+    """
+    from parametros.raster_io import RasterMemoria
+
+    if isinstance(resultado, RasterMemoria):
+        return int(resultado.dados.size)
+    if isinstance(resultado, np.ndarray):
+        return int(resultado.size)
+    if isinstance(resultado, (str, Path)) and str(resultado).lower().endswith(
+        (".tif", ".tiff")
+    ):
+        import rasterio
+
+        try:
+            with rasterio.open(resultado) as src:
+                return src.width * src.height * src.count
+        except Exception:
+            return None
+    if isinstance(resultado, (tuple, dict)):
+        valores = resultado.values() if isinstance(resultado, dict) else resultado
+        contagens = [contar_pixeis(r) for r in valores]
+        contagens = [c for c in contagens if c is not None]
+        return sum(contagens) if contagens else None
+    return None
+
+
+class _Sessao:
+    """Registos de uma sessão de instrumentação e amostragem da memória"""
+
+    def __init__(self, perfilar: bool, diretoria_perfis: Path):
+        self.perfilar = perfilar
+        self.diretoria_perfis = Path(diretoria_perfis) if diretoria_perfis else None
+        self.inicio = time.time()
+        self.inicio_perf = time.perf_counter()
+        self.registos = []
+        self.abertos = []
+        self.rss_pico = _rss_bytes()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self._parar = threading.Event()
+        self._amostrador = threading.Thread(
+            target=self._amostrar, name="instrumentacao-rss", daemon=True
+        )
+        self._amostrador.start()
+
+    def _amostrar(self):
+        while not self._parar.wait(INTERVALO_AMOSTRAGEM):
+            rss = _rss_bytes()
+            if rss is None:
+                return
+            with self.lock:
+                self.rss_pico = max(self.rss_pico or 0, rss)
+                for registo in self.abertos:
+                    registo["_rss_pico"] = max(registo["_rss_pico"] or 0, rss)
+
+    def parar(self):
+        self._parar.set()
+        self._amostrador.join()
+
+
+_sessao = None
+
+
+def ativar(perfilar: bool = False, diretoria_perfis: Path = None):
+    """
+    Inicia uma sessão de instrumentação no processo
+
+    perfilar: guarda também um perfil cProfile (.prof) por chamada de topo
+    em diretoria_perfis (ver pstats/snakeviz).
+    """
+    global _sessao
+    if _sessao is not None:
+        _sessao.parar()
+    _sessao = _Sessao(perfilar, diretoria_perfis)
+    logger.info("Instrumentacao ativa")
+
+
+def desativar() -> dict:
+    """Termina a sessão e devolve o relatório (None se não estava ativa)"""
+    global _sessao
+    if _sessao is None:
+        return None
+    dados = relatorio()
+    _sessao.parar()
+    _sessao = None
+    return dados
+
+
+def ativa() -> bool:
+    return _sessao is not None
+
+
+@contextmanager
+def medir(nome: str):
+    """
+    Mede um bloco de código: tempo real e de CPU, pico de memória residente,
+    bytes lidos/escritos e pixeis processados (registo["pixeis"], preenchido
+    por quem mede). CPU, memória e I/O são do processo inteiro, pelo que
+    incluem o trabalho de outras threads ativas no mesmo intervalo.
+
+    Sem sessão ativa não faz nada (custo de uma comparação).
+    """
+    sessao = _sessao
+    if sessao is None:
+        yield {}
+        return
+
+    pilha = getattr(sessao.local, "pilha", None)
+    if pilha is None:
+        pilha = sessao.local.pilha = []
+    lidos, escritos = _io_bytes()
+    rss = _rss_bytes()
+    registo = {
+        "nome": nome,
+        "pai": pilha[-1]["nome"] if pilha else None,
+        "thread": threading.current_thread().name,
+        "inicio_s": round(time.perf_counter() - sessao.inicio_perf, 4),
+        "_wall": time.perf_counter(),
+        "_cpu": time.process_time(),
+        "_io": (lidos, escritos),
+        "_rss_inicio": rss,
+        "_rss_pico": rss,
+        "pixeis": None,
+    }
+
+    perfil = None
+    if sessao.perfilar and sessao.diretoria_perfis and not pilha:
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Outro perfil ativo noutra thread: esta chamada fica sem perfil
+            perfil = None
+
+    pilha.append(registo)
+    with sessao.lock:
+        sessao.abertos.append(registo)
+    try:
+        yield registo
+    except BaseException as e:
+        registo["erro"] = repr(e)
+        raise
+    finally:
+        if perfil is not None:
+            perfil.disable()
+        pilha.pop()
+        lidos, escritos = _io_bytes()
+        rss = _rss_bytes()
+        with sessao.lock:
+            sessao.abertos.remove(registo)
+            lidos_inicio, escritos_inicio = registo.pop("_io")
+            pico = max(registo.pop("_rss_pico") or 0, rss or 0) or None
+            registo.update(
+                duracao_s=round(time.perf_counter() - registo.pop("_wall"), 4),
+                cpu_s=round(time.process_time() - registo.pop("_cpu"), 4),
+                rss_inicio_mb=_mb(registo.pop("_rss_inicio")),
+                rss_pico_mb=_mb(pico),
+                bytes_lidos=_diferenca(lidos, lidos_inicio),
+                bytes_escritos=_diferenca(escritos, escritos_inicio),
+            )
+            if perfil is not None:
+                registo["perfil"] = str(_guardar_perfil(sessao, perfil, nome))
+            sessao.registos.append(registo)
+
+
+def instrumentar(nome: str = None):
+    """
+    Decorador: mede cada chamada da função com medir()
+
+    Os pixeis processados são obtidos do valor devolvido (RasterMemoria,
+    array ou caminho de GeoTIFF). Sem sessão ativa a função é chamada
+    diretamente.
+    """
+
+    def decorador(funcao):
+        etiqueta = nome or funcao.__qualname__
+
+        @functools.wraps(funcao)
+        def envolvida(*args, **kwargs):
+            if _sessao is None:
+                return funcao(*args, **kwargs)
+            with medir(etiqueta) as registo:
+                resultado = funcao(*args, **kwargs)
+                registo["pixeis"] = contar_pixeis(resultado)
+                return resultado
+
+        return envolvida
+
+    return decorador
+
+
+def relatorio() -> dict:
+    """Relatório da sessão atual: uma entrada por chamada e um resumo por nome"""
+    sessao = _sessao
+    if sessao is None:
+        return None
+
+    with sessao.lock:
+        registos = list(sessao.registos)
+        rss_pico = sessao.rss_pico
+
+    resumo = {}
+    for registo in registos:
+        total = resumo.setdefault(
+            registo["nome"],
+            {
+                "chamadas": 0,
+                "duracao_s": 0.0,
+                "cpu_s": 0.0,
+                "bytes_lidos": 0,
+                "bytes_escritos": 0,
+                "pixeis": 0,
+                "rss_pico_mb": 0.0,
+            },
+        )
+        total["chamadas"] += 1
+        for campo in ("duracao_s", "cpu_s", "bytes_lidos", "bytes_escritos", "pixeis"):
+            total[campo] += registo[campo] or 0
+        total["rss_pico_mb"] = max(total["rss_pico_mb"], registo["rss_pico_mb"] or 0)
+    for total in resumo.values():
+        total["duracao_s"] = round(total["duracao_s"], 4)
+        total["cpu_s"] = round(total["cpu_s"], 4)
+
+    return {
+        "inicio": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sessao.inicio)),
+        "duracao_s": round(time.perf_counter() - sessao.inicio_perf, 4),
+        "rss_pico_mb": _mb(rss_pico),
+        "plataforma": dados_plataforma(),
+        "resumo": resumo,
+        "chamadas": registos,
+    }
+
+
+def dados_plataforma() -> dict:
+    """Versão do Python, sistema e CPUs, para comparar relatórios entre máquinas"""
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "sistema": platform.platform(),
+        "cpus": os.cpu_count(),
+        "psutil": psutil is not None,
+    }
+
+
+def escrever_relatorio(caminho: Path, **extra) -> Path:
+    """Escreve o relatório da sessão atual em JSON (extra: campos adicionais)"""
+    dados = relatorio()
+    if dados is None:
+        return None
+    dados.update(extra)
+    caminho = Path(caminho)
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(dados, f, indent=2, default=str)
+    logger.info(f"Relatorio de execucao salvo em: {caminho}")
+    return caminho
+
+
+def _guardar_perfil(sessao: _Sessao, perfil: cProfile.Profile, nome: str) -> Path:
+    sessao.diretoria_perfis.mkdir(parents=True, exist_ok=True)
+    base = re.sub(r"[^\w.-]+", "_", nome)
+    caminho = sessao.diretoria_perfis / f"{base}_{len(sessao.registos):03d}.prof"
+    perfil.dump_stats(caminho)
+    return caminho
+
+
+def _mb(valor) -> float:
+    return round(valor / 1024**2, 1) if valor is not None else None
+
+
+def _diferenca(fim, inicio) -> int:
+    return fim - inicio if fim is not None and inicio is not None else None
@@ -0,0 +1,527 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Backends suportados (numpy, a referência, está sempre disponível)
+BACKENDS = ("numexpr", "numba", "numpy")
+
+# Escolha validada por escolher_backend (a única usada em "auto")
+FICHEIRO_ESCOLHA = (
+    Path(__file__).parent.parent.resolve() / "CACHE" / "kernels" / "backend.json"
+)
+
+# Tolerância face ao NumPy (float32) para um backend ser aceite
+RTOL = 1e-5
+ATOL = 1e-6
+
+# Parâmetros do FPAR (Param_FPAR)
+FPAR_MAX = 0.95
+FPAR_MIN = 0.001
+
+_backend = "auto"
+_resolvido = None
+_lock = threading.Lock()
+
+
+# --- NumPy (referência) ---
+
+
+def _ndvi_numpy(red, nir):
+    denominador = nir + red
+    ndvi = np.zeros_like(red, dtype=np.float32)
+    validos = denominador != 0
+    ndvi[validos] = (nir[validos] - red[validos]) / denominador[validos]
+    ndvi[~validos] = np.nan
+    return ndvi
+
+
+def _fpar_numpy(ndvi, minimo, maximo, nodata):
+    validos = (ndvi != nodata) & (~np.isnan(ndvi))
+    fpar = np.full(ndvi.shape, nodata, dtype=np.float32)
+    fpar[validos] = (
+        (ndvi[validos] - minimo) * (FPAR_MAX - FPAR_MIN) / (maximo - minimo)
+    ) + FPAR_MIN
+    return fpar
+
+
+def _simi_numpy(b11, b12):
+    b11 = b11 / 10000.0
+    b12 = b12 / 10000.0
+    return 0.7071 * np.sqrt(np.square(b11) + np.square(b12))
+
+
+def _wsc_numpy(simi, minimo, maximo):
+    nsimi = (simi - minimo) / (maximo - minimo)
+    wsc = 0.5 + 0.5 * (1 - nsimi)
+    wsc[~np.isfinite(wsc)] = np.nan
+    return wsc.astype(np.float32, copy=False)
+
+
+def _t2_numpy(t_media, topt):
+    temp1 = np.exp(0.2 * (topt - 10 - t_media))
+    temp2 = np.exp(0.3 * (-topt - 10 + t_media))
+    return 1.1814 / (1 + temp1) * (1 / (1 + temp2))
+
+
+def _npp_numpy(sol, fpar, t1, t2, wsc, emax):
+    npp = sol * np.float32(0.5)
+    npp *= fpar
+    npp *= t1
+    npp *= t2
+    npp *= wsc
+    npp *= emax
+    return npp
+
+
+# --- numexpr: uma passagem por expressão, multithread ---
+
+
+def _implementacoes_numexpr() -> dict:
+    import numexpr as ne
+
+    f32 = np.float32
+
+    def avaliar(expressao, **variaveis):
+        return ne.evaluate(expressao, local_dict=variaveis)
+
+    def ndvi(red, nir):
+        return avaliar(
+            "where(nir + red != 0, (nir - red) / (nir + red), nan)",
+            red=red,
+            nir=nir,
+            nan=f32(np.nan),
+        )
+
+    def fpar(ndvi, minimo, maximo, nodata):
+        return avaliar(
+            "where((ndvi != nodata) & (ndvi == ndvi), (ndvi - minimo) * escala + fmin, nodata)",
+            ndvi=ndvi,
+            minimo=f32(minimo),
+            escala=f32((FPAR_MAX - FPAR_MIN) / (maximo - minimo)),
+            fmin=f32(FPAR_MIN),
+            nodata=f32(nodata),
+        )
+
+    def simi(b11, b12):
+        return avaliar(
+            "k * sqrt(b11 * b11 + b12 * b12)", b11=b11, b12=b12, k=f32(0.7071e-4)
+        )
+
+    def wsc(simi, minimo, maximo):
+        return avaliar(
+            "where(abs(w) < inf, w, nan)",
+            w=avaliar(
+                "uno - meio * (simi - minimo) / amplitude",
+                simi=simi,
+                minimo=f32(minimo),
+                amplitude=f32(maximo - minimo),
+                uno=f32(1.0),
+                meio=f32(0.5),
+            ),
+            inf=f32(np.inf),
+            nan=f32(np.nan),
+        )
+
+    def t2(t_media, topt):
+        return avaliar(
+            "c / ((uno + exp(a * (topt - dez - t))) * (uno + exp(b * (t - topt - dez))))",
+            t=t_media,
+            topt=f32(topt),
+            a=f32(0.2),
+            b=f32(0.3),
+            c=f32(1.1814),
+            dez=f32(10.0),
+            uno=f32(1.0),
+        )
+
+    def npp(sol, fpar, t1, t2, wsc, emax):
+        return avaliar(
+            "k * sol * fpar * t2 * wsc * emax",
+            sol=sol,
+            fpar=fpar,
+            t2=t2,
+            wsc=wsc,
+            emax=emax,
+            k=f32(0.5 * t1),
+        )
+
+    return {
+        "ndvi": ndvi,
+        "fpar": fpar,
+        "simi": simi,
+        "wsc": wsc,
+        "t2": t2,
+        "npp": npp,
+    }
+
+
+# --- numba: ciclos compilados (JIT), paralelos por pixel ---
+
+
+def _implementacoes_numba() -> dict:
+    import math
+
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def _ndvi(red, nir, out):
+        for i in prange(out.size):
+            d = nir[i] + red[i]
+            out[i] = (nir[i] - red[i]) / d if d != 0 else np.nan
+
+    @njit(parallel=True, cache=True)
+    def _fpar(ndvi, minimo, escala, nodata, nodata_nan, out):
+        for i in prange(out.size):
+            v = ndvi[i]
+            if math.isnan(v) or (not nodata_nan and v == nodata):
+                out[i] = nodata
+            else:
+                out[i] = (v - minimo) * escala + FPAR_MIN
+
+    @njit(parallel=True, cache=True)
+    def _simi(b11, b12, out):
+        for i in prange(out.size):
+            out[i] = 0.7071e-4 * math.sqrt(b11[i] * b11[i] + b12[i] * b12[i])
+
+    @njit(parallel=True, cache=True)
+    def _wsc(simi, minimo, amplitude, out):
+        for i in prange(out.size):
+            w = 1.0 - 0.5 * (simi[i] - minimo) / amplitude
+            out[i] = w if math.isfinite(w) else np.nan
+
+    @njit(parallel=True, cache=True)
+    def _t2(t, topt, out):
+        for i in prange(out.size):
+            out[i] = 1.1814 / (
+                (1.0 + math.exp(0.2 * (topt - 10.0 - t[i])))
+                * (1.0 + math.exp(0.3 * (-topt - 10.0 + t[i])))
+            )
+
+    @njit(parallel=True, cache=True)
+    def _npp(sol, fpar, k, t2, wsc, emax, out):
+        for i in prange(out.size):
+            out[i] = k * sol[i] * fpar[i] * t2[i] * wsc[i] * emax[i]
+
+    def plano(*arrays):
+        return [np.ascontiguousarray(a, dtype=np.float32).ravel() for a in arrays]
+
+    def ndvi(red, nir):
+        out = np.empty(red.shape, dtype=np.float32)
+        _ndvi(*plano(red, nir), out.ravel())
+        return out
+
+    def fpar(ndvi, minimo, maximo, nodata):
+        out = np.empty(ndvi.shape, dtype=np.float32)
+        (v,) = plano(ndvi)
+        _fpar(
+            v,
+            np.float32(minimo),
+            np.float32((FPAR_MAX - FPAR_MIN) / (maximo - minimo)),
+            np.float32(nodata),
+            bool(np.isnan(nodata)),
+            out.ravel(),
+        )
+        return out
+
+    def simi(b11, b12):
+        out = np.empty(b11.shape, dtype=np.float32)
+        _simi(*plano(b11, b12), out.ravel())
+        return out
+
+    def wsc(simi, minimo, maximo):
+        out = np.empty(simi.shape, dtype=np.float32)
+        (s,) = plano(simi)
+        _wsc(s, np.float32(minimo), np.float32(maximo - minimo), out.ravel())
+        return out
+
+    def t2(t_media, topt):
+        out = np.empty(t_media.shape, dtype=np.float32)
+        (t,) = plano(t_media)
+        _t2(t, np.float32(topt), out.ravel())
+        return out
+
+    def npp(sol, fpar, t1, t2, wsc, emax):
+        out = np.empty(sol.shape, dtype=np.float32)
+        s, f, t, w, e = plano(sol, fpar, t2, wsc, emax)
+        _npp(s, f, np.float32(0.5 * t1), t, w, e, out.ravel())
+        return out
+
+    return {
+        "ndvi": ndvi,
+        "fpar": fpar,
+        "simi": simi,
+        "wsc": wsc,
+        "t2": t2,
+        "npp": npp,
+    }
+
+
+_IMPLEMENTACOES = {
+    "numpy": {
+        "ndvi": _ndvi_numpy,
+        "fpar": _fpar_numpy,
+        "simi": _simi_numpy,
+        "wsc": _wsc_numpy,
+        "t2": _t2_numpy,
+        "npp": _npp_numpy,
+    }
+}
+_FABRICAS = {"numexpr": _implementacoes_numexpr, "numba": _implementacoes_numba}
+_indisponiveis = set()
+
+
+def _implementacoes(nome: str) -> dict:
+    """Kernels de um backend (carregados na primeira utilização), ou None"""
+    with _lock:
+        if nome in _IMPLEMENTACOES:
+            return _IMPLEMENTACOES[nome]
+        if nome in _indisponiveis or nome not in _FABRICAS:
+            return None
+        try:
+            _IMPLEMENTACOES[nome] = _FABRICAS[nome]()
+        except ImportError:
+            _indisponiveis.add(nome)
+            return None
+        return _IMPLEMENTACOES[nome]
+
+
+def backends_disponiveis() -> list:
+    """Backends instalados"""
+    return [nome for nome in BACKENDS if _implementacoes(nome) is not None]
+
+
+def definir_backend(nome: str):
+    """
+    Escolhe o backend dos kernels: "numpy", "numexpr", "numba" ou "auto"
+
+    "auto" usa a escolha guardada por escolher_backend (se esse backend
+    estiver instalado); sem escolha validada usa o NumPy, a referência.
+    """
+    global _backend, _resolvido
+    if nome != "auto" and nome not in BACKENDS:
+        raise ValueError(f"Backend desconhecido: {nome} (use {', '.join(BACKENDS)})")
+    _backend = nome
+    _resolvido = None
+
+
+def backend_ativo() -> str:
+    """Backend efetivamente usado pelos kernels (resolve "auto")"""
+    global _resolvido
+    if _resolvido is not None:
+        return _resolvido
+
+    nome = _backend
+    if nome == "auto":
+        nome = _escolha_guardada()
+        if nome is None or _implementacoes(nome) is None:
+            nome = "numpy"
+    elif _implementacoes(nome) is None:
+        logger.warning(f"Backend {nome} nao instalado, a usar numpy")
+        nome = "numpy"
+    _resolvido = nome
+    logger.info(f"Backend dos kernels: {nome}")
+    return nome
+
+
+def _executar(kernel: str, *args):
+    """Executa um kernel no backend ativo; se este falhar, volta ao NumPy"""
+    global _resolvido
+    nome = backend_ativo()
+    if nome == "numpy":
+        return _IMPLEMENTACOES["numpy"][kernel](*args)
+    try:
+        return _IMPLEMENTACOES[nome][kernel](*args)
+    except Exception as e:
+        logger.warning(f"Kernel {kernel} falhou no backend {nome} ({e}), a usar numpy")
+        _resolvido = "numpy"
+        return _IMPLEMENTACOES["numpy"][kernel](*args)
+
+
+def ndvi(red: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    """NDVI = (NIR - R) / (NIR + R), NaN onde NIR + R = 0"""
+    return _executar("ndvi", red, nir)
+
+
+def fpar(ndvi: np.ndarray, minimo: float, maximo: float, nodata) -> np.ndarray:
+    """FPAR por escala linear do NDVI entre minimo e maximo (nodata fora dos válidos)"""
+    nodata = np.nan if nodata is None else nodata
+    return _executar("fpar", ndvi, minimo, maximo, nodata)
+
+
+def simi(b11: np.ndarray, b12: np.ndarray) -> np.ndarray:
+    """SIMI = 0.7071 * sqrt(B11² + B12²), com as bandas em reflectância x10000"""
+    return _executar("simi", b11, b12)
+
+
+def wsc(simi: np.ndarray, minimo: float, maximo: float) -> np.ndarray:
+    """WSC = 0.5 + 0.5 * (1 - SIMI normalizado), NaN onde não for finito"""
+    return _executar("wsc", simi, minimo, maximo)
+
+
+def t2(t_media: np.ndarray, topt: float) -> np.ndarray:
+    """T2 = 1.1814 / (1 + e^(0.2(Topt-10-T))) / (1 + e^(0.3(-Topt-10+T)))"""
+    return _executar("t2", t_media, topt)
+
+
+def npp(sol, fpar, t1: float, t2, wsc, emax) -> np.ndarray:
+    """NPP = 0.5 * SOL * FPAR * T1 * T2 * WSC * E_max"""
+    return _executar("npp", sol, fpar, t1, t2, wsc, emax)
+
+
+def _entradas_teste(pixeis: int, semente: int = 0) -> dict:
+    """Argumentos sintéticos de cada kernel, com NaN e zeros como nos dados reais"""
+    rng = np.random.default_rng(semente)
+    lado = int(np.sqrt(pixeis))
+    forma = (lado, lado)
+
+    def uniforme(a, b):
+        return rng.uniform(a, b, forma).astype(np.float32)
+
+    red, nir = uniforme(300, 1500), uniforme(1500, 4000)
+    red[:2, :] = 0
+    nir[:1, :] = 0
+    ndvi_teste = _ndvi_numpy(red, nir)
+    simi_teste = _simi_numpy(uniforme(1000, 3000), uniforme(500, 2000))
+    t_media = uniforme(5, 35)
+    t_media[0, :3] = np.nan
+    camada = uniforme(0, 1)
+    camada[1, :5] = np.nan
+    return {
+        "ndvi": (red, nir),
+        "fpar": (ndvi_teste, -0.5, 0.9, np.nan),
+        "simi": (uniforme(1000, 3000), uniforme(500, 2000)),
+        "wsc": (simi_teste, 0.07, 0.25),
+        "t2": (t_media, np.float32(20.0)),
+        "npp": (
+            uniforme(100, 500),
+            camada,
+            0.97,
+            uniforme(0, 1),
+            uniforme(0.5, 1),
+            uniforme(0, 1),
+        ),
+    }
+
+
+def comparar_backends(pixeis: int = 4_000_000, repeticoes: int = 3) -> dict:
+    """
+    Mede cada kernel em cada backend instalado e compara com o NumPy
+
+    A primeira chamada (compilação do numba, arranque das threads) não conta.
+
+    Retorna:
+    dict: {backend: {"tempos": {kernel: s}, "total_s", "iguais": bool, "erro"}}
+    """
+    entradas = _entradas_teste(pixeis)
+    referencia = {k: _IMPLEMENTACOES["numpy"][k](*a) for k, a in entradas.items()}
+
+    resultados = {}
+    for nome in backends_disponiveis():
+        implementacoes = _IMPLEMENTACOES[nome]
+        tempos = {}
+        iguais = True
+        try:
+            for kernel, argumentos in entradas.items():
+                resultado = implementacoes[kernel](*argumentos)
+                iguais &= bool(
+                    resultado.dtype == np.float32
+                    and np.allclose(
+                        resultado,
+                        referencia[kernel],
+                        rtol=RTOL,
+                        atol=ATOL,
+                        equal_nan=True,
+                    )
+                )
+                melhor = float("inf")
+                for _ in range(repeticoes):
+                    inicio = time.perf_counter()
+                    implementacoes[kernel](*argumentos)
+                    melhor = min(melhor, time.perf_counter() - inicio)
+                tempos[kernel] = round(melhor, 5)
+            erro = None
+        except Exception as e:
+            erro, iguais = repr(e), False
+        resultados[nome] = {
+            "tempos": tempos,
+            "total_s": round(sum(tempos.values()), 5),
+            "iguais": iguais,
+            "erro": erro,
+        }
+        logger.info(
+            f"{nome}: {resultados[nome]['total_s']:.4f} s, "
+            f"{'igual ao numpy' if iguais else 'DIFERENTE do numpy'}"
+        )
+    return resultados
+
+
+def escolher_backend(pixeis: int = 4_000_000, repeticoes: int = 3) -> str:
+    """
+    Escolhe o backend mais rápido com resultados iguais aos do NumPy, guarda a
+    escolha (usada por "auto" neste e nos próximos processos) e ativa-o
+    """
+    resultados = comparar_backends(pixeis, repeticoes)
+    validos = {n: r for n, r in resultados.items() if r["iguais"] and not r["erro"]}
+    escolhido = min(validos, key=lambda n: validos[n]["total_s"])
+
+    FICHEIRO_ESCOLHA.parent.mkdir(parents=True, exist_ok=True)
+    with open(FICHEIRO_ESCOLHA, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "backend": escolhido,
+                "data": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "pixeis": pixeis,
+                "resultados": resultados,
+            },
+            f,
+            indent=2,
+        )
+    logger.info(f"Backend escolhido: {escolhido} (guardado em {FICHEIRO_ESCOLHA})")
+    definir_backend("auto")
+    return escolhido
+
+
+def _escolha_guardada() -> str:
+    """Backend guardado por escolher_backend, se igual ao NumPy e sem erros"""
+    try:
+        with open(FICHEIRO_ESCOLHA, encoding="utf-8") as f:
+            escolha = json.load(f)
+        nome = escolha["backend"]
+        resultado = escolha["resultados"][nome]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if not resultado.get("iguais") or resultado.get("erro"):
+        logger.warning(f"Escolha guardada ({nome}) nao validada, a usar numpy")
+        return None
+    return nome
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="Compara os backends dos kernels e guarda o mais rápido"
+    )
+    parser.add_argument("--pixeis", type=int, default=4_000_000)
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument(
+        "--so-comparar", action="store_true", help="não guarda a escolha"
+    )
+    args = parser.parse_args()
+
+    if args.so_comparar:
+        resultados = comparar_backends(args.pixeis, args.repeticoes)
+    else:
+        escolher_backend(args.pixeis, args.repeticoes)
+        with open(FICHEIRO_ESCOLHA, encoding="utf-8") as f:
+            resultados = json.load(f)["resultados"]
+    for nome, r in resultados.items():
+        tempos = ", ".join(f"{k} {v * 1000:.1f} ms" for k, v in r["tempos"].items())
+        print(f"{nome:>8}: {r['total_s'] * 1000:8.1f} ms  ({tempos})")
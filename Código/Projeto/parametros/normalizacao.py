@@ -0,0 +1,90 @@
+import numpy as np
+
+# Classes do histograma usado para os percentis (resolução = amplitude / classes)
+CLASSES_HISTOGRAMA = 4096
+
+
+class Histograma:
+    """
+    Histograma de classes fixas entre minimo e maximo, acumulado bloco a bloco
+
+    Dois histogramas com os mesmos limites juntam-se somando as contagens
+    (juntar), pelo que blocos ou processos diferentes podem ser acumulados
+    separadamente. Os percentis são interpolados dentro da classe.
+    """
+
+    def __init__(self, minimo: float, maximo: float, classes: int = CLASSES_HISTOGRAMA):
+        self.minimo = float(minimo)
+        self.maximo = float(maximo)
+        self.contagens = np.zeros(classes, dtype=np.int64)
+
+    def acrescentar(self, valores: np.ndarray):
+        contagens, _ = np.histogram(
+            valores, bins=self.contagens.size, range=(self.minimo, self.maximo)
+        )
+        self.contagens += contagens
+
+    def juntar(self, outro: "Histograma"):
+        if (outro.minimo, outro.maximo, outro.contagens.size) != (
+            self.minimo,
+            self.maximo,
+            self.contagens.size,
+        ):
+            raise ValueError("Histogramas com limites ou classes diferentes")
+        self.contagens += outro.contagens
+
+    def percentil(self, q: float) -> float:
+        """Valor abaixo do qual fica q% dos valores acumulados"""
+        acumulado = np.cumsum(self.contagens)
+        if acumulado[-1] == 0:
+            raise ValueError("Histograma vazio")
+        alvo = q / 100 * acumulado[-1]
+        classe = min(int(np.searchsorted(acumulado, alvo)), self.contagens.size - 1)
+        antes = acumulado[classe - 1] if classe else 0
+        fracao = (
+            (alvo - antes) / self.contagens[classe] if self.contagens[classe] else 0
+        )
+        largura = (self.maximo - self.minimo) / self.contagens.size
+        return self.minimo + (classe + fracao) * largura
+
+
+def limites_normalizacao(passagem, percentis: tuple = None) -> tuple:
+    """
+    Limites globais para normalizar valores lidos por blocos
+
+    passagem: função sem argumentos que devolve um iterador novo pelos
+    valores válidos (1D) de cada bloco; é chamada uma vez para o mínimo e
+    máximo e, com percentis, uma segunda vez para o histograma. Com um único
+    bloco (o raster inteiro) o resultado é o mesmo que por blocos.
+    percentis: (inferior, superior), ex. (2, 98), para limites robustos a
+    valores extremos em vez do mínimo e máximo.
+
+    Retorna:
+    tuple: (minimo, maximo), ou None se não houver valores válidos
+    """
+    minimo = maximo = None
+    for valores in passagem():
+        if valores.size == 0:
+            continue
+        bloco_min, bloco_max = np.min(valores), np.max(valores)
+        minimo = bloco_min if minimo is None else min(minimo, bloco_min)
+        maximo = bloco_max if maximo is None else max(maximo, bloco_max)
+
+    if minimo is None:
+        return None
+    if percentis is None or minimo == maximo:
+        return minimo, maximo
+
+    histograma = Histograma(minimo, maximo)
+    for valores in passagem():
+        histograma.acrescentar(valores)
+    tipo = np.result_type(minimo)
+    return (
+        tipo.type(histograma.percentil(percentis[0])),
+        tipo.type(histograma.percentil(percentis[1])),
+    )
+
+
+def limitar(dados: np.ndarray, minimo: float, maximo: float, validos: np.ndarray):
+    """Limita os valores válidos a [minimo, maximo] (os restantes ficam iguais)"""
+    return np.where(validos, np.clip(dados, minimo, maximo), dados)
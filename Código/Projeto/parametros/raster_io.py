@@ -0,0 +1,304 @@
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import reproject
+from rasterio.windows import Window
+from typing import Iterator, NamedTuple, Union
+from contextlib import ExitStack
+from pathlib import Path
+
+from parametros.escrita_raster import DestinoBlocos, escrever_raster
+
+
+class RasterMemoria(NamedTuple):
+    """
+    Raster mantido em memória: dados de uma banda (ou várias, em 3D) e perfil
+    rasterio (crs, transform, nodata, ...) necessário para o georreferenciar.
+    descricoes e tags são os nomes das bandas e os metadados do GeoTIFF de
+    origem, escritos por materializar.
+    """
+
+    dados: np.ndarray
+    perfil: dict
+    descricoes: tuple = None
+    tags: dict = None
+
+
+FonteRaster = Union[str, Path, RasterMemoria]
+
+# Linhas por bloco na leitura/escrita por blocos (ler_blocos, EscritaPorBlocos)
+LINHAS_BLOCO = 512
+
+
+def ler_banda(fonte: FonteRaster, banda: int = 1):
+    """
+    Lê uma banda como float32 a partir de um ficheiro GeoTIFF ou de um RasterMemoria
+
+    Retorna:
+    tuple: (dados, perfil)
+    """
+    if isinstance(fonte, RasterMemoria):
+        dados = fonte.dados if fonte.dados.ndim == 2 else fonte.dados[banda - 1]
+        return dados.astype(np.float32, copy=False), fonte.perfil.copy()
+
+    with rasterio.open(fonte) as src:
+        return src.read(banda).astype(np.float32), src.profile.copy()
+
+
+def guardar_raster(
+    caminho,
+    dados: np.ndarray,
+    perfil: dict,
+    classe: str = "intermedio",
+    descricoes: tuple = None,
+    tags: dict = None,
+    **atualizacoes,
+):
+    """
+    Escreve um array 2D (uma banda) ou 3D (várias bandas) num GeoTIFF
+
+    classe: classe de saída (intermedio, resultado ou arquivo) que define o
+    codec, os blocos e as overviews (ver escrita_raster.CLASSES_SAIDA).
+    descricoes e tags: nomes das bandas e metadados a escrever.
+    """
+    return escrever_raster(
+        caminho, dados, perfil, classe, descricoes, tags, **atualizacoes
+    )
+
+
+def ler_perfil(fonte: FonteRaster) -> dict:
+    """Perfil rasterio de um ficheiro GeoTIFF ou de um RasterMemoria, sem ler os dados"""
+    if isinstance(fonte, RasterMemoria):
+        return fonte.perfil.copy()
+
+    with rasterio.open(fonte) as src:
+        return src.profile.copy()
+
+
+def janelas_de_linhas(altura: int, largura: int, linhas: int = LINHAS_BLOCO):
+    """Janelas de linhas completas (a última pode ser mais curta) que cobrem o raster"""
+    for linha in range(0, altura, linhas):
+        yield Window(0, linha, largura, min(linhas, altura - linha))
+
+
+def ler_blocos(
+    fonte: FonteRaster, bandas: tuple = (1,), linhas: int = LINHAS_BLOCO
+) -> Iterator[tuple]:
+    """
+    Lê bandas por blocos de linhas, como float32
+
+    Do GeoTIFF só fica em memória um bloco de cada vez; de um RasterMemoria
+    os blocos são vistas dos dados (sem cópia, se já forem float32).
+
+    Retorna:
+    iterador de (janela, tuplo com um bloco 2D por banda)
+    """
+    if isinstance(fonte, RasterMemoria):
+        dados = fonte.dados if fonte.dados.ndim == 3 else fonte.dados[np.newaxis]
+        for janela in janelas_de_linhas(*dados.shape[1:], linhas):
+            linhas_janela = slice(janela.row_off, janela.row_off + janela.height)
+            yield janela, tuple(
+                dados[banda - 1, linhas_janela].astype(np.float32, copy=False)
+                for banda in bandas
+            )
+        return
+
+    with rasterio.open(fonte) as src:
+        for janela in janelas_de_linhas(src.height, src.width, linhas):
+            yield janela, tuple(
+                src.read(banda, window=janela).astype(np.float32) for banda in bandas
+            )
+
+
+class EscritaPorBlocos:
+    """
+    Escreve uma banda por janelas num GeoTIFF (com as opções da classe de
+    saída, ver guardar_raster) ou, sem caminho, num array em memória
+    (devolvido como RasterMemoria por resultado)
+
+    with EscritaPorBlocos(caminho, perfil) as destino:
+        for janela, bloco in ...:
+            destino.escrever(janela, bloco)
+    destino.resultado()
+    """
+
+    def __init__(self, caminho, perfil: dict, classe: str = "intermedio"):
+        self.caminho = caminho
+        self.perfil = perfil.copy()
+        self.perfil.update(count=1)
+        self._destino = None
+        self._dst = None
+        self._dados = None
+        if caminho is not None:
+            self._destino = DestinoBlocos(caminho, self.perfil, classe)
+
+    def __enter__(self):
+        if self.caminho is None:
+            self._dados = np.empty(
+                (self.perfil["height"], self.perfil["width"]),
+                dtype=self.perfil["dtype"],
+            )
+        else:
+            self._dst = self._destino.__enter__()
+        return self
+
+    def escrever(self, janela: Window, bloco: np.ndarray):
+        bloco = bloco.astype(self.perfil["dtype"], copy=False)
+        if self._dst is not None:
+            self._dst.write(bloco, 1, window=janela)
+        else:
+            self._dados[
+                janela.row_off : janela.row_off + janela.height,
+                janela.col_off : janela.col_off + janela.width,
+            ] = bloco
+
+    def __exit__(self, *exc):
+        if self._dst is not None:
+            self._dst = None
+            return self._destino.__exit__(*exc)
+
+    def resultado(self):
+        """Caminho do GeoTIFF escrito, ou RasterMemoria com os dados"""
+        if self.caminho is None:
+            return RasterMemoria(self._dados, self.perfil)
+        return self.caminho
+
+
+def descricoes_bandas(fonte: FonteRaster) -> tuple:
+    """Nomes das bandas de um ficheiro GeoTIFF ou de um RasterMemoria"""
+    if isinstance(fonte, RasterMemoria):
+        contagem = 1 if fonte.dados.ndim == 2 else fonte.dados.shape[0]
+        return tuple(fonte.descricoes or (None,) * contagem)
+
+    with rasterio.open(fonte) as src:
+        return src.descriptions
+
+
+def ler_tags(fonte: FonteRaster) -> dict:
+    """Metadados (tags) de um ficheiro GeoTIFF ou de um RasterMemoria"""
+    if isinstance(fonte, RasterMemoria):
+        return dict(fonte.tags or {})
+
+    with rasterio.open(fonte) as src:
+        return src.tags()
+
+
+def materializar(raster: RasterMemoria, caminho, classe: str = "intermedio"):
+    """Escreve um RasterMemoria num GeoTIFF, com os nomes das bandas e as tags"""
+    return guardar_raster(
+        caminho,
+        raster.dados,
+        raster.perfil,
+        classe,
+        descricoes=raster.descricoes,
+        tags=raster.tags,
+    )
+
+
+class GrelhaAlvo(NamedTuple):
+    """Grelha de referência (CRS, transform e dimensões) para alinhar camadas"""
+
+    crs: object
+    transform: Affine
+    largura: int
+    altura: int
+
+    @property
+    def forma(self) -> tuple:
+        return (self.altura, self.largura)
+
+
+def grelha_de_raster(fonte: FonteRaster) -> GrelhaAlvo:
+    """Obtém a grelha de um ficheiro GeoTIFF ou de um RasterMemoria"""
+    if isinstance(fonte, RasterMemoria):
+        altura, largura = fonte.dados.shape[-2:]
+        return GrelhaAlvo(
+            fonte.perfil["crs"], fonte.perfil["transform"], largura, altura
+        )
+
+    with rasterio.open(fonte) as src:
+        return GrelhaAlvo(src.crs, src.transform, src.width, src.height)
+
+
+def esta_na_grelha(crs, transform: Affine, forma: tuple, grelha: GrelhaAlvo) -> bool:
+    """Indica se um raster (crs, transform, forma) já coincide com a grelha alvo"""
+    return (
+        tuple(forma) == grelha.forma
+        and crs == grelha.crs
+        and transform.almost_equals(grelha.transform)
+    )
+
+
+def alinhar_raster(
+    raster: RasterMemoria,
+    grelha: GrelhaAlvo,
+    metodo_reamostragem: Resampling = Resampling.nearest,
+) -> RasterMemoria:
+    """
+    Reprojeta (uma única vez) um RasterMemoria para a grelha alvo
+
+    Se o raster já estiver na grelha é devolvido sem cópia.
+    """
+    dados = raster.dados if raster.dados.ndim == 2 else raster.dados[0]
+    perfil = raster.perfil
+    if esta_na_grelha(perfil["crs"], perfil["transform"], dados.shape, grelha):
+        return raster
+
+    nodata = perfil.get("nodata")
+    dst_nodata = nodata if nodata is not None else np.nan
+    destino = np.full(grelha.forma, dst_nodata, dtype=np.float32)
+    reproject(
+        source=dados.astype(np.float32, copy=False),
+        destination=destino,
+        src_transform=perfil["transform"],
+        src_crs=perfil["crs"],
+        src_nodata=nodata,
+        dst_transform=grelha.transform,
+        dst_crs=grelha.crs,
+        dst_nodata=dst_nodata,
+        resampling=metodo_reamostragem,
+    )
+
+    novo_perfil = perfil.copy()
+    novo_perfil.update(
+        crs=grelha.crs,
+        transform=grelha.transform,
+        width=grelha.largura,
+        height=grelha.altura,
+        count=1,
+        dtype="float32",
+        nodata=dst_nodata,
+    )
+    return RasterMemoria(destino, novo_perfil)
+
+
+def abrir_alinhado(
+    caminho,
+    grelha: GrelhaAlvo,
+    pilha: ExitStack,
+    metodo_reamostragem: Resampling = Resampling.nearest,
+):
+    """
+    Abre um GeoTIFF para leitura na grelha alvo
+
+    Se o ficheiro já estiver na grelha devolve o próprio dataset; caso contrário
+    devolve um WarpedVRT (reprojeção virtual, lida por janelas a pedido), sem
+    reescrever o ficheiro. O dataset fica registado em pilha para ser fechado.
+    """
+    src = pilha.enter_context(rasterio.open(caminho))
+    if esta_na_grelha(src.crs, src.transform, src.shape, grelha):
+        return src
+
+    return pilha.enter_context(
+        WarpedVRT(
+            src,
+            crs=grelha.crs,
+            transform=grelha.transform,
+            width=grelha.largura,
+            height=grelha.altura,
+            resampling=metodo_reamostragem,
+            nodata=src.nodata if src.nodata is not None else np.nan,
+        )
+    )
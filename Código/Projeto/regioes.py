@@ -0,0 +1,247 @@
+import json
+import math
+from pathlib import Path
+from typing import NamedTuple
+
+# shapely e rasterio só são importados quando usados: a interface importa o
+# registo de regiões antes de a janela aparecer
+
+projeto_dir = Path(__file__).parent.resolve()
+anexos_dir = projeto_dir.parent.parent / "ANEXOS"
+
+# Variação percentual mensal do GHI (relativa à média diária anual) de Oeiras
+VAR_PCT_MES_OEIRAS = {
+    1: -53.57138918,
+    2: -35.49327248,
+    3: -17.53257806,
+    4: 21.45016561,
+    5: 52.10518815,
+    6: 42.992943,
+    7: 63.0189765,
+    8: 55.56084036,
+    9: 20.07604713,
+    10: -32.22469972,
+    11: -49.63097221,
+    12: -49.23973522,
+}
+
+
+class Regiao(NamedTuple):
+    """
+    Área de estudo: geometria, dados socioeconómicos e entradas estáticas
+
+    wkt_quadrado é o retângulo envolvente da região (extensão pedida ao openEO
+    e recorte do GHI); shapefile é o limite usado para recortar os rasters.
+    worldcover pode ser uma lista de mosaicos, se a região atravessar vários.
+    var_pct_mes: variação percentual mensal do GHI da região (relativa à
+    média diária anual), usada no SOL; None enquanto não houver dados (a
+    região não pode então ser processada).
+    zonas: {camada: (ficheiro vetorial, campo com o nome da zona)} para as
+    estatísticas zonais (ex.: freguesias da CAOP, parques); as classes
+    WorldCover são sempre incluídas.
+    """
+
+    nome: str
+    descricao: str
+    shapefile: Path
+    wkt_quadrado: Path
+    populacao: int
+    emissoes_co2_per_capita: float  # t CO₂/pessoa/mês
+    ghi: Path
+    worldcover: Path
+    var_pct_mes: dict
+    zonas: dict = {}
+
+    def quadrado(self):
+        """Retângulo envolvente como geometria shapely (EPSG:4326)"""
+        from shapely import wkt
+
+        with open(self.wkt_quadrado, encoding="utf-8") as f:
+            return wkt.loads(f.read().strip())
+
+    def mosaicos_worldcover(self) -> list:
+        """Mosaicos WorldCover da região, sempre como lista"""
+        if isinstance(self.worldcover, (list, tuple)):
+            return list(self.worldcover)
+        return [self.worldcover]
+
+    def limites(self) -> tuple:
+        """(oeste, sul, este, norte) do retângulo envolvente, em graus"""
+        return self.quadrado().bounds
+
+
+REGIOES = {
+    "OEIRAS": Regiao(
+        nome="OEIRAS",
+        descricao="Oeiras, Lisboa, Portugal",
+        shapefile=projeto_dir / "Oeiras" / "oeiras_shapefile.shp",
+        wkt_quadrado=projeto_dir / "Oeiras" / "oeiras_wkt_square.wkt",
+        populacao=172120,
+        emissoes_co2_per_capita=0.8917,
+        ghi=projeto_dir / "INPUTS" / "SOL" / "GHI.tif",
+        worldcover=projeto_dir
+        / "INPUTS"
+        / "Subset_ESA_WorldCover_10m_2021_v200_N36W012_Map.tif",
+        var_pct_mes=VAR_PCT_MES_OEIRAS,
+    ),
+    # Parque florestal, sem população residente: o relatório mostra só a absorção
+    "MONSANTO": Regiao(
+        nome="MONSANTO",
+        descricao="Parque Florestal de Monsanto, Lisboa, Portugal",
+        shapefile=anexos_dir / "Monsanto" / "geometry_Polygon.shp",
+        wkt_quadrado=anexos_dir / "Monsanto" / "monsanto_wkt_square.wkt",
+        populacao=0,
+        emissoes_co2_per_capita=0.8917,
+        ghi=projeto_dir / "INPUTS" / "SOL" / "GHI.tif",
+        # Mesmo mosaico N36W012 e mesmo clima que Oeiras, que lhe é contígua
+        worldcover=projeto_dir
+        / "INPUTS"
+        / "Subset_ESA_WorldCover_10m_2021_v200_N36W012_Map.tif",
+        var_pct_mes=VAR_PCT_MES_OEIRAS,
+    ),
+    "FLORES": Regiao(
+        nome="FLORES",
+        descricao="Ilha das Flores, Açores, Portugal",
+        shapefile=anexos_dir / "Flores" / "geometry_Polygon.shp",
+        wkt_quadrado=anexos_dir / "Flores" / "flores_wkt_square.txt",
+        populacao=3428,  # Censos 2021
+        emissoes_co2_per_capita=0.8917,
+        ghi=projeto_dir / "INPUTS" / "FLORES" / "GHI.tif",
+        worldcover=projeto_dir
+        / "INPUTS"
+        / "FLORES"
+        / "Subset_ESA_WorldCover_10m_2021_v200_N39W033_Map.tif",
+        var_pct_mes=None,  # por preencher com a variação mensal do GHI das Flores
+    ),
+    # Sem dados de população: o relatório mostra só a absorção
+    "CHINA": Regiao(
+        nome="CHINA",
+        descricao="Qinghai, China",
+        shapefile=anexos_dir / "China" / "geometry_polygon_Polygon.shp",
+        wkt_quadrado=anexos_dir / "China" / "china_wkt_square.txt",
+        populacao=0,
+        emissoes_co2_per_capita=0.0,
+        ghi=projeto_dir / "INPUTS" / "CHINA" / "GHI.tif",
+        worldcover=projeto_dir
+        / "INPUTS"
+        / "CHINA"
+        / "Subset_ESA_WorldCover_10m_2021_v200_N36E099_Map.tif",
+        var_pct_mes=None,  # por preencher com a variação mensal do GHI de Qinghai
+    ),
+}
+
+
+def obter_regiao(regiao) -> Regiao:
+    """Aceita um Regiao ou o nome de uma região do registo (ex.: "OEIRAS")"""
+    if isinstance(regiao, Regiao):
+        return regiao
+    try:
+        return REGIOES[regiao.upper()]
+    except KeyError:
+        raise ValueError(
+            f"Regiao desconhecida: '{regiao}'. Disponiveis: {', '.join(REGIOES)}"
+        )
+
+
+def agrupar_sobrepostas(regioes: list) -> list:
+    """
+    Agrupa as regiões cujos retângulos envolventes se sobrepõem (transitivamente)
+
+    Regiões do mesmo grupo podem partilhar um único download, feito sobre a
+    união dos retângulos.
+
+    Retorna:
+    list: Lista de grupos (listas de Regiao), pela ordem de entrada
+    """
+    regioes = [obter_regiao(r) for r in regioes]
+    quadrados = [r.quadrado() for r in regioes]
+    grupo_de = list(range(len(regioes)))
+
+    def raiz(i):
+        while grupo_de[i] != i:
+            i = grupo_de[i]
+        return i
+
+    for i in range(len(regioes)):
+        for j in range(i + 1, len(regioes)):
+            if quadrados[i].intersects(quadrados[j]):
+                grupo_de[raiz(j)] = raiz(i)
+
+    grupos = {}
+    for i, regiao in enumerate(regioes):
+        grupos.setdefault(raiz(i), []).append(regiao)
+    return list(grupos.values())
+
+
+def escrever_geojson_envolvente(regioes: list, caminho: Path) -> Path:
+    """Escreve (como coordenadas.txt) o retângulo que envolve todas as regiões"""
+    limites = [obter_regiao(r).limites() for r in regioes]
+    oeste = min(l[0] for l in limites)
+    sul = min(l[1] for l in limites)
+    este = max(l[2] for l in limites)
+    norte = max(l[3] for l in limites)
+    poligono = {
+        "type": "Polygon",
+        "coordinates": [
+            [[oeste, sul], [este, sul], [este, norte], [oeste, norte], [oeste, sul]]
+        ],
+    }
+    caminho = Path(caminho)
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(poligono, f, indent=4)
+    return caminho
+
+
+def escrever_geojson_regiao(regiao, caminho: Path) -> Path:
+    """Escreve o retângulo envolvente de uma região como GeoJSON (pedido openEO)"""
+    from shapely.geometry import mapping
+
+    caminho = Path(caminho)
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(mapping(obter_regiao(regiao).quadrado()), f, indent=4)
+    return caminho
+
+
+def recortar_extensao_regiao(origem: Path, destino: Path, regiao) -> Path:
+    """
+    Recorta um download partilhado para o retângulo envolvente de uma região
+
+    O resultado equivale ao GeoTIFF que um pedido só dessa região devolveria,
+    pelo que as etapas seguintes (máscara, T1/T2) não mudam.
+    """
+    import rasterio
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import Window, from_bounds
+
+    from parametros.raster_io import guardar_raster
+
+    regiao = obter_regiao(regiao)
+    with rasterio.open(origem) as src:
+        limites = transform_bounds("EPSG:4326", src.crs, *regiao.limites())
+        exata = from_bounds(*limites, transform=src.transform)
+        # Incluir os pixels parcialmente cobertos, como o openEO
+        coluna, linha = math.floor(exata.col_off), math.floor(exata.row_off)
+        janela = Window(
+            coluna,
+            linha,
+            math.ceil(exata.col_off + exata.width) - coluna,
+            math.ceil(exata.row_off + exata.height) - linha,
+        ).intersection(Window(0, 0, src.width, src.height))
+        perfil = src.profile.copy()
+        perfil.update(
+            width=janela.width,
+            height=janela.height,
+            transform=src.window_transform(janela),
+        )
+        destino = Path(destino)
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        guardar_raster(
+            destino,
+            src.read(window=janela),
+            perfil,
+            descricoes=src.descriptions,
+            tags=src.tags(),
+        )
+    return destino
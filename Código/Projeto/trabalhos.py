@@ -0,0 +1,237 @@
+import importlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# main (openeo, geopandas, rasterio e os módulos de parametros) só é
+# importado pelo primeiro trabalho ou por precarregar: importar este módulo
+# não atrasa a abertura da interface
+
+logger = logging.getLogger(__name__)
+
+# Trabalhos executados em simultâneo por omissão
+MAX_TRABALHOS = 2
+
+# Estados de um trabalho
+EM_FILA = "em fila"
+A_CORRER = "a correr"
+CONCLUIDO = "concluido"
+FALHOU = "falhou"
+CANCELADO = "cancelado"
+TERMINADOS = (CONCLUIDO, FALHOU, CANCELADO)
+
+
+def precarregar():
+    """Importa main e as suas dependências (ex.: numa thread, com a janela já aberta)"""
+    inicio = time.perf_counter()
+    for modulo in ("main", "parametros.cubo_resultados"):
+        importlib.import_module(modulo)
+    logger.info(f"Modulos de calculo carregados em {time.perf_counter() - inicio:.1f}s")
+
+
+class Trabalho:
+    """
+    Processamento de um mês de uma região, com a sua diretoria de trabalho
+
+    estado, etapa, concluidas/total e mensagem são atualizados pela thread
+    que o executa; quem os lê noutra thread recebe-os através de ao_atualizar
+    (ver GestorTrabalhos).
+    """
+
+    def __init__(self, numero: int, ano: int, mes: int, regiao: str, diretoria: Path):
+        self.numero = numero
+        self.ano = ano
+        self.mes = mes
+        self.regiao = regiao
+        self.diretoria = diretoria
+        self.estado = EM_FILA
+        self.etapa = None
+        self.concluidas = 0
+        self.total = None
+        self.mensagem = ""
+        self.resultado = None
+        self.inicio = None
+        self.fim = None
+        self.cancelamento = threading.Event()
+        self.futuro = None
+
+    @property
+    def descricao(self) -> str:
+        return f"{self.regiao} {self.mes:02d}/{self.ano}"
+
+    @property
+    def relatorio(self) -> Path:
+        return self.diretoria / "RESULT" / "RELATORIO_NPP.txt"
+
+
+class GestorTrabalhos:
+    """
+    Fila de trabalhos (mês, região) executados por um conjunto de threads
+
+    Cada trabalho corre main() na sua diretoria
+    (resultados_base/<REGIAO>/<ano>.RESULTS.BY.MONTH/<mes>.<REGIAO>, como em
+    executar_intervalo), pelo que trabalhos diferentes não partilham OUTPUTS
+    nem RESULT; um trabalho para uma diretoria ainda em fila ou a correr é
+    recusado. Voltar a pedir um mês já processado retoma-o pelo manifesto de
+    etapas. Os meses concluídos são acrescentados ao cubo da região um de
+    cada vez.
+
+    ao_atualizar(trabalho) é chamada (na thread do trabalho) sempre que o
+    estado ou a etapa mudam; a interface deve passá-la para o seu ciclo
+    principal antes de mexer em widgets.
+    """
+
+    def __init__(
+        self,
+        max_trabalhos: int = MAX_TRABALHOS,
+        resultados_base: Path = None,
+        ao_atualizar=None,
+        **opcoes_main,
+    ):
+        self.resultados_base = Path(
+            resultados_base or Path(__file__).parent.resolve() / "Resultados"
+        )
+        self.ao_atualizar = ao_atualizar
+        self.opcoes_main = opcoes_main
+        self.trabalhos = []
+        self._lock = threading.Lock()
+        self._lock_cubo = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_trabalhos, thread_name_prefix="trabalho"
+        )
+
+    def diretoria(self, ano: int, mes: int, regiao: str) -> Path:
+        return (
+            self.resultados_base
+            / regiao
+            / f"{ano}.RESULTS.BY.MONTH"
+            / f"{mes:02d}.{regiao}"
+        )
+
+    def submeter(self, ano: int, mes: int, regiao: str = "OEIRAS") -> Trabalho:
+        """
+        Acrescenta um trabalho à fila
+
+        Lança:
+        ValueError: se o mesmo mês e região já estiver em fila ou a correr
+        """
+        diretoria = self.diretoria(ano, mes, regiao)
+        with self._lock:
+            for outro in self.trabalhos:
+                if outro.diretoria == diretoria and outro.estado not in TERMINADOS:
+                    raise ValueError(
+                        f"{outro.descricao} ja esta {outro.estado} (trabalho {outro.numero})"
+                    )
+            trabalho = Trabalho(len(self.trabalhos) + 1, ano, mes, regiao, diretoria)
+            self.trabalhos.append(trabalho)
+            trabalho.futuro = self._pool.submit(self._executar, trabalho)
+
+        logger.info(f"Trabalho {trabalho.numero} em fila: {trabalho.descricao}")
+        self._notificar(trabalho)
+        return trabalho
+
+    def cancelar(self, numero: int):
+        """
+        Cancela um trabalho: se ainda estiver em fila não chega a correr; a
+        correr, para no fim da etapa em curso
+        """
+        trabalho = self.trabalhos[numero - 1]
+        if trabalho.estado in TERMINADOS:
+            return
+        trabalho.cancelamento.set()
+        if trabalho.futuro.cancel():
+            self._terminar(trabalho, CANCELADO, "cancelado antes de comecar")
+        else:
+            trabalho.mensagem = "a cancelar no fim da etapa"
+            self._notificar(trabalho)
+
+    def cancelar_todos(self):
+        for trabalho in list(self.trabalhos):
+            self.cancelar(trabalho.numero)
+
+    def ativos(self) -> list:
+        return [t for t in self.trabalhos if t.estado not in TERMINADOS]
+
+    def encerrar(self, cancelar: bool = True):
+        """Termina o conjunto de threads (cancelando, por omissão, o que falta)"""
+        if cancelar:
+            self.cancelar_todos()
+        self._pool.shutdown(wait=False)
+
+    def _executar(self, trabalho: Trabalho):
+        from etapas import ExecucaoCancelada, FalhaEtapa
+        from main import main
+
+        if trabalho.cancelamento.is_set():
+            self._terminar(trabalho, CANCELADO, "cancelado antes de comecar")
+            return
+
+        trabalho.estado = A_CORRER
+        trabalho.inicio = time.time()
+        self._notificar(trabalho)
+
+        def progresso(etapa, concluidas, total, estado):
+            trabalho.etapa = etapa
+            trabalho.concluidas = concluidas
+            trabalho.total = total
+            if not trabalho.cancelamento.is_set():
+                trabalho.mensagem = estado
+            self._notificar(trabalho)
+
+        try:
+            trabalho.resultado = main(
+                trabalho.ano,
+                trabalho.mes,
+                diretoria_trabalho=trabalho.diretoria,
+                regiao=trabalho.regiao,
+                cubo=None,
+                progresso=progresso,
+                cancelamento=trabalho.cancelamento,
+                **self.opcoes_main,
+            )
+        except ExecucaoCancelada as e:
+            self._terminar(trabalho, CANCELADO, str(e))
+            return
+        except FalhaEtapa as e:
+            self._terminar(trabalho, FALHOU, str(e))
+            return
+        except Exception as e:
+            logger.exception(f"Trabalho {trabalho.numero} ({trabalho.descricao})")
+            self._terminar(trabalho, FALHOU, repr(e))
+            return
+
+        self._acrescentar_ao_cubo(trabalho)
+        self._terminar(trabalho, CONCLUIDO, f"resultados em {trabalho.diretoria}")
+
+    def _acrescentar_ao_cubo(self, trabalho: Trabalho):
+        from main import NOME_CUBO
+        from parametros.cubo_resultados import CuboResultados
+
+        with self._lock_cubo:
+            try:
+                CuboResultados(
+                    self.resultados_base / trabalho.regiao / NOME_CUBO
+                ).acrescentar_mes(
+                    trabalho.ano,
+                    trabalho.mes,
+                    trabalho.resultado["npp"],
+                    regiao=trabalho.regiao,
+                )
+            except Exception as e:
+                logger.warning(f"{trabalho.descricao} nao acrescentado ao cubo: {e}")
+
+    def _terminar(self, trabalho: Trabalho, estado: str, mensagem: str):
+        trabalho.estado = estado
+        trabalho.mensagem = mensagem
+        trabalho.fim = time.time()
+        logger.info(f"Trabalho {trabalho.numero} ({trabalho.descricao}): {estado}")
+        self._notificar(trabalho)
+
+    def _notificar(self, trabalho: Trabalho):
+        if self.ao_atualizar is not None:
+            try:
+                self.ao_atualizar(trabalho)
+            except Exception:
+                logger.exception("Erro ao notificar o estado de um trabalho")